@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Compares recording draws and plays in per-player lists of (entity, turn)
+tuples against the array columns of mapred.events, per replay: export time
+and the number and size of allocations (with tracemalloc).
+
+Usage:
+	$ PYTHONPATH=lib python benchmarks/exporter_events.py build/hsreplay-test-data/*.xml
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from hearthstone.enums import BlockType, GameTag, Zone
+from hearthstone.hslog.export import EntityTreeExporter
+from hsreplay.document import HSReplayDocument
+
+from mapred.events import EventExporter
+
+
+class ListExporter(EntityTreeExporter):
+	"""
+	The exporter contrib/chess_brawl.py used before mapred.events.
+	"""
+	def handle_create_game(self, packet):
+		super().handle_create_game(packet)
+		for player in self.game.players:
+			player.drawn_cards = []
+			player.played_cards = []
+
+	def handle_block(self, block):
+		if block.type == BlockType.PLAY:
+			entity = self.game.find_entity_by_id(block.entity)
+			controller = entity.controller
+			if controller:
+				turn = self.game.tags.get(GameTag.TURN, 0)
+				controller.played_cards.append((entity, turn))
+		super().handle_block(block)
+
+	def handle_drawn_card(self, entity_id):
+		entity = self.game.find_entity_by_id(entity_id)
+		if entity.zone == Zone.DECK:
+			controller = entity.controller
+			if controller:
+				turn = self.game.tags.get(GameTag.TURN, 0)
+				controller.drawn_cards.append((entity, turn))
+
+	def handle_show_entity(self, packet):
+		tags = dict(packet.tags)
+		if tags.get(GameTag.ZONE, 0) == Zone.HAND:
+			self.handle_drawn_card(packet.entity)
+		super().handle_show_entity(packet)
+
+	def handle_tag_change(self, packet):
+		if packet.tag == GameTag.ZONE and packet.value == Zone.HAND:
+			self.handle_drawn_card(packet.entity)
+		super().handle_tag_change(packet)
+
+
+def best_time(iterations, func):
+	best = None
+	for i in range(iterations):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def allocations(func):
+	"""
+	Return the number of blocks and bytes allocated by `func()` which are
+	still alive when it returns, and its peak memory use.
+	"""
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	ret = func()
+	after = tracemalloc.take_snapshot()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	stats = after.compare_to(before, "filename")
+	del ret
+	return sum(s.count_diff for s in stats), sum(s.size_diff for s in stats), peak
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("paths", nargs="+", help="Uncompressed HSReplay XML files")
+	p.add_argument("-n", "--iterations", type=int, default=5)
+	args = p.parse_args()
+
+	print("%-32s %9s %9s %9s %9s %10s %10s" % (
+		"replay", "list (ms)", "array (ms)", "list blk", "array blk", "list peak", "array peak"
+	))
+	totals = [0.0, 0.0, 0, 0]
+	for path in args.paths:
+		with open(path, "rb") as f:
+			packet_tree = HSReplayDocument.from_xml_file(f).to_packet_tree()[0]
+
+		results = []
+		for exporter_class in (ListExporter, EventExporter):
+			export = lambda: packet_tree.export(exporter_class)
+			elapsed = best_time(args.iterations, export)
+			blocks, size, peak = allocations(export)
+			results.append((elapsed, blocks, peak))
+
+		(list_time, list_blocks, list_peak), (array_time, array_blocks, array_peak) = results
+		totals[0] += list_time
+		totals[1] += array_time
+		totals[2] += list_blocks
+		totals[3] += array_blocks
+		print("%-32s %9.1f %10.1f %9i %9i %9iK %9iK" % (
+			path[-32:], list_time * 1000, array_time * 1000, list_blocks, array_blocks,
+			list_peak // 1024, array_peak // 1024,
+		))
+
+	print("%-32s %9.1f %10.1f %9i %9i" % ("total", totals[0] * 1000, totals[1] * 1000, totals[2], totals[3]))
+
+
+if __name__ == "__main__":
+	main()
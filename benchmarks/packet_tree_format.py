@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compares building packet trees from HSReplay XML against loading them from
+the binary packet tree format (mapred.packetstore), per replay.
+
+Usage:
+	$ PYTHONPATH=lib python benchmarks/packet_tree_format.py build/hsreplay-test-data/*.xml
+"""
+
+import argparse
+import gzip
+import time
+from io import BytesIO
+
+from hsreplay.document import HSReplayDocument
+
+from mapred import packetstore
+
+
+def best_of(iterations, func):
+	best = None
+	for i in range(iterations):
+		start = time.time()
+		ret = func()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best, ret
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("paths", nargs="+", help="Uncompressed HSReplay XML files")
+	p.add_argument("-n", "--iterations", type=int, default=3)
+	args = p.parse_args()
+
+	def from_xml(data):
+		return HSReplayDocument.from_xml_file(BytesIO(data)).to_packet_tree()
+
+	print("%-40s %10s %10s %8s %10s %10s" % (
+		"replay", "xml (ms)", "hspt (ms)", "speedup", "xml.gz KB", "hspt.gz KB"
+	))
+	totals = [0.0, 0.0]
+	for path in args.paths:
+		with open(path, "rb") as f:
+			xml = f.read()
+
+		xml_time, packet_trees = best_of(args.iterations, lambda: from_xml(xml))
+		out = BytesIO()
+		packetstore.dump(packet_trees, out)
+		data = out.getvalue()
+		load_time, _ = best_of(args.iterations, lambda: packetstore.load(BytesIO(data)))
+
+		totals[0] += xml_time
+		totals[1] += load_time
+		print("%-40s %10.1f %10.1f %7.1fx %10i %10i" % (
+			path[-40:], xml_time * 1000, load_time * 1000, xml_time / load_time,
+			len(gzip.compress(xml)) // 1024, len(gzip.compress(data)) // 1024,
+		))
+
+	print("%-40s %10.1f %10.1f %7.1fx" % (
+		"total", totals[0] * 1000, totals[1] * 1000, totals[0] / totals[1]
+	))
+
+
+if __name__ == "__main__":
+	main()
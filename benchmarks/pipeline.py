@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of the analysis jobs over a local replay corpus.
+
+Every contrib/ job and load_redshift.py (exporting to local part files) is
+run over the corpus, each in its own interpreter so that its peak RSS is its
+own. Inputs are served from gzipped copies of the corpus by
+mapred.s3.LocalBucket, so no network access is needed: HSReplay XML files (*.xml) are given
+to XML jobs and Power.log files (*.log, *.txt) to PowerlogS3Protocol jobs.
+
+Usage:
+	$ ./scripts/update_log_data.sh
+	$ PYTHONPATH=lib python benchmarks/pipeline.py build/hsreplay-test-data \\
+		--output results.json [--baseline baseline.json]
+
+Results are written as JSON: replays/s, MB/s (of uncompressed input), peak
+RSS and the wall time of every stage of mapred.timing, per job. With
+--baseline, each job is compared against a previous results file, and the
+exit status is 1 if any of them got slower by more than --threshold.
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from read_s3 import peak_rss_kb
+
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "bench"
+XML_EXTENSIONS = (".xml", )
+LOG_EXTENSIONS = (".log", ".txt")
+
+
+def find_jobs():
+	jobs = sorted(glob.glob(os.path.join(BASEDIR, "contrib", "*.py")))
+	jobs = [path for path in jobs if not path.endswith("__init__.py")]
+	return jobs + [os.path.join(BASEDIR, "load_redshift.py")]
+
+
+def job_name(path):
+	return os.path.splitext(os.path.basename(path))[0]
+
+
+def prepare(corpus, root):
+	"""
+	Store gzipped copies of the corpus under `root`/BUCKET, the directory
+	LocalBucket serves from. Returns the keys and uncompressed sizes per input format.
+	"""
+	inputs = {"xml": [], "log": []}
+	os.makedirs(os.path.join(root, BUCKET))
+	for dirpath, dirnames, filenames in os.walk(corpus):
+		dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+		for filename in sorted(filenames):
+			if filename.endswith(XML_EXTENSIONS):
+				format = "xml"
+			elif filename.endswith(LOG_EXTENSIONS):
+				format = "log"
+			else:
+				continue
+			path = os.path.join(dirpath, filename)
+			key = "%s/%i.gz" % (format, len(inputs[format]))
+			os.makedirs(os.path.join(root, BUCKET, format), exist_ok=True)
+			with open(path, "rb") as src, gzip.open(os.path.join(root, BUCKET, key), "wb") as dst:
+				shutil.copyfileobj(src, dst)
+			inputs[format].append((key, os.path.getsize(path)))
+	return inputs
+
+
+def get_job_args(path, workdir):
+	if job_name(path) == "load_redshift":
+		return ["--export-location", "local:%s/" % (os.path.join(workdir, "export"))]
+	return []
+
+
+def run_job(path, root, inputs, iterations, workdir):
+	"""
+	Run the job at `path` in the current process and return its results.
+	"""
+	from mapred import s3
+	from mapred.local import create_job, run_inline
+	from mapred.protocols import PowerlogS3Protocol
+
+	s3.set_client(s3.LocalBucket(os.path.join(root, BUCKET)))
+	job = create_job(path, None, get_job_args(path, workdir))
+
+	format = "log" if issubclass(job.INPUT_PROTOCOL, PowerlogS3Protocol) else "xml"
+	lines = []
+	for i in range(iterations):
+		for key, size in inputs[format]:
+			metadata = {"game_id": len(lines) + 1}
+			lines.append(("%s:%s:%s" % (BUCKET, key, json.dumps(metadata))).encode("utf-8"))
+	input_bytes = iterations * sum(size for key, size in inputs[format])
+
+	baseline_rss = peak_rss_kb()
+	start = time.time()
+	pairs, counters = run_inline(job, lines)
+	elapsed = time.time() - start
+
+	stages = {}
+	for counter, amount in counters.get("timing", {}).items():
+		if counter.endswith("_wall_ms"):
+			stages[counter[:-len("_wall_ms")]] = amount
+	errors = sum(
+		amount for group in ("errors", "exceptions") for amount in counters.get(group, {}).values()
+	)
+
+	return {
+		"format": format,
+		"replays": len(lines),
+		"output_pairs": len(pairs),
+		"errors": errors,
+		"seconds": elapsed,
+		"replays_per_sec": len(lines) / elapsed if elapsed else 0,
+		"mb_per_sec": input_bytes / elapsed / 1024 / 1024 if elapsed else 0,
+		"baseline_rss_kb": baseline_rss,
+		"peak_rss_kb": peak_rss_kb(),
+		"stage_wall_ms": stages,
+	}
+
+
+def run_child(path, root, inputs_path, iterations, workdir):
+	command = [
+		sys.executable, __file__, "--run-job", path, "--root", root, "--inputs", inputs_path,
+		"--iterations", str(iterations), "--workdir", workdir,
+	]
+	proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if proc.returncode:
+		lines = proc.stderr.decode("utf-8", "replace").strip().splitlines()
+		return {"error": lines[-1] if lines else "exit status %i" % (proc.returncode)}
+	return json.loads(proc.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+	"""
+	Print the change of every job against `baseline` and return the names of
+	the jobs whose throughput dropped by more than `threshold`.
+	"""
+	regressions = []
+	print()
+	print("%-28s %12s %12s %8s %14s" % ("job", "baseline r/s", "replays/s", "change", "peak RSS diff"))
+	for name, result in sorted(results.items()):
+		previous = baseline.get("jobs", {}).get(name)
+		if not previous or "error" in result or "error" in previous:
+			continue
+		before, after = previous["replays_per_sec"], result["replays_per_sec"]
+		change = (after - before) / before if before else 0
+		if change < -threshold:
+			regressions.append(name)
+		print("%-28s %12.2f %12.2f %+7.1f%% %+13iK%s" % (
+			name, before, after, change * 100, result["peak_rss_kb"] - previous["peak_rss_kb"],
+			"  SLOWER" if name in regressions else "",
+		))
+	return regressions
+
+
+def print_results(results):
+	print("%-28s %6s %8s %10s %8s %10s  %s" % (
+		"job", "format", "replays", "replays/s", "MB/s", "RSS (KB)", "slowest stages (ms)"
+	))
+	for name, result in sorted(results.items()):
+		if "error" in result:
+			print("%-28s failed: %s" % (name, result["error"]))
+			continue
+		stages = sorted(result["stage_wall_ms"].items(), key=lambda item: -item[1])[:3]
+		print("%-28s %6s %8i %10.2f %8.2f %10i  %s" % (
+			name, result["format"], result["replays"], result["replays_per_sec"],
+			result["mb_per_sec"], result["peak_rss_kb"],
+			", ".join("%s %i" % (stage, ms) for stage, ms in stages),
+		))
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("corpus", nargs="?", help="Directory of replays (eg. build/hsreplay-test-data)")
+	p.add_argument("-n", "--iterations", type=int, default=1, help="Number of passes over the corpus")
+	p.add_argument("--job", action="append", help="Only run this job (name or path, repeatable)")
+	p.add_argument("-o", "--output", help="File to write the results to, as JSON")
+	p.add_argument("--baseline", help="Results file to compare against")
+	p.add_argument("--threshold", type=float, default=0.1, help="Slowdown considered a regression")
+	p.add_argument("--run-job", help=argparse.SUPPRESS)
+	p.add_argument("--root", help=argparse.SUPPRESS)
+	p.add_argument("--inputs", help=argparse.SUPPRESS)
+	p.add_argument("--workdir", help=argparse.SUPPRESS)
+	args = p.parse_args()
+
+	if args.run_job:
+		# Child process: run a single job and report back as JSON
+		with open(args.inputs, "r") as f:
+			inputs = json.load(f)
+		result = run_job(args.run_job, args.root, inputs, args.iterations, args.workdir)
+		print(json.dumps(result))
+		return
+
+	if not args.corpus:
+		p.error("A corpus directory is required")
+
+	jobs = find_jobs()
+	if args.job:
+		jobs = [path for path in jobs if job_name(path) in args.job or path in args.job]
+
+	root = tempfile.mkdtemp()
+	try:
+		inputs = prepare(args.corpus, root)
+		if not inputs["xml"] and not inputs["log"]:
+			p.error("No replays found in %r" % (args.corpus))
+		inputs_path = os.path.join(root, "inputs.json")
+		with open(inputs_path, "w") as f:
+			json.dump(inputs, f)
+
+		results = {}
+		for path in jobs:
+			name = job_name(path)
+			sys.stderr.write("Running %s\n" % (name))
+			workdir = os.path.join(root, "work", name)
+			os.makedirs(workdir)
+			results[name] = run_child(path, root, inputs_path, args.iterations, workdir)
+	finally:
+		shutil.rmtree(root)
+
+	print_results(results)
+	report = {
+		"time": int(time.time()),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"iterations": args.iterations,
+		"corpus": dict((format, len(keys)) for format, keys in inputs.items()),
+		"jobs": results,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent="\t", sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline, "r") as f:
+			baseline = json.load(f)
+		if compare(results, baseline, args.threshold):
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
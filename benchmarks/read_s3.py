@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compares the streaming and buffered S3 read paths of BaseS3Protocol.
+
+Each mode runs in its own interpreter so that the reported peak RSS only
+reflects that mode. S3 is replaced by mapred.s3.LocalBucket, serving gzipped
+copies of the given replays from a temporary directory.
+
+Usage:
+	$ PYTHONPATH=lib python benchmarks/read_s3.py build/hsreplay-test-data/*.xml
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+MODES = ("buffered", "streaming")
+BUCKET = "bench"
+
+
+def peak_rss_kb():
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		# Reported in bytes on OS X
+		rss //= 1024
+	return rss
+
+
+def run_mode(mode, root, keys, iterations):
+	from hsreplay.document import HSReplayDocument
+	from mapred import protocols, s3
+
+	s3.set_client(s3.LocalBucket(os.path.join(root, BUCKET)))
+	protocol = protocols.BaseS3Protocol()
+	protocol.STREAMING = mode == "streaming"
+
+	baseline_rss = peak_rss_kb()
+	total_bytes = 0
+	start = time.time()
+	for i in range(iterations):
+		for key in keys:
+			fh = protocol.read_s3(BUCKET, key)
+			HSReplayDocument.from_xml_file(fh)
+			total_bytes += fh.tell()
+			fh.close()
+	elapsed = time.time() - start
+
+	replays = iterations * len(keys)
+	return {
+		"mode": mode,
+		"replays": replays,
+		"seconds": elapsed,
+		"replays_per_sec": replays / elapsed,
+		"mb_per_sec": total_bytes / elapsed / 1024 / 1024,
+		"baseline_rss_kb": baseline_rss,
+		"peak_rss_kb": peak_rss_kb(),
+	}
+
+
+def prepare(paths, root):
+	keys = []
+	os.makedirs(os.path.join(root, BUCKET))
+	for i, path in enumerate(paths):
+		key = "%i.xml.gz" % (i)
+		with open(path, "rb") as src:
+			with gzip.open(os.path.join(root, BUCKET, key), "wb") as dst:
+				shutil.copyfileobj(src, dst)
+		keys.append(key)
+	return keys
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("paths", nargs="*", help="Uncompressed HSReplay XML files")
+	p.add_argument("-n", "--iterations", type=int, default=3)
+	p.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+	p.add_argument("--root", help=argparse.SUPPRESS)
+	p.add_argument("--keys", help=argparse.SUPPRESS)
+	args = p.parse_args()
+
+	if args.mode:
+		# Child process: benchmark a single mode and report back as JSON
+		keys = args.keys.split(",")
+		print(json.dumps(run_mode(args.mode, args.root, keys, args.iterations)))
+		return
+
+	if not args.paths:
+		p.error("At least one replay is required")
+
+	root = tempfile.mkdtemp()
+	try:
+		keys = prepare(args.paths, root)
+		results = []
+		for mode in MODES:
+			out = subprocess.check_output([
+				sys.executable, __file__, "--mode", mode, "--root", root,
+				"--keys", ",".join(keys), "--iterations", str(args.iterations),
+			])
+			results.append(json.loads(out.decode("utf-8")))
+	finally:
+		shutil.rmtree(root)
+
+	print("%-10s %10s %10s %10s %14s" % ("mode", "replays/s", "MB/s", "seconds", "peak RSS (KB)"))
+	for result in results:
+		print("%-10s %10.2f %10.2f %10.2f %14i" % (
+			result["mode"], result["replays_per_sec"], result["mb_per_sec"],
+			result["seconds"], result["peak_rss_kb"]
+		))
+
+
+if __name__ == "__main__":
+	main()
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
+"""
+Usage:
+	$ PYTHONPATH=$PYTHONPATH:lib python brawl-reports/blackheart_brawl_discover_parser.py <KEYS_FILE> \
+		-o <OUTPUT_CSV> [-j <PROCESSES>] [--local-dir <DIRECTORY>]
+
+Rerun the same command to resume after a crash; see mapred/driver.py.
+"""
 
-import boto3
 import csv
-import gzip
 import sys
 from uuid import uuid4
 from io import StringIO
 from hearthstone.enums import ChoiceType, GameTag
 from hearthstone.hslog.watcher import LogWatcher
 
+from mapred import driver
+from mapred.prefilter import ReplayFilter
+
 
-S3 = boto3.client("s3")
 BUCKET = "hsreplaynet-replays"
+BLACKHEART_DISCOVER = "TB_013"
 
 
 class CustomWatcher(LogWatcher):
@@ -24,7 +32,7 @@ class CustomWatcher(LogWatcher):
 		if c.type == ChoiceType.MULLIGAN:
 			return
 		source = c.source.card_id
-		if source != "TB_013":
+		if source != BLACKHEART_DISCOVER:
 			return
 		if not c.choices[0].card_id:
 			# choice is not revealed - skip
@@ -76,28 +84,10 @@ def do_paths(args):
 			print(out)
 
 
-def do_s3(bucket, key):
-	obj = S3.get_object(Bucket=bucket, Key=key)
-	gzstream = obj["Body"].read()
-	ret = gzip.decompress(gzstream).decode("utf-8")
-	f = StringIO(ret)
-	return parse_file(f)
-
-
 def main():
-	# do_paths(sys.argv[1:])
-	with open(sys.argv[1], "r") as f:
-		lines = f.read().split()
-
-	logs = [line.strip() for line in lines if line]
-	total = len(logs)
-	for i, key in enumerate(logs):
-		print("%i / %i - %s" % (i + 1, total, key), file=sys.stderr)
-		if key:
-			try:
-				print(do_s3(BUCKET, key))
-			except Exception as e:
-				print("ERROR: Cannot parse %r: %r" % (key, e), file=sys.stderr)
+	# Replays the brawl card never appears in are skipped
+	prefilter = ReplayFilter([BLACKHEART_DISCOVER])
+	driver.main(parse_file, BUCKET, prefilter=prefilter, description="Blackheart brawl Discover picks")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Builds an inverted index of the cards played in a set of replays (see
+mapred.cardindex), so that later analyses only need to parse the games in
+which the cards they are interested in were played.
+
+$ PYTHONPATH=$PYTHONPATH:lib python contrib/build_card_index.py inputs.txt > index_output.txt
+$ PYTHONPATH=lib python -m mapred.cardindex build card_index/ index_output.txt
+$ PYTHONPATH=lib python -m mapred.cardindex query card_index/ --card OG_134 > inputs_yogg.txt
+
+The postings of a card are written in lines of at most POSTINGS_PER_LINE,
+since common cards (eg. The Coin) are played in most games.
+"""
+from base64 import b64encode
+
+from mapred import cardindex
+from mapred.protocols import BaseJob
+
+
+POSTINGS_PER_LINE = 64 * 1024
+
+
+class Job(BaseJob):
+	# Values reach the reducer sorted, so that duplicates are adjacent
+	SORT_VALUES = True
+
+	def mapper(self, line, obj):
+		if not obj:
+			return
+
+		replay = obj.get("replay")
+		if not replay:
+			return
+
+		try:
+			packet_tree = replay.to_packet_tree()[0]
+			exporter = packet_tree.export(cardindex.CardPlayExporter)
+		except Exception as e:
+			self.increment_counter("exceptions", e.__class__.__name__)
+			if self.INPUT_PROTOCOL.DEBUG:
+				raise
+			return
+
+		doc = cardindex.doc_id(line)
+		yield ("D", doc), line.decode("utf-8")
+		for card_id, controller, turn, block_type in exporter.plays:
+			yield ("P", card_id), (doc, controller, turn, block_type)
+
+		self.increment_counter("replays", "replays_processed")
+		self.increment_counter("index", "postings", len(exporter.plays))
+
+	def reducer(self, key, values):
+		kind, name = key
+		if kind == "D":
+			# Identical input lines are the same game
+			yield None, "D\t%i\t%s" % (name, next(values))
+			return
+
+		postings = []
+		previous = None
+		for value in values:
+			value = tuple(value)
+			if value == previous:
+				continue
+			previous = value
+			postings.append(value)
+			if len(postings) >= POSTINGS_PER_LINE:
+				yield None, self.format_postings(name, postings)
+				postings = []
+		if postings:
+			yield None, self.format_postings(name, postings)
+
+	def format_postings(self, card_id, postings):
+		data = b64encode(cardindex.encode_postings(postings)).decode("ascii")
+		return "P\t%s\t%i\t%s" % (card_id, len(postings), data)
+
+
+if __name__ == "__main__":
+	Job.run()
@@ -20,52 +20,18 @@ import csv
 from io import StringIO
 from uuid import uuid4
 
-from hearthstone.enums import BlockType, GameTag, PlayState, Zone
-from hearthstone.hslog.export import EntityTreeExporter, FriendlyPlayerExporter
+from hearthstone.enums import GameTag, PlayState
+from hearthstone.hslog.export import FriendlyPlayerExporter
 
+from mapred.events import DRAW, PLAY, EventExporter
 from mapred.protocols import BaseJob
 
 
-class DeepEntityTreeExporter(EntityTreeExporter):
-	def handle_create_game(self, packet):
-		super().handle_create_game(packet)
-		for player in self.game.players:
-			player.drawn_cards = []
-			player.played_cards = []
-
-	def handle_block(self, block):
-		if block.type == BlockType.PLAY:
-			entity = self.game.find_entity_by_id(block.entity)
-			controller = entity.controller
-			if controller:
-				turn = self.game.tags.get(GameTag.TURN, 0)
-				controller.played_cards.append((entity, turn))
-		super().handle_block(block)
-
-	def handle_drawn_card(self, entity_id):
-		entity = self.game.find_entity_by_id(entity_id)
-		if entity.zone == Zone.DECK:
-			controller = entity.controller
-			if controller:
-				turn = self.game.tags.get(GameTag.TURN, 0)
-				controller.drawn_cards.append((entity, turn))
-
-	def handle_show_entity(self, packet):
-		tags = dict(packet.tags)
-		if tags.get(GameTag.ZONE, 0) == Zone.HAND:
-			self.handle_drawn_card(packet.entity)
-		super().handle_show_entity(packet)
-
-	def handle_tag_change(self, packet):
-		if packet.tag == GameTag.ZONE and packet.value == Zone.HAND:
-			self.handle_drawn_card(packet.entity)
-		super().handle_tag_change(packet)
-
-
 def handle_replay(self, replay, metadata):
 	packet_tree = replay.to_packet_tree()[0]
-	exporter = packet_tree.export(DeepEntityTreeExporter)
+	exporter = packet_tree.export(EventExporter)
 	game = exporter.game
+	events = exporter.events
 
 	id = uuid4()
 	friendly_player = packet_tree.export(FriendlyPlayerExporter)
@@ -86,10 +52,10 @@ def handle_replay(self, replay, metadata):
 		fatigue = player.tags.get(GameTag.FATIGUE, 0)
 		hero_power_activations = player.tags.get(GameTag.NUM_TIMES_HERO_POWER_USED_THIS_GAME, 0)
 		drawn_cards = "|".join(
-			"%s:%i" % (entity.card_id or "", turn) for entity, turn in player.drawn_cards
+			"%s:%i" % (card_id, turn) for card_id, turn in events.cards(DRAW, player.player_id)
 		)
 		played_cards = "|".join(
-			"%s:%i" % (entity.card_id or "", turn) for entity, turn in player.played_cards
+			"%s:%i" % (card_id, turn) for card_id, turn in events.cards(PLAY, player.player_id)
 		)
 		row = [
 			id, "PLAYER%i" % (player.player_id), hero, state, fatigue, hero_power_activations,
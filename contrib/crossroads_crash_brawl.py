@@ -16,9 +16,11 @@ from io import StringIO
 
 from hearthstone.enums import ChoiceType, GameTag
 from hearthstone.hslog.watcher import LogWatcher
-from mrjob.job import MRJob
 
-from mapred.protocols import PowerlogS3Protocol
+from mapred.protocols import BaseJob, PowerlogS3Protocol
+
+
+PICK_SECOND_CLASS = "TB_ClassRandom_PickSecondClass"
 
 
 class CustomWatcher(LogWatcher):
@@ -35,7 +37,7 @@ class CustomWatcher(LogWatcher):
 			return
 
 		source = c.source.card_id
-		if source != "TB_ClassRandom_PickSecondClass":
+		if source != PICK_SECOND_CLASS:
 			# discard anything that isn't from the TB source
 			return
 
@@ -83,8 +85,10 @@ def parse_file(f):
 	return out.getvalue().strip().replace("\r", "")
 
 
-class Job(MRJob):
+class Job(BaseJob):
 	INPUT_PROTOCOL = PowerlogS3Protocol
+	PREFILTER_CARD_IDS = (PICK_SECOND_CLASS, )
+	PREFILTER_SCENARIO_ID = 1812
 
 	def mapper(self, line, log_fp):
 		if not log_fp:
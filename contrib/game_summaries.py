@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Produces one CSV row per game with the players' heroes, their final states
+and the length of the game, without parsing the full replays.
+
+Input: Any sample of games
+Format: HSReplay XML
+Output: CSV, one row per game.
+uuid,scenario_id,first_player,hero1,hero2,final_state1,final_state2,turns
+"""
+
+import csv
+from io import StringIO
+from uuid import uuid4
+
+from mapred.protocols import BaseJob, SummaryS3Protocol
+
+
+def state_name(playstate):
+	# Unknown states are kept as ints, missing ones as None
+	return getattr(playstate, "name", playstate if playstate is not None else "")
+
+
+def handle_replay(self, replay, metadata):
+	player1, player2 = replay.players
+	first_player = replay.first_player.player_id if replay.first_player else ""
+
+	out = StringIO()
+	writer = csv.writer(out)
+	writer.writerow([
+		uuid4(), replay.scenario_id, first_player, player1.hero, player2.hero,
+		state_name(player1.playstate), state_name(player2.playstate), replay.turns
+	])
+
+	return out.getvalue().strip().replace("\r", "")
+
+
+class Job(BaseJob):
+	INPUT_PROTOCOL = SummaryS3Protocol
+	SUMMARY_FIELDS = ("players", "heroes", "first_player", "playstates", "turns")
+	handler_function = handle_replay
+
+
+if __name__ == "__main__":
+	Job.run()
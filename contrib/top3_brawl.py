@@ -9,10 +9,10 @@ Output: CSV, one row per game - Each line looks like the following:
 
 deck1 and deck2 are pipe-separated (`|`) unique sets of 0 or more card IDs.
 The card IDs are found by looking at the final list of entities in the game and
-finding all the revealed IDs, then filtering for all those without a CREATOR.
-For performance reasons, the COLLECTIBLE value is not checked as it requires
-access to the CardXML database - that means you may find more than three values
-in the final set. You should do a second pass on it, filtering for COLLECTIBLE.
+finding all the revealed IDs, then filtering for all those without a CREATOR
+and keeping the COLLECTIBLE ones only (with the card table of mapred.cards).
+Card IDs missing from the table, such as new cards, are kept and counted in
+cards/unknown_ids.
 """
 
 import csv
@@ -20,13 +20,11 @@ from io import StringIO
 
 from hearthstone.enums import GameTag
 from hearthstone.hslog.watcher import LogWatcher
-from mrjob.job import MRJob
-from mrjob.protocol import RawValueProtocol
 
-from mapred.protocols import PowerlogS3Protocol
+from mapred.protocols import BaseJob, PowerlogS3Protocol
 
 
-def parse_file(f):
+def parse_file(f, card_table):
 	watcher = LogWatcher()
 	watcher.read(f)
 
@@ -48,10 +46,15 @@ def parse_file(f):
 		1: set(),
 		2: set(),
 	}
+	unknown = set()
 
 	for player in game.players:
 		for entity in player.initial_deck:
-			if entity.card_id:
+			if not entity.card_id:
+				continue
+			if entity.card_id not in card_table:
+				unknown.add(entity.card_id)
+			if card_table.is_collectible(entity.card_id, unknown=True):
 				decks[player.player_id].add(entity.card_id)
 
 	deck1 = "|".join(sorted(decks[1]))
@@ -66,23 +69,27 @@ def parse_file(f):
 	]
 	writer.writerow(row)
 
-	return out.getvalue().strip().replace("\r", "")
+	return out.getvalue().strip().replace("\r", ""), len(unknown)
 
 
-class Job(MRJob):
+class Job(BaseJob):
 	INPUT_PROTOCOL = PowerlogS3Protocol
-	OUTPUT_PROTOCOL = RawValueProtocol
+	PREFILTER_SCENARIO_ID = 1739
 
 	def mapper(self, line, log_fp):
 		if not log_fp:
 			return
 
+		# Outside of the try block: a missing or broken table fails the job
+		card_table = self.get_card_table()
 		try:
-			value = parse_file(log_fp)
+			value, unknown = parse_file(log_fp, card_table)
 		except Exception as e:
 			return
 
 		self.increment_counter("replays", "replays_processed")
+		if unknown:
+			self.increment_counter("cards", "unknown_ids", unknown)
 		yield None, value
 
 
@@ -21,10 +21,8 @@ from uuid import uuid4
 
 from hearthstone.enums import BlockType, GameTag, PowerType
 from hearthstone.hslog.watcher import LogWatcher
-from mrjob.job import MRJob
-from mrjob.protocol import RawValueProtocol
 
-from mapred.protocols import PowerlogS3Protocol
+from mapred.protocols import BaseJob, PowerlogS3Protocol
 
 TUSKARR_TOTEMIC = "AT_046"
 
@@ -102,9 +100,9 @@ def parse_file(f):
 	return out.getvalue().strip().replace("\r", "")
 
 
-class Job(MRJob):
+class Job(BaseJob):
 	INPUT_PROTOCOL = PowerlogS3Protocol
-	OUTPUT_PROTOCOL = RawValueProtocol
+	PREFILTER_CARD_IDS = (TUSKARR_TOTEMIC, )
 
 	def mapper(self, line, log_fp):
 		if not log_fp:
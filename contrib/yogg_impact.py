@@ -7,12 +7,10 @@ Input: A sample of games in which Yogg-Saron may have been played (eg. in deck)
 Format: Power.log
 """
 
-from collections import defaultdict
-
 from hearthstone.enums import GameTag, BlockType, PlayState
 from hearthstone.hslog.watcher import LogWatcher
-from mrjob.job import MRJob
 
+from mapred.aggregate import AggregateJob
 from mapred.protocols import PowerlogS3Protocol
 
 
@@ -31,8 +29,10 @@ class YoggEventWatcher(LogWatcher):
 				self.yogg_events.append((player, turn))
 
 
-class Job(MRJob):
+class Job(AggregateJob):
 	INPUT_PROTOCOL = PowerlogS3Protocol
+	PREFILTER_CARD_IDS = (YoggEventWatcher.YOGG_SARON, )
+	COLUMNS = ["TURNS_SINCE_YOGG_PLAYED", "YOGG_CONTROLLER_WON", "YOGG_CONTROLLER_LOST"]
 
 	def mapper(self, line, log_fp):
 		if not log_fp:
@@ -61,48 +61,9 @@ class Job(MRJob):
 			yogg_controller_won = player_id_that_played_yogg == winning_player_id
 
 			if yogg_controller_won:
-				line = "%s,%s,1" % (num_turns_made_after_yogg, "YOGG_CONTROLLER_WON")
+				self.aggregates.add((num_turns_made_after_yogg, ), 1, 0)
 			else:
-				line = "%s,%s,1" % (num_turns_made_after_yogg, "YOGG_CONTROLLER_LOST")
-
-			yield None, line
-
-	def combiner_init(self):
-		self.DATA_SET = defaultdict(lambda: defaultdict(int))
-
-	def combiner(self, key, yogg_events):
-		for event_str in yogg_events:
-			num_turns, outcome, count = event_str.split(",")
-			self.DATA_SET[num_turns][outcome] += int(count)
-
-	def combiner_final(self):
-		for turn in sorted(self.DATA_SET.keys(), key=lambda k: int(k)):
-			data = self.DATA_SET[turn]
-			wins = [str(turn), "YOGG_CONTROLLER_WON", str(data["YOGG_CONTROLLER_WON"])]
-			losses = [str(turn), "YOGG_CONTROLLER_LOST", str(data["YOGG_CONTROLLER_LOST"])]
-
-			yield None, ",".join(wins)
-			yield None, ",".join(losses)
-
-	def reducer_init(self):
-		self.DATA_SET = defaultdict(lambda: defaultdict(int))
-
-	def reducer(self, key, yogg_events):
-		for event_str in yogg_events:
-			num_turns, outcome, count = event_str.split(",")
-			self.DATA_SET[num_turns][outcome] += int(count)
-
-	def reducer_final(self):
-		COLUMNS = ["TURNS_SINCE_YOGG_PLAYED", "YOGG_CONTROLLER_WON", "YOGG_CONTROLLER_LOST"]
-		yield None, ",".join(COLUMNS)
-
-		for num_turns in sorted(self.DATA_SET.keys(), key=lambda k: int(k)):
-			row_data = self.DATA_SET[num_turns]
-			wins = row_data["YOGG_CONTROLLER_WON"]
-			losses = row_data["YOGG_CONTROLLER_LOST"]
-
-			row_result = [str(num_turns), str(wins), str(losses)]
-			yield None, ",".join(row_result)
+				self.aggregates.add((num_turns_made_after_yogg, ), 0, 1)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,47 @@
+#!/usr/bin/env python
+"""
+Converts the CSV output of a job to JSON, streaming.
+
+Usage:
+	$ python converters/json_converter.py part-* --key card_name [--values DRUID,MAGE] \\
+		[--layout records|arrays|columns] [--strings COLUMNS] [--schema-rows N] [-o output.json]
+
+The original `json_converter.py FILE KEY` form still works and writes
+`output.json`.
+
+The input is read row by row from one or more files (part files of the same
+job, optionally gzipped); the header of the first file is used for all of
+them, and repeated headers are skipped. The key is always written as a
+string. The types of the value columns are inferred once from the first
+--schema-rows rows: integers, floats and strings; only plain decimal numbers
+(no whitespace, underscores, "nan" or "inf") are numeric, and empty values
+are written as null. A later value which doesn't match its column's type is an error rather
+than a column of mixed types: force the column to strings with --strings, or
+infer types from every row with --schema-rows 0, which reads the inputs
+twice (so not from stdin). Output is written in chunks, so memory use doesn't
+depend on the size of the input. Layouts:
+
+- records: `[{"key": ..., "druid": 1, ...}, ...]`, the original format
+- arrays: `[["key", "druid", ...], [..., 1, ...], ...]`, header first
+- columns: `{"key": [...], "druid": [...], ...}`, spooled to temporary files
+  one column at a time
+
+Value column names are lowercased. By default, the values are the nine class
+columns if the input has them, and every other column otherwise.
+"""
+
+import argparse
 import csv
-import sys
+import gzip
 import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+# The C string encoder of json.dumps()
+from json.encoder import encode_basestring_ascii
 
 CLASSES = [
 	"DRUID", "HUNTER", "MAGE",
@@ -8,22 +49,326 @@ CLASSES = [
 	"SHAMAN", "WARLOCK", "WARRIOR"
 ]
 
-file = sys.argv[1]
-key = sys.argv[2] if len(sys.argv) > 2 else "key"
-output = []
+LAYOUTS = ("records", "arrays", "columns")
+CHUNK_SIZE = 10000
+# Number of rows the column types are inferred from
+SCHEMA_ROWS = 1000
+# int() and float() also accept whitespace, underscores and "nan"/"inf"
+INT_RE = re.compile(r"-?[0-9]+\Z")
+FLOAT_RE = re.compile(r"-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\Z")
+
+
+def open_input(path):
+	if path == "-":
+		return sys.stdin
+	if path.endswith(".gz"):
+		return gzip.open(path, "rt", encoding="utf-8", newline="")
+	return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_rows(paths, header=None):
+	"""
+	Yield the header, then every row of `paths`. Without a `header`, the
+	first row of the first file is used, and skipped in the other files.
+	"""
+	if header is not None:
+		yield header
+	for path in paths:
+		f = open_input(path)
+		try:
+			for row in csv.reader(f):
+				if not row:
+					continue
+				if header is None:
+					header = row
+					yield header
+					continue
+				if row == header:
+					continue
+				yield row
+		finally:
+			if f is not sys.stdin:
+				f.close()
+	if header is None:
+		raise ValueError("No rows in %s" % (", ".join(paths)))
+
+
+def to_int(value):
+	if not INT_RE.match(value):
+		raise ValueError("Not an integer: %r" % (value))
+	return int(value)
+
+
+def to_float(value):
+	if not FLOAT_RE.match(value):
+		raise ValueError("Not a number: %r" % (value))
+	ret = float(value)
+	if math.isinf(ret) or math.isnan(ret):
+		# Not valid JSON
+		raise ValueError("Not a finite number: %r" % (value))
+	return ret
+
+
+def is_type(value, cast):
+	try:
+		cast(value)
+		return True
+	except ValueError:
+		return False
+
+
+class TypeInference:
+	"""
+	Narrows the type (int, float or str) of each column down as rows are
+	added, ignoring empty values.
+	"""
+	def __init__(self, count):
+		self.types = [None] * count
+
+	def add(self, row):
+		types = self.types
+		for i, value in enumerate(row[:len(types)]):
+			if value == "" or types[i] is str:
+				continue
+			if types[i] in (None, int) and is_type(value, to_int):
+				types[i] = int
+			elif types[i] is not str and is_type(value, to_float):
+				types[i] = float
+			else:
+				types[i] = str
+
+	def get_types(self):
+		return [str if t is None else t for t in self.types]
+
+
+def infer_types(rows, count):
+	"""
+	Return the type (int, float or str) of each of the `count` columns of
+	`rows`, ignoring empty values.
+	"""
+	inference = TypeInference(count)
+	for row in rows:
+		inference.add(row)
+	return inference.get_types()
+
+
+def encode_int(value):
+	if value == "":
+		return "null"
+	return str(to_int(value))
+
+
+def encode_float(value):
+	if value == "":
+		return "null"
+	return repr(to_float(value))
+
+
+ENCODERS = {int: encode_int, float: encode_float, str: encode_basestring_ascii}
+
+
+class Schema:
+	def __init__(self, header, key, values, types, schema_rows=SCHEMA_ROWS):
+		self.names = ["key"] + [header[i].lower() for i in values]
+		self.indexes = [key] + values
+		# The key is always a string, as in the original format
+		self.columns = [(key, encode_basestring_ascii)] + [(i, ENCODERS[types[i]]) for i in values]
+		self.last_index = max(self.indexes)
+		self.header = header
+		self.types = types
+		self.schema_rows = schema_rows
+
+	def encode(self, row):
+		"""
+		Return the JSON encoded values of a row, key first.
+		"""
+		if len(row) <= self.last_index:
+			row = row + [""] * (self.last_index + 1 - len(row))
+		try:
+			return [encode(row[index]) for index, encode in self.columns]
+		except ValueError:
+			self.raise_mismatch(row)
+
+	def raise_mismatch(self, row):
+		for index, encode in self.columns:
+			try:
+				encode(row[index])
+			except ValueError:
+				name = self.header[index]
+				raise ValueError(
+					"Value %r of column %r is not of the type %s inferred from the first %i rows; "
+					"pass --strings %s or --schema-rows 0" % (
+						row[index], name, self.types[index].__name__, self.schema_rows, name,
+					)
+				)
+		raise ValueError("Can't encode %r" % (row))
+
+
+def get_schema(header, sample, key, values=None, strings=(), schema_rows=SCHEMA_ROWS):
+	if key not in header:
+		raise ValueError("No %r column in %s" % (key, ", ".join(header)))
+	if values:
+		missing = [column for column in values if column not in header]
+		if missing:
+			raise ValueError("No %s column in %s" % (", ".join(missing), ", ".join(header)))
+	elif all(column in header for column in CLASSES):
+		values = CLASSES
+	else:
+		values = [column for column in header if column != key and column]
+	missing = [column for column in strings if column not in header]
+	if missing:
+		raise ValueError("No %s column in %s" % (", ".join(missing), ", ".join(header)))
+	if isinstance(sample, TypeInference):
+		types = sample.get_types()
+	else:
+		types = infer_types(sample, len(header))
+	types = [str if column in strings else t for column, t in zip(header, types)]
+	return Schema(
+		header, header.index(key), [header.index(column) for column in values], types, schema_rows
+	)
+
+
+def write_records(schema, rows, out):
+	names = [json.dumps(name) + ": " for name in schema.names]
+	out.write("[")
+	chunk = []
+	first = True
+	for row in rows:
+		values = schema.encode(row)
+		chunk.append("{" + ", ".join(name + value for name, value in zip(names, values)) + "}")
+		if len(chunk) >= CHUNK_SIZE:
+			out.write(("" if first else ", ") + ", ".join(chunk))
+			first, chunk = False, []
+	if chunk:
+		out.write(("" if first else ", ") + ", ".join(chunk))
+	out.write("]")
+
+
+def write_arrays(schema, rows, out):
+	out.write("[" + json.dumps(schema.names))
+	chunk = []
+	for row in rows:
+		chunk.append("[" + ", ".join(schema.encode(row)) + "]")
+		if len(chunk) >= CHUNK_SIZE:
+			out.write(", " + ", ".join(chunk))
+			chunk = []
+	if chunk:
+		out.write(", " + ", ".join(chunk))
+	out.write("]")
+
+
+def write_columns(schema, rows, out):
+	"""
+	Write the columnar layout, spooling every column to a temporary file so
+	that the rows are only read once.
+	"""
+	spool_dir = tempfile.mkdtemp()
+	try:
+		spools = [
+			open(os.path.join(spool_dir, str(i)), "w+", encoding="utf-8")
+			for i in range(len(schema.names))
+		]
+		chunks = [[] for spool in spools]
+		first = True
+
+		def flush():
+			for spool, chunk in zip(spools, chunks):
+				spool.write(("" if first else ", ") + ", ".join(chunk))
+				del chunk[:]
+
+		for i, row in enumerate(rows):
+			for chunk, value in zip(chunks, schema.encode(row)):
+				chunk.append(value)
+			if i % CHUNK_SIZE == CHUNK_SIZE - 1:
+				flush()
+				first = False
+		if chunks[0]:
+			flush()
+
+		out.write("{")
+		for i, (name, spool) in enumerate(zip(schema.names, spools)):
+			out.write("%s%s: [" % (", " if i else "", json.dumps(name)))
+			spool.seek(0)
+			shutil.copyfileobj(spool, out)
+			spool.close()
+			out.write("]")
+		out.write("}")
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def convert(
+	paths, out, key="key", values=None, layout="records", header=None, strings=(),
+	schema_rows=SCHEMA_ROWS,
+):
+	"""
+	Convert the CSV rows of `paths` to JSON in `layout`, written to `out`.
+	Types are inferred from the first `schema_rows` rows, or every row if 0.
+	"""
+	rows = read_rows(paths, header)
+	given_header = header
+	header = next(rows)
+	sample = []
+	if schema_rows:
+		for row in rows:
+			sample.append(row)
+			if len(sample) >= schema_rows:
+				break
+		schema = get_schema(header, sample, key, values, strings, schema_rows)
+	else:
+		if "-" in paths:
+			raise ValueError("--schema-rows 0 reads the inputs twice, which stdin can't be")
+		inference = TypeInference(len(header))
+		for row in rows:
+			inference.add(row)
+		schema = get_schema(header, inference, key, values, strings, schema_rows)
+		rows = read_rows(paths, given_header)
+		next(rows)
+	writer = {"records": write_records, "arrays": write_arrays, "columns": write_columns}[layout]
+
+	def all_rows():
+		for row in sample:
+			yield row
+		for row in rows:
+			yield row
+
+	writer(schema, all_rows(), out)
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("inputs", nargs="+", help="CSV files ('-' for stdin)")
+	p.add_argument("-k", "--key", help="Column written as \"key\" (default: key)")
+	p.add_argument("--values", help="Comma-separated value columns (default: see above)")
+	p.add_argument("--columns", help="Comma-separated header, if the inputs have none")
+	p.add_argument("--strings", help="Comma-separated value columns to always write as strings")
+	p.add_argument(
+		"--schema-rows", type=int, default=SCHEMA_ROWS,
+		help="Number of rows to infer types from, 0 for all (default: %i)" % (SCHEMA_ROWS)
+	)
+	p.add_argument("--layout", choices=LAYOUTS, default="records")
+	p.add_argument("-o", "--output", default="output.json", help="Output file ('-' for stdout)")
+	args = p.parse_args()
 
+	inputs = args.inputs
+	key = args.key
+	if key is None and len(inputs) == 2 and not os.path.exists(inputs[1]):
+		# The original `json_converter.py FILE KEY` form
+		inputs, key = inputs[:1], inputs[1]
 
-def generate(row):
-	data = {}
-	data["key"] = row[key]
-	for c in CLASSES:
-		data[c.lower()] = int(row[c])
-	return data
+	values = args.values.split(",") if args.values else None
+	header = args.columns.split(",") if args.columns else None
+	strings = args.strings.split(",") if args.strings else ()
+	kwargs = dict(strings=strings, schema_rows=args.schema_rows)
+	try:
+		if args.output == "-":
+			convert(inputs, sys.stdout, key or "key", values, args.layout, header, **kwargs)
+		else:
+			with open(args.output, "w", encoding="utf-8") as out:
+				convert(inputs, out, key or "key", values, args.layout, header, **kwargs)
+	except ValueError as e:
+		p.exit(1, "%s: error: %s\n" % (p.prog, e))
 
-with open(file) as f:
-	reader = csv.DictReader(f)
-	for row in reader:
-		output.append(generate(row))
 
-with open("output.json", "w", encoding="utf-8") as f:
-	f.write(json.dumps(output))
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Converts HSReplay XML replays to packet tree files (see mapred.packetstore).
+
+Each replay is parsed once and its packet trees are written next to the
+--output-location prefix, keeping the original key with a .hspt extension.
+The job outputs one input line per converted replay, so its output can be
+used directly as the inputs file of jobs using PacketTreeS3Protocol:
+
+$ PYTHONPATH=$PYTHONPATH:lib python export_packet_trees.py --output-location local:trees/ inputs.txt > tree_inputs.txt
+
+Then, in the job:
+
+	class Job(BaseJob):
+		INPUT_PROTOCOL = PacketTreeS3Protocol
+"""
+import os
+from io import BytesIO
+
+from mapred import packetstore
+from mapred.protocols import BaseJob
+
+
+class Job(BaseJob):
+	def configure_args(self):
+		super().configure_args()
+		self.add_passthru_arg(
+			"--output-location", default="local:trees/",
+			help="<STORAGE_LOCATION>:<PREFIX> under which to write the packet tree files"
+		)
+
+	def mapper_init(self):
+		self.protocol = self.input_protocol()
+		self.output_bucket, sep, self.output_prefix = self.options.output_location.partition(":")
+
+	def mapper(self, line, obj):
+		if not obj:
+			return
+
+		replay = obj.get("replay")
+		if not replay:
+			return
+
+		bucket, key, metadata = self.protocol.read_line_protocol(line)
+		out_key = self.output_prefix + os.path.splitext(key)[0] + packetstore.EXTENSION
+
+		out = BytesIO()
+		try:
+			packetstore.dump(replay.to_packet_tree(), out)
+			self.protocol.write_object(self.output_bucket, out_key, out.getvalue())
+		except Exception as e:
+			self.increment_counter("exceptions", e.__class__.__name__)
+			if self.INPUT_PROTOCOL.DEBUG:
+				raise
+			return
+
+		self.increment_counter("replays", "replays_processed")
+		self.increment_counter("packet_trees", "bytes_written", len(out.getvalue()))
+		yield None, self.protocol.format_line_protocol(self.output_bucket, out_key, metadata)
+
+
+if __name__ == "__main__":
+	Job.run()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Finds the duplicate uploads of the games in a set of replays (see
+mapred.dedupe) and outputs their input lines, keeping the upload of every
+game in which the most cards are revealed.
+
+$ PYTHONPATH=$PYTHONPATH:lib python find_duplicates.py inputs.txt > duplicates.txt
+$ PYTHONPATH=lib python -m mapred.dedupe build duplicates.txt dedupe.bin
+$ python my_job.py --dedupe dedupe.bin inputs.txt
+
+For load_redshift.py, match uploads by global game ID and build an exact
+filter instead:
+
+$ PYTHONPATH=$PYTHONPATH:lib python find_duplicates.py --key game_id inputs.txt > duplicates.txt
+$ PYTHONPATH=lib python -m mapred.dedupe build --exact duplicates.txt dedupe.bin
+"""
+from mapred import dedupe
+from mapred.protocols import BaseJob, FingerprintS3Protocol
+
+
+class Job(BaseJob):
+	INPUT_PROTOCOL = FingerprintS3Protocol
+
+	def configure_args(self):
+		super(Job, self).configure_args()
+		self.add_passthru_arg(
+			"--key", choices=("fingerprint", "game_id"), default="fingerprint",
+			help="Match uploads by game fingerprint, or exactly by the game_id metadata field"
+		)
+		self.add_passthru_arg(
+			"--powerlog", action="store_true", help="The inputs are Power.log files"
+		)
+
+	def input_protocol(self):
+		protocol = super(Job, self).input_protocol()
+		protocol.xml = not self.options.powerlog
+		return protocol
+
+	def mapper(self, line, obj):
+		if not obj:
+			return
+
+		scan = obj["scan"]
+		if self.options.key == "game_id":
+			key = obj["metadata"].get("game_id")
+		else:
+			key = scan.fingerprint
+		self.increment_counter("replays", "replays_processed")
+		if key is None:
+			# Can't be matched, so always kept
+			self.increment_counter("dedupe", "unmatched")
+			return
+
+		yield key, (line.decode("utf-8"), scan.revealed, scan.size)
+
+	def reducer(self, key, values):
+		uploads = dedupe.pick(values)
+		self.increment_counter("dedupe", "games")
+		for line, revealed, size in uploads[1:]:
+			self.increment_counter("dedupe", "duplicates")
+			yield None, line
+
+
+if __name__ == "__main__":
+	Job.run()
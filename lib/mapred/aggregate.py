@@ -0,0 +1,160 @@
+"""
+Typed aggregation of counters, grouped sums and histograms keyed by tuples.
+
+An AggregateJob's mapper adds to `self.aggregates` instead of yielding rows:
+
+	class Job(AggregateJob):
+		COLUMNS = ["TURNS", "WON", "LOST"]
+
+		def mapper(self, line, obj):
+			...
+			self.aggregates.add((turns, ), 1, 0)
+
+Values are vectors of integers which are summed per key, first in the mapper
+itself, then by the combiner and the reducer. Keys travel through the shuffle
+as compact JSON and values as comma separated decimals (shorter than any
+fixed-width encoding for the small counts most jobs emit), and rows are only
+formatted as CSV by the reducers. Hadoop hashes
+whole keys to reducers, so the work is spread across all of them; the header
+row is only written by the first partition.
+"""
+
+import csv
+import json
+from io import StringIO
+
+from mrjob.compat import jobconf_from_env
+from mrjob.protocol import RawValueProtocol
+
+from .protocols import BaseJob
+
+
+def sum_values(a, b):
+	if len(a) < len(b):
+		a, b = b, a
+	return [x + y for x, y in zip(a, b)] + list(a[len(b):])
+
+
+class Aggregates:
+	def __init__(self):
+		self.data = {}
+
+	def __len__(self):
+		return len(self.data)
+
+	def add(self, key, *values):
+		"""
+		Add the vector `values` to the sums of `key`, a tuple of JSON
+		serializable values. Rows are sorted by key, so the values at each
+		position of the keys should be of the same type.
+		"""
+		current = self.data.get(key)
+		self.data[key] = list(values) if current is None else sum_values(current, values)
+
+	def count(self, key, amount=1):
+		self.add(key, amount)
+
+	def histogram(self, key, value, bucket_size=1):
+		"""
+		Count `value` in the bucket of size `bucket_size` it falls into. The
+		lower bound of the bucket is appended to `key`.
+		"""
+		self.add(tuple(key) + (value - value % bucket_size, ), 1)
+
+	def merge(self, key, values):
+		self.add(key, *values)
+
+	def items(self):
+		return self.data.items()
+
+	def clear(self):
+		self.data.clear()
+
+
+class AggregateProtocol:
+	"""
+	Internal protocol for (key tuple, integer vector) pairs.
+	"""
+	def read(self, line):
+		key, sep, values = line.partition(b"\t")
+		values = [int(value) for value in values.split(b",")] if values else []
+		return tuple(json.loads(key.decode("utf-8"))), values
+
+	def write(self, key, values):
+		key = json.dumps(list(key), separators=(",", ":")).encode("utf-8")
+		return key + b"\t" + ",".join("%i" % (value) for value in values).encode("ascii")
+
+
+class AggregateJob(BaseJob):
+	INTERNAL_PROTOCOL = AggregateProtocol
+	OUTPUT_PROTOCOL = RawValueProtocol
+	# The CSV header: the key columns followed by the value columns
+	COLUMNS = ()
+
+	def configure_args(self):
+		super().configure_args()
+		self.add_passthru_arg(
+			"--emit-partials", action="store_true",
+			help="Output the aggregates in their internal format, to be merged with other runs "
+			"(see mapred.incremental)"
+		)
+
+	def mapper_init(self):
+		self.aggregates = Aggregates()
+
+	def mapper(self, line, obj):
+		# Handler functions add to self.aggregates; their return value is unused.
+		for key, value in super().mapper(line, obj):
+			pass
+
+	def mapper_final(self):
+		for key, values in self.aggregates.items():
+			yield key, values
+		self.aggregates.clear()
+
+	def combiner(self, key, values):
+		total = []
+		for value in values:
+			total = sum_values(total, value)
+		yield key, total
+
+	def reducer_init(self):
+		self.aggregates = Aggregates()
+
+	def reducer(self, key, values):
+		for value in values:
+			self.aggregates.merge(key, value)
+
+	def format_row(self, key, values):
+		"""
+		Return the CSV columns of an aggregated key.
+		"""
+		return list(key) + list(values)
+
+	def format_csv(self, items, header=True):
+		"""
+		Yield the CSV lines of the aggregated (key, values) `items`, sorted by
+		key and preceded by the COLUMNS header if `header` is set.
+		"""
+		out = StringIO()
+		writer = csv.writer(out, lineterminator="")
+		if self.COLUMNS and header:
+			writer.writerow(self.COLUMNS)
+			yield out.getvalue()
+
+		for key, values in sorted(items):
+			out.seek(0)
+			out.truncate()
+			writer.writerow(self.format_row(key, values))
+			yield out.getvalue()
+
+	def reducer_final(self):
+		if self.options.emit_partials:
+			protocol = AggregateProtocol()
+			for key, values in self.aggregates.items():
+				yield None, protocol.write(key, values).decode("utf-8")
+			return
+
+		header = jobconf_from_env("mapreduce.task.partition", "0") == "0"
+		for line in self.format_csv(self.aggregates.items(), header):
+			yield None, line
@@ -0,0 +1,272 @@
+"""
+Bulk export of records to gzipped part files for Redshift COPY.
+
+A BulkExporter has the same publish(stream, data) interface as the
+FirehosePublisher, but instead of sending records to Firehose it appends them
+to gzipped part files, one directory per stream, under a location such as
+`local:exports/` or `<bucket>:<prefix>/`. Every writer also writes a manifest
+of the parts it produced. Once the job is done, the per-writer manifests of
+each stream are merged into one COPY manifest and loaded with:
+
+	$ python -m mapred.bulkload <LOCATION> --iam-role <ROLE> --database-url <URL>
+
+Without --database-url, the COPY statements are only printed.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import tempfile
+from uuid import uuid4
+
+from . import s3 as aws
+
+
+MANIFEST_DIR = "manifests"
+MANIFEST_EXTENSION = ".manifest"
+
+
+def parse_location(location):
+	bucket, sep, prefix = location.partition(":")
+	return bucket, prefix
+
+
+class Storage:
+	"""
+	Minimal file storage over either the local filesystem or an S3 bucket.
+	"""
+	def __init__(self, location, s3=None):
+		self.bucket, self.prefix = parse_location(location)
+		# The prefix is a directory, so that path() never extends a name
+		if self.prefix and not self.prefix.endswith("/"):
+			self.prefix += "/"
+		self.s3 = s3
+		if self.bucket != "local" and self.s3 is None:
+			self.s3 = aws.get_client("s3")
+
+	def path(self, *parts):
+		return self.prefix + "/".join(parts)
+
+	def url(self, key):
+		if self.bucket == "local":
+			return os.path.abspath(key)
+		return "s3://%s/%s" % (self.bucket, key)
+
+	def mkstemp(self, key, suffix=""):
+		"""
+		Create a temporary file to write `key` to before put_file(), returning
+		its (fd, path). Local ones are created next to `key`, so that moving
+		them there is a rename within one filesystem.
+		"""
+		if self.bucket != "local":
+			return tempfile.mkstemp(suffix=suffix)
+		directory = os.path.dirname(key) or "."
+		os.makedirs(directory, exist_ok=True)
+		return tempfile.mkstemp(suffix=suffix, prefix=".tmp-", dir=directory)
+
+	def put_file(self, local_path, key):
+		if self.bucket == "local":
+			os.makedirs(os.path.dirname(key) or ".", exist_ok=True)
+			os.replace(local_path, key)
+		else:
+			self.s3.upload_file(local_path, self.bucket, key)
+			os.remove(local_path)
+
+	def put(self, key, data):
+		fd, tmp_path = self.mkstemp(key)
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		self.put_file(tmp_path, key)
+
+	def get(self, key):
+		if self.bucket == "local":
+			with open(key, "rb") as f:
+				return f.read()
+		return self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+	def list(self, prefix):
+		if self.bucket == "local":
+			if not os.path.isdir(prefix):
+				return []
+			return sorted(os.path.join(prefix, name) for name in os.listdir(prefix))
+
+		ret = []
+		paginator = self.s3.get_paginator("list_objects_v2")
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+			ret += [obj["Key"] for obj in page.get("Contents", [])]
+		return sorted(ret)
+
+	def list_dirs(self, prefix):
+		"""
+		Return the names of the directories directly under `prefix`, which
+		ends with a slash. On S3, only those are listed, not every key.
+		"""
+		if self.bucket == "local":
+			if not os.path.isdir(prefix or "."):
+				return []
+			return sorted(
+				name for name in os.listdir(prefix or ".") if os.path.isdir(os.path.join(prefix, name))
+			)
+
+		ret = []
+		paginator = self.s3.get_paginator("list_objects_v2")
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter="/"):
+			ret += [item["Prefix"][len(prefix):].rstrip("/") for item in page.get("CommonPrefixes", [])]
+		return sorted(ret)
+
+
+class PartFileWriter:
+	"""
+	Appends newline-terminated records of one stream to gzipped part files,
+	starting a new part every `max_bytes` of uncompressed data.
+	"""
+	def __init__(self, storage, stream, writer_id, max_bytes):
+		self.storage = storage
+		self.stream = stream
+		self.writer_id = writer_id
+		self.max_bytes = max_bytes
+		self.entries = []
+		self.file = None
+		self.key = None
+		self.tmp_path = None
+		self.part_bytes = 0
+		self.records = 0
+		self.bytes = 0
+
+	def write(self, data):
+		if not data.endswith(b"\n"):
+			data += b"\n"
+		if self.file is None:
+			self.key = self.storage.path(
+				self.stream, "part-%s-%05i.gz" % (self.writer_id, len(self.entries))
+			)
+			fd, self.tmp_path = self.storage.mkstemp(self.key, suffix=".gz")
+			self.file = gzip.GzipFile(fileobj=os.fdopen(fd, "wb"), mode="wb")
+			self.part_bytes = 0
+
+		self.file.write(data)
+		self.part_bytes += len(data)
+		self.records += 1
+		self.bytes += len(data)
+		if self.part_bytes >= self.max_bytes:
+			self.close_part()
+
+	def close_part(self):
+		if self.file is None:
+			return
+
+		fileobj = self.file.fileobj
+		self.file.close()
+		fileobj.close()
+		size = os.path.getsize(self.tmp_path)
+		self.storage.put_file(self.tmp_path, self.key)
+		self.entries.append({
+			"url": self.storage.url(self.key),
+			"mandatory": True,
+			"meta": {"content_length": size},
+		})
+		self.file = None
+
+	def close(self):
+		self.close_part()
+		if self.entries:
+			key = self.storage.path(
+				self.stream, MANIFEST_DIR, self.writer_id + MANIFEST_EXTENSION
+			)
+			self.storage.put(key, json.dumps({"entries": self.entries}).encode("utf-8"))
+
+
+class BulkExporter:
+	MAX_PART_BYTES = 256 * 1024 * 1024
+
+	def __init__(self, location, s3=None, max_part_bytes=MAX_PART_BYTES):
+		self.storage = Storage(location, s3)
+		self.writer_id = uuid4().hex
+		self.max_part_bytes = max_part_bytes
+		self.writers = {}
+
+	def publish(self, stream, data):
+		writer = self.writers.get(stream)
+		if writer is None:
+			writer = PartFileWriter(self.storage, stream, self.writer_id, self.max_part_bytes)
+			self.writers[stream] = writer
+		writer.write(data)
+
+	def close(self):
+		for writer in self.writers.values():
+			writer.close()
+
+	def report(self, increment_counter):
+		for stream, writer in self.writers.items():
+			increment_counter("export", "%s_records" % (stream), writer.records)
+			increment_counter("export", "%s_bytes" % (stream), writer.bytes)
+			increment_counter("export", "%s_parts" % (stream), len(writer.entries))
+			writer.records, writer.bytes = 0, 0
+
+
+def merge_manifests(storage):
+	"""
+	Merge the per-writer manifests of every stream into one COPY manifest
+	per stream. Returns a dict of stream name to manifest URL.
+	"""
+	ret = {}
+	for stream in storage.list_dirs(storage.prefix):
+		entries = []
+		for key in storage.list(storage.path(stream, MANIFEST_DIR) + "/"):
+			if key.endswith(MANIFEST_EXTENSION):
+				entries += json.loads(storage.get(key).decode("utf-8"))["entries"]
+		if not entries:
+			continue
+		key = storage.path(stream + MANIFEST_EXTENSION)
+		storage.put(key, json.dumps({"entries": entries}, indent="\t").encode("utf-8"))
+		ret[stream] = storage.url(key)
+	return ret
+
+
+def copy_statement(table, manifest_url, iam_role, options):
+	return "COPY %s FROM '%s' IAM_ROLE '%s' MANIFEST GZIP %s;" % (
+		table, manifest_url, iam_role, options
+	)
+
+
+def main():
+	p = argparse.ArgumentParser(description="Merge export manifests and COPY them into Redshift")
+	p.add_argument("location", help="<STORAGE_LOCATION>:<PREFIX> the job exported to")
+	p.add_argument(
+		"--iam-role", help="IAM role Redshift assumes to read the files (required with --database-url)"
+	)
+	p.add_argument(
+		"--copy-options", default="DELIMITER '|' TIMEFORMAT 'auto'",
+		help="Format options matching the records, as configured on the Firehose streams"
+	)
+	p.add_argument(
+		"--table", action="append", default=[], metavar="STREAM=TABLE",
+		help="Table to load a stream into (defaults to the stream name)"
+	)
+	p.add_argument("--database-url", help="SQLAlchemy URL of the cluster; print the SQL if omitted")
+	args = p.parse_args()
+	if args.database_url and not args.iam_role:
+		p.error("--iam-role is required with --database-url")
+
+	tables = dict(mapping.split("=", 1) for mapping in args.table)
+	manifests = merge_manifests(Storage(args.location))
+	statements = [
+		copy_statement(tables.get(stream, stream), url, args.iam_role or "<IAM_ROLE>", args.copy_options)
+		for stream, url in sorted(manifests.items())
+	]
+
+	if not args.database_url:
+		print("\n".join(statements))
+		return
+
+	from sqlalchemy import create_engine, text
+	engine = create_engine(args.database_url)
+	with engine.begin() as connection:
+		for statement in statements:
+			print(statement)
+			connection.execute(text(statement))
+
+
+if __name__ == "__main__":
+	main()
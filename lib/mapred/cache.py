@@ -0,0 +1,144 @@
+"""
+On-disk cache of decompressed replay objects, shared by local job runs.
+
+Entries are keyed by bucket, key and ETag and hold the decompressed object:
+the ETag is part of the file name, so a caller asking for the current ETag
+never gets a copy of an older version of the object. Entries are evicted
+least recently used first once the cache grows past its size cap; hits
+refresh the entry's mtime.
+
+Several processes may share one cache directory: entries are written to a
+temporary file and published with a single rename, and eviction runs under a
+lock file.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+LOCK_FILE = "lock"
+TMP_PREFIX = ".tmp"
+
+
+class ReplayCache:
+	# After evicting, shrink the cache to this fraction of its cap so that
+	# eviction doesn't run again on the very next write.
+	LOW_WATERMARK = 0.9
+
+	def __init__(self, path, max_size):
+		self.path = path
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+		self.size = sum(size for _, _, size in self.entries())
+
+	def entry_prefix(self, bucket, key):
+		digest = hashlib.sha1(("%s/%s" % (bucket, key)).encode("utf-8")).hexdigest()
+		return os.path.join(self.path, digest[:2], digest + "-")
+
+	def entry_path(self, bucket, key, etag=None):
+		version = hashlib.sha1((etag or "").encode("utf-8")).hexdigest()[:16]
+		return self.entry_prefix(bucket, key) + version
+
+	def entries(self):
+		for dirpath, dirnames, filenames in os.walk(self.path):
+			for filename in filenames:
+				if filename == LOCK_FILE or filename.startswith(TMP_PREFIX):
+					continue
+				path = os.path.join(dirpath, filename)
+				try:
+					st = os.stat(path)
+				except FileNotFoundError:
+					# Evicted by another process
+					continue
+				yield path, st.st_mtime, st.st_size
+
+	def get(self, bucket, key, etag=None):
+		"""
+		Return an open binary handle to the cached object, or None on a miss
+		(including when only a version with another `etag` is cached).
+		"""
+		path = self.entry_path(bucket, key, etag)
+		try:
+			fh = open(path, "rb")
+		except FileNotFoundError:
+			return None
+
+		# Refresh the entry for LRU eviction
+		os.utime(path)
+		return fh
+
+	def put(self, bucket, key, fh, etag=None):
+		"""
+		Copy the stream `fh` into the cache and return an open handle to the
+		new entry along with its size in bytes. Older versions of the object
+		are removed.
+		"""
+		path = self.entry_path(bucket, key, etag)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				shutil.copyfileobj(fh, f)
+				size = f.tell()
+			os.replace(tmp_path, path)
+		except Exception:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			raise
+
+		ret = open(path, "rb")
+		removed = self.remove_versions(bucket, key, keep=path)
+		with self.lock:
+			self.size += size - removed
+			if self.size > self.max_size:
+				self.evict(keep=path)
+
+		return ret, size
+
+	def remove_versions(self, bucket, key, keep):
+		"""
+		Remove the entries of `key` other than `keep`, returning their total
+		size.
+		"""
+		prefix = self.entry_prefix(bucket, key)
+		directory = os.path.dirname(prefix)
+		ret = 0
+		for filename in os.listdir(directory):
+			path = os.path.join(directory, filename)
+			if not path.startswith(prefix) or path == keep:
+				continue
+			try:
+				ret += os.path.getsize(path)
+				os.remove(path)
+			except FileNotFoundError:
+				# Removed by another process
+				pass
+		return ret
+
+	def evict(self, keep=None):
+		"""
+		Remove the least recently used entries, but never `keep` (the entry
+		just written, which may be larger than the target on its own).
+		"""
+		with open(os.path.join(self.path, LOCK_FILE), "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			entries = sorted(self.entries(), key=lambda entry: entry[1])
+			size = sum(size for _, _, size in entries)
+			target = self.max_size * self.LOW_WATERMARK
+			for path, mtime, entry_size in entries:
+				if size <= target:
+					break
+				if path == keep:
+					continue
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+				size -= entry_size
+			self.size = size
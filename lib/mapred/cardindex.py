@@ -0,0 +1,246 @@
+"""
+Inverted index of the cards played in a corpus of replays.
+
+contrib/build_card_index.py makes one pass over the replays and emits, for
+every card ID, the (game, controller, turn, block type) postings it appears
+in, in lines of a bounded number of postings, along with a table of the
+games' input lines. Pack its output into
+an index directory with:
+
+	$ PYTHONPATH=lib python -m mapred.cardindex build INDEX_DIR part-*
+
+Then generate the inputs of an analysis from it, eg. the games in which
+Tuskarr Totemic was played before turn 4:
+
+	$ PYTHONPATH=lib python -m mapred.cardindex query INDEX_DIR --card AT_046 \\
+		--max-turn 3 --block-type PLAY > inputs.txt
+
+An index directory holds `docs.txt` (the input line of each game, in game ID
+order), `postings.bin` (the zlib compressed posting list of each card) and
+`cards.tsv` (the offset, size and number of postings of each card). Postings
+are sorted by game and stored as varints, with game IDs delta-encoded.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import zlib
+from base64 import b64decode
+from collections import defaultdict
+
+from hearthstone.enums import BlockType, GameTag
+from hearthstone.hslog.export import EntityTreeExporter
+
+
+DOCS_FILE = "docs.txt"
+POSTINGS_FILE = "postings.bin"
+CARDS_FILE = "cards.tsv"
+
+INDEXED_BLOCK_TYPES = (BlockType.ATTACK, BlockType.POWER, BlockType.TRIGGER, BlockType.PLAY)
+
+
+def doc_id(line):
+	"""
+	Return a 63-bit ID of the game of an input line. IDs are only assigned
+	densely once the index is built.
+	"""
+	if isinstance(line, str):
+		line = line.encode("utf-8")
+	return int.from_bytes(hashlib.sha1(line).digest()[:8], "big") >> 1
+
+
+def encode_varint(value, out):
+	while value > 0x7f:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+
+def decode_varints(data):
+	value, shift = 0, 0
+	for byte in data:
+		value |= (byte & 0x7f) << shift
+		if byte & 0x80:
+			shift += 7
+		else:
+			yield value
+			value, shift = 0, 0
+
+
+def encode_postings(postings):
+	"""
+	Compress a list of (doc, controller, turn, block_type) postings.
+	"""
+	out = bytearray()
+	previous = 0
+	for doc, controller, turn, block_type in sorted(postings):
+		encode_varint(doc - previous, out)
+		encode_varint(controller, out)
+		encode_varint(turn, out)
+		encode_varint(block_type, out)
+		previous = doc
+	return zlib.compress(bytes(out))
+
+
+def decode_postings(data):
+	values = decode_varints(zlib.decompress(data))
+	doc = 0
+	for delta in values:
+		doc += delta
+		yield doc, next(values), next(values), next(values)
+
+
+class CardPlayExporter(EntityTreeExporter):
+	"""
+	Collects the (card_id, controller, turn, block_type) of every block of
+	an indexed type.
+	"""
+	def __init__(self, packet_tree):
+		super().__init__(packet_tree)
+		self.plays = set()
+
+	def handle_block(self, packet):
+		turn = self.game.tags.get(GameTag.TURN, 0)
+		# The card is often only revealed within its block
+		super().handle_block(packet)
+		if packet.type not in INDEXED_BLOCK_TYPES:
+			return
+
+		try:
+			entity = self.find_entity(packet.entity, "BLOCK")
+		except self.EntityNotFound:
+			return
+		if entity.card_id:
+			controller = entity.tags.get(GameTag.CONTROLLER, 0)
+			self.plays.add((entity.card_id, controller, turn, int(packet.type)))
+
+
+def read_job_output(paths):
+	for path in paths:
+		with open(path, "r", encoding="utf-8") as f:
+			for line in f:
+				yield line.rstrip("\r\n").split("\t")
+
+
+def build(index_dir, paths):
+	"""
+	Pack the output of build_card_index.py into an index directory, with
+	game IDs renumbered densely. The lines of a card are merged.
+	"""
+	docs = {}
+	cards = defaultdict(list)
+	for row in read_job_output(paths):
+		if row[0] == "D":
+			docs[int(row[1])] = row[2]
+		elif row[0] == "P":
+			cards[row[1]].append(b64decode(row[3]))
+
+	hashes = sorted(docs)
+	dense = dict((h, i) for i, h in enumerate(hashes))
+
+	os.makedirs(index_dir, exist_ok=True)
+	with open(os.path.join(index_dir, DOCS_FILE), "w", encoding="utf-8") as f:
+		for h in hashes:
+			f.write(docs[h] + "\n")
+
+	offset = 0
+	postings_path = os.path.join(index_dir, POSTINGS_FILE)
+	cards_path = os.path.join(index_dir, CARDS_FILE)
+	with open(postings_path, "wb") as postings_file, open(cards_path, "w") as cards_file:
+		for card_id, chunks in sorted(cards.items()):
+			postings = set(
+				(dense[doc], controller, turn, block_type)
+				for data in chunks
+				for doc, controller, turn, block_type in decode_postings(data) if doc in dense
+			)
+			data = encode_postings(postings)
+			postings_file.write(data)
+			cards_file.write("%s\t%i\t%i\t%i\n" % (card_id, offset, len(data), len(postings)))
+			offset += len(data)
+
+	return len(hashes), len(cards)
+
+
+class CardIndex:
+	def __init__(self, index_dir):
+		self.index_dir = index_dir
+		self.cards = {}
+		with open(os.path.join(index_dir, CARDS_FILE), "r") as f:
+			for line in f:
+				card_id, offset, size, count = line.rstrip("\n").split("\t")
+				self.cards[card_id] = (int(offset), int(size), int(count))
+
+	def postings(self, card_id):
+		if card_id not in self.cards:
+			return
+		offset, size, count = self.cards[card_id]
+		with open(os.path.join(self.index_dir, POSTINGS_FILE), "rb") as f:
+			f.seek(offset)
+			data = f.read(size)
+		for posting in decode_postings(data):
+			yield posting
+
+	def find(self, card_id, max_turn=None, block_types=None, controller=None):
+		"""
+		Return the set of game IDs in which `card_id` matches the filters.
+		"""
+		ret = set()
+		for doc, posting_controller, turn, block_type in self.postings(card_id):
+			if max_turn is not None and turn > max_turn:
+				continue
+			if block_types and block_type not in block_types:
+				continue
+			if controller is not None and posting_controller != controller:
+				continue
+			ret.add(doc)
+		return ret
+
+	def input_lines(self, docs):
+		"""
+		Yield the input lines of the given game IDs, in game ID order.
+		"""
+		with open(os.path.join(self.index_dir, DOCS_FILE), "r", encoding="utf-8") as f:
+			for doc, line in enumerate(f):
+				if doc in docs:
+					yield line.rstrip("\n")
+
+
+def main():
+	p = argparse.ArgumentParser(description="Build and query card play indexes")
+	commands = p.add_subparsers(dest="command")
+
+	build_parser = commands.add_parser("build", help="Pack build_card_index.py output into an index")
+	build_parser.add_argument("index_dir")
+	build_parser.add_argument("paths", nargs="+", help="Output files of build_card_index.py")
+
+	query_parser = commands.add_parser("query", help="Print the input lines of matching games")
+	query_parser.add_argument("index_dir")
+	query_parser.add_argument("--card", action="append", required=True, help="Card ID (repeatable)")
+	query_parser.add_argument("--all", action="store_true", help="Require every card instead of any")
+	query_parser.add_argument("--max-turn", type=int, help="Only count plays up to this turn")
+	query_parser.add_argument(
+		"--block-type", action="append", choices=[t.name for t in INDEXED_BLOCK_TYPES],
+		help="Only count blocks of this type (repeatable)"
+	)
+	query_parser.add_argument("--controller", type=int, help="Only count plays by this player ID")
+	args = p.parse_args()
+
+	if args.command == "build":
+		num_docs, num_cards = build(args.index_dir, args.paths)
+		sys.stderr.write("Indexed %i cards in %i games\n" % (num_cards, num_docs))
+	elif args.command == "query":
+		index = CardIndex(args.index_dir)
+		block_types = [BlockType[name] for name in args.block_type or ()]
+		matches = [
+			index.find(card_id, args.max_turn, block_types, args.controller) for card_id in args.card
+		]
+		docs = set.intersection(*matches) if args.all else set.union(*matches)
+		for line in index.input_lines(docs):
+			print(line)
+	else:
+		p.print_help()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,194 @@
+"""
+A compact, memory-mapped table of card attributes.
+
+Loading CardDefs.xml with hearthstone.cardxml takes seconds and hundreds of
+megabytes per process, which is why jobs used to leave card filters (eg. on
+COLLECTIBLE) to a second pass. The attributes most analyses need are packed
+once into a small binary table instead:
+
+	$ PYTHONPATH=lib python -m mapred.cards build cards.bin
+
+Jobs pass it with `--card-table cards.bin` (mrjob uploads it with the job)
+and read it with `self.get_card_table()`; opening it only maps the file, so
+it is shared by every process on a machine through the page cache. Without
+a table, one is built from the installed hearthstone package the first time
+it is needed and kept in the temporary directory for the next jobs.
+
+The table is sorted by card ID; a card's `index` in it is a compact integer
+ID, which is stable for a given table but not across hearthstone versions.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+
+
+MAGIC = b"HSCT"
+VERSION = 1
+# magic, version, width of the card ID field, number of cards
+HEADER = struct.Struct("<4sHHI")
+# dbf_id, collectible, card_class, cost, card_type, rarity
+FIELDS = struct.Struct("<IBBhBB")
+
+CardInfo = namedtuple(
+	"CardInfo", ("index", "card_id", "dbf_id", "collectible", "card_class", "cost", "type", "rarity")
+)
+
+_table = None
+_lock = threading.Lock()
+
+
+def get_default_path():
+	from hearthstone import __version__
+	return os.path.join(tempfile.gettempdir(), "mapred-cards-%s.bin" % (__version__))
+
+
+def build(path, db=None):
+	"""
+	Write the table of the cards in `db` (by default, the CardDefs.xml of the
+	installed hearthstone package) to `path`. Cards without a dbf ID can't be
+	packed and are left out. Returns the number of cards written.
+	"""
+	if db is None:
+		from hearthstone import cardxml
+		db, xml = cardxml.load()
+
+	ids = sorted(card_id.encode("utf-8") for card_id, card in db.items() if card.dbf_id is not None)
+	width = max(len(card_id) for card_id in ids)
+	tmp_path = "%s.%i.tmp" % (path, os.getpid())
+	with open(tmp_path, "wb") as f:
+		f.write(HEADER.pack(MAGIC, VERSION, width, len(ids)))
+		for card_id in ids:
+			card = db[card_id.decode("utf-8")]
+			f.write(card_id.ljust(width, b"\0"))
+			f.write(FIELDS.pack(
+				card.dbf_id, bool(card.collectible), int(card.card_class), int(card.cost),
+				int(card.type), int(card.rarity),
+			))
+	os.replace(tmp_path, path)
+	return len(ids)
+
+
+class CardTable:
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.width, self.count = HEADER.unpack_from(self.data)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("%r is not a version %i card table" % (path, VERSION))
+		self.record_size = self.width + FIELDS.size
+		self.indexes = {}
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, card_id):
+		return self.index(card_id) is not None
+
+	def offset(self, index):
+		return HEADER.size + index * self.record_size
+
+	def key(self, index):
+		offset = self.offset(index)
+		return self.data[offset:offset + self.width]
+
+	def index(self, card_id):
+		"""
+		Return the compact integer ID of `card_id`, or None if it is unknown.
+		"""
+		try:
+			return self.indexes[card_id]
+		except KeyError:
+			pass
+
+		encoded = card_id.encode("utf-8") if card_id else b""
+		ret = None
+		if 0 < len(encoded) <= self.width:
+			key = encoded.ljust(self.width, b"\0")
+			low, high = 0, self.count
+			while low < high:
+				middle = (low + high) // 2
+				if self.key(middle) < key:
+					low = middle + 1
+				else:
+					high = middle
+			if low < self.count and self.key(low) == key:
+				ret = low
+
+		self.indexes[card_id] = ret
+		return ret
+
+	def card_id(self, index):
+		return self.key(index).rstrip(b"\0").decode("utf-8")
+
+	def get(self, card_id):
+		"""
+		Return the CardInfo of `card_id`, or None if it is unknown.
+		"""
+		index = self.index(card_id)
+		if index is None:
+			return None
+		fields = FIELDS.unpack_from(self.data, self.offset(index) + self.width)
+		return CardInfo(index, card_id, *fields)
+
+	def is_collectible(self, card_id, unknown=False):
+		"""
+		Return whether `card_id` is collectible, or `unknown` if it isn't in
+		the table (such as cards newer than the table).
+		"""
+		index = self.index(card_id)
+		if index is None:
+			return unknown
+		return bool(self.data[self.offset(index) + self.width + 4])
+
+
+def get_table(path=None):
+	"""
+	Return the process-wide CardTable, opening the table at `path` (or
+	MAPRED_CARD_TABLE, or the default path, building it there if needed) on
+	first use.
+	"""
+	global _table
+	if _table is not None:
+		return _table
+
+	with _lock:
+		if _table is None:
+			path = path or os.environ.get("MAPRED_CARD_TABLE") or get_default_path()
+			if not os.path.exists(path):
+				build(path)
+			_table = CardTable(path)
+		return _table
+
+
+def main():
+	p = argparse.ArgumentParser(description="Build and inspect card attribute tables")
+	commands = p.add_subparsers(dest="command")
+
+	build_parser = commands.add_parser("build", help="Build a table from the installed CardDefs.xml")
+	build_parser.add_argument("path")
+
+	show_parser = commands.add_parser("show", help="Print the attributes of cards")
+	show_parser.add_argument("path")
+	show_parser.add_argument("card_ids", nargs="+")
+	args = p.parse_args()
+
+	if args.command == "build":
+		count = build(args.path)
+		sys.stderr.write("Wrote %i cards to %s\n" % (count, args.path))
+	elif args.command == "show":
+		table = CardTable(args.path)
+		for card_id in args.card_ids:
+			print(table.get(card_id))
+	else:
+		p.print_help()
+
+
+if __name__ == "__main__":
+	main()
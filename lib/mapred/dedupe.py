@@ -0,0 +1,288 @@
+"""
+Detection of duplicate uploads of the same game.
+
+When both players of a game upload it, it is stored twice and every job
+parses and counts it twice. Duplicates are found by a pre-pass over the
+inputs (find_duplicates.py), which groups the uploads of every game and
+keeps the one with the most information: the one in which the most cards
+are revealed, then the largest. The input lines of the other uploads are
+written to a filter file, which jobs check every input line against before
+fetching it:
+
+	$ PYTHONPATH=$PYTHONPATH:lib python find_duplicates.py inputs.txt > duplicates.txt
+	$ PYTHONPATH=lib python -m mapred.dedupe build duplicates.txt dedupe.bin
+	$ python my_job.py --dedupe dedupe.bin inputs.txt
+
+Uploads of a game are matched by a fingerprint of the game server handle in
+the upload metadata (server_ip, server_port and game_handle) or, without it,
+of the account IDs of the players and the start time (to the minute, in UTC)
+in the header of HSReplay XML files. Uploads whose clocks disagree are not
+matched, and are counted twice as before. Power.log files carry no date, so they are
+only matched through their metadata.
+
+By default the filter is a Bloom filter, which takes about 3.6 bytes per
+duplicate at the default error rate: a line which isn't a duplicate is
+skipped with a probability of --error-rate. The Redshift loader, which must
+neither lose nor duplicate games, should find duplicates by global game ID
+(`find_duplicates.py --key game_id`) and build an exact filter with --exact,
+a sorted table of line digests taking 16 bytes per duplicate.
+"""
+
+import argparse
+import hashlib
+from datetime import datetime, timedelta
+import math
+import mmap
+import re
+import struct
+import sys
+
+
+MAGIC = b"HSDD"
+VERSION = 1
+BLOOM, EXACT = 0, 1
+# magic, version, kind, number of hash functions, number of bits or digests
+HEADER = struct.Struct("<4sHHIQ")
+DIGEST_SIZE = 16
+ERROR_RATE = 1e-6
+
+METADATA_FIELDS = ("server_ip", "server_port", "game_handle")
+CHUNK_SIZE = 1024 * 1024
+# The players and the start time are within the first few kilobytes
+HEAD_SIZE = 64 * 1024
+
+XML_TIMESTAMP_RE = re.compile(
+	br'<Game\b[^>]*\bts="(\d{4}-\d\d-\d\dT\d\d:\d\d)(?::\d\d(?:\.\d+)?)?(Z|[+-]\d\d:?\d\d)?"'
+)
+XML_ACCOUNT_RE = re.compile(br'<Player\b[^>]*\baccountHi="(\d+)"[^>]*\baccountLo="(\d+)"')
+# Matches are a fixed number of bytes long
+XML_REVEALED_RE, XML_REVEALED_SIZE = re.compile(br'cardID="\w'), 9
+LOG_REVEALED_RE, LOG_REVEALED_SIZE = re.compile(br"CardID=\w"), 8
+
+
+# blake2b would do, but EMR runs Python 3.4
+def digest(line):
+	if isinstance(line, str):
+		line = line.encode("utf-8")
+	return hashlib.md5(line).digest()[:DIGEST_SIZE]
+
+
+def make_fingerprint(*parts):
+	text = "\t".join(str(part) for part in parts).encode("utf-8")
+	return hashlib.sha1(text).hexdigest()[:24]
+
+
+def utc_minute(minute, offset):
+	"""
+	Return the "YYYY-MM-DDTHH:MM" `minute` with the UTC `offset` ("Z",
+	"+HH:MM", "-HHMM" or None for UTC) of a timestamp, in UTC.
+	"""
+	if not offset or offset == "Z":
+		return minute
+	offset = offset.replace(":", "")
+	delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+	if offset[0] == "-":
+		delta = -delta
+	date = datetime.strptime(minute, "%Y-%m-%dT%H:%M") - delta
+	return date.strftime("%Y-%m-%dT%H:%M")
+
+
+def metadata_fingerprint(metadata):
+	"""
+	Return the fingerprint of the game server handle in `metadata`, or None
+	if it is incomplete.
+	"""
+	values = [metadata.get(field) for field in METADATA_FIELDS]
+	if any(value in (None, "") for value in values):
+		return None
+	return make_fingerprint("handle", *values)
+
+
+def header_fingerprint(head, xml):
+	"""
+	Return the fingerprint of the players and start time of a game from the
+	start of its replay, or None if they can't be found.
+	"""
+	if not xml:
+		return None
+	timestamp = XML_TIMESTAMP_RE.search(head)
+	accounts = sorted(set(XML_ACCOUNT_RE.findall(head)))
+	if not timestamp or len(accounts) != 2 or (b"0", b"0") in accounts:
+		return None
+	accounts = ["%s.%s" % (hi.decode("ascii"), lo.decode("ascii")) for hi, lo in accounts]
+	minute, offset = (group and group.decode("ascii") for group in timestamp.groups())
+	return make_fingerprint("header", utc_minute(minute, offset), *accounts)
+
+
+class Scan:
+	"""
+	What the pre-pass needs to know about an upload: the fingerprint of its
+	game, the number of revealed cards and its size.
+	"""
+	__slots__ = ("fingerprint", "revealed", "size")
+
+	def __init__(self, fingerprint, revealed, size):
+		self.fingerprint = fingerprint
+		self.revealed = revealed
+		self.size = size
+
+
+def scan(fh, metadata, xml=True):
+	"""
+	Read the replay in the binary stream `fh` through without parsing it.
+	"""
+	if xml:
+		revealed_re, overlap = XML_REVEALED_RE, XML_REVEALED_SIZE - 1
+	else:
+		revealed_re, overlap = LOG_REVEALED_RE, LOG_REVEALED_SIZE - 1
+	head = b""
+	tail = b""
+	revealed = 0
+	size = 0
+	while True:
+		chunk = fh.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		if len(head) < HEAD_SIZE:
+			head += chunk[:HEAD_SIZE - len(head)]
+		size += len(chunk)
+		# The tail can't hold a whole match, so none is counted twice
+		window = tail + chunk
+		revealed += len(revealed_re.findall(window))
+		tail = window[-overlap:]
+
+	fingerprint = metadata_fingerprint(metadata) or header_fingerprint(head, xml)
+	return Scan(fingerprint, revealed, size)
+
+
+def pick(uploads):
+	"""
+	Sort the (line, revealed, size) of the uploads of a game, the one to
+	keep first.
+	"""
+	return sorted(uploads, key=lambda upload: (-upload[1], -upload[2], upload[0]))
+
+
+class BloomFilter:
+	def __init__(self, data, hashes, bits):
+		self.data = data
+		self.hashes = hashes
+		self.bits = bits
+
+	@classmethod
+	def create(cls, count, error_rate=ERROR_RATE):
+		count = max(count, 1)
+		bits = max(int(math.ceil(-count * math.log(error_rate) / (math.log(2) ** 2))), 8)
+		hashes = max(int(round(bits / count * math.log(2))), 1)
+		data = bytearray(HEADER.size + (bits + 7) // 8)
+		HEADER.pack_into(data, 0, MAGIC, VERSION, BLOOM, hashes, bits)
+		return cls(data, hashes, bits)
+
+	def positions(self, line):
+		# Double hashing: the k positions are h1 + i * h2
+		h1, h2 = struct.unpack("<QQ", digest(line))
+		for i in range(self.hashes):
+			yield (h1 + i * h2) % self.bits
+
+	def add(self, line):
+		for position in self.positions(line):
+			self.data[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+
+	def __contains__(self, line):
+		for position in self.positions(line):
+			if not self.data[HEADER.size + (position >> 3)] & (1 << (position & 7)):
+				return False
+		return True
+
+
+class DigestSet:
+	def __init__(self, data, count):
+		self.data = data
+		self.count = count
+
+	@classmethod
+	def create(cls, lines):
+		digests = sorted(set(digest(line) for line in lines))
+		data = bytearray(HEADER.pack(MAGIC, VERSION, EXACT, 0, len(digests)))
+		for value in digests:
+			data += value
+		return cls(data, len(digests))
+
+	def get(self, index):
+		offset = HEADER.size + index * DIGEST_SIZE
+		return self.data[offset:offset + DIGEST_SIZE]
+
+	def __contains__(self, line):
+		key = digest(line)
+		low, high = 0, self.count
+		while low < high:
+			middle = (low + high) // 2
+			if self.get(middle) < key:
+				low = middle + 1
+			else:
+				high = middle
+		return low < self.count and self.get(low) == key
+
+
+def load(path):
+	"""
+	Map the filter at `path`, returning a BloomFilter or a DigestSet.
+	"""
+	with open(path, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	magic, version, kind, hashes, size = HEADER.unpack_from(data)
+	if magic != MAGIC or version != VERSION:
+		raise ValueError("%r is not a version %i dedupe filter" % (path, VERSION))
+	if kind == EXACT:
+		return DigestSet(data, size)
+	return BloomFilter(data, hashes, size)
+
+
+def read_lines(path):
+	with open(path, "rb") as f:
+		return [line.rstrip(b"\r\n") for line in f if line.strip()]
+
+
+def main():
+	p = argparse.ArgumentParser(description="Build and check filters of duplicate uploads")
+	commands = p.add_subparsers(dest="command")
+
+	build_parser = commands.add_parser("build", help="Build a filter of the lines of find_duplicates.py")
+	build_parser.add_argument("duplicates", help="Output of find_duplicates.py")
+	build_parser.add_argument("path")
+	build_parser.add_argument("--exact", action="store_true", help="Build an exact filter")
+	build_parser.add_argument(
+		"--error-rate", type=float, default=ERROR_RATE,
+		help="False positive rate of the Bloom filter (default: %g)" % (ERROR_RATE)
+	)
+
+	check_parser = commands.add_parser("check", help="Print the input lines which aren't duplicates")
+	check_parser.add_argument("path")
+	check_parser.add_argument("inputs")
+	args = p.parse_args()
+
+	if args.command == "build":
+		lines = read_lines(args.duplicates)
+		if args.exact:
+			duplicates = DigestSet.create(lines)
+		else:
+			duplicates = BloomFilter.create(len(lines), args.error_rate)
+			for line in lines:
+				duplicates.add(line)
+		with open(args.path, "wb") as f:
+			f.write(duplicates.data)
+		sys.stderr.write("Wrote %i duplicates to %s (%i bytes)\n" % (
+			len(lines), args.path, len(duplicates.data)
+		))
+	elif args.command == "check":
+		duplicates = load(args.path)
+		out = sys.stdout.buffer
+		for line in read_lines(args.inputs):
+			if line not in duplicates:
+				out.write(line + b"\n")
+	else:
+		p.print_help()
+
+
+if __name__ == "__main__":
+	main()
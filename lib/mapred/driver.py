@@ -0,0 +1,252 @@
+"""
+Runs a `parse_file(f)` function over a list of replays outside of Hadoop.
+
+Replays are fetched and decompressed on a thread pool, parsed on a process
+pool and the (text) result of every replay is appended to an output file.
+Every replay done is recorded in a checkpoint file next to the output, so a
+run which crashed or was interrupted resumes where it stopped when started
+again with the same arguments:
+
+	$ PYTHONPATH=lib python brawl-reports/blackheart_brawl_discover_parser.py keys.txt \\
+		-o blackheart.csv [-j 8] [--fetch-workers 16] [--local-dir replays/]
+
+Each checkpoint line holds the status of a replay and the size of the output
+once its result was written. On resume, the output is truncated back to the
+size recorded last, so results are written exactly once even if the driver
+was stopped between writing a result and recording it. Replays which failed
+to parse are recorded as such and not retried; replays which failed to fetch
+are not recorded, and are retried by the next run.
+
+With --local-dir, objects are read from a directory instead of the bucket,
+stored gzipped under their key (see mapred.s3.LocalBucket).
+
+`parse_file` is called in worker processes, so it has to be importable: a
+module-level function of a script guarded by `if __name__ == "__main__"`.
+Power.log replays are given to it as text, XML replays as bytes.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from io import BytesIO, TextIOWrapper
+
+from . import s3
+from .protocols import BaseS3Protocol
+
+
+OK = "ok"
+SKIPPED = "skipped"
+ERROR = "error"
+
+
+def parse_data(parse_file, xml, data):
+	"""
+	Run `parse_file` over the replay in `data`, in a worker process. Returns
+	a (status, result) pair; exceptions are returned as text since they may
+	not survive pickling.
+	"""
+	fh = BytesIO(data)
+	if not xml:
+		fh = TextIOWrapper(fh, encoding="utf-8")
+	try:
+		return OK, parse_file(fh)
+	except Exception as e:
+		return ERROR, "%s: %s" % (e.__class__.__name__, e)
+
+
+class Checkpoint:
+	def __init__(self, path, output_path, sync=True):
+		self.path = path
+		self.output_path = output_path
+		self.sync = sync
+		self.fh = None
+
+	def load(self):
+		"""
+		Return the set of keys already done, truncating the output (and a
+		partially written checkpoint line) to the last recorded state.
+		"""
+		done = set()
+		size = 0
+		valid = 0
+		if os.path.exists(self.path):
+			with open(self.path, "rb") as f:
+				for line in f:
+					if not line.endswith(b"\n"):
+						break
+					status, offset, key = line.decode("utf-8").rstrip("\n").split("\t", 2)
+					done.add(key)
+					size = int(offset)
+					valid += len(line)
+			if valid < os.path.getsize(self.path):
+				os.truncate(self.path, valid)
+
+		output_size = os.path.getsize(self.output_path) if os.path.exists(self.output_path) else 0
+		if output_size < size:
+			raise ValueError("%r is shorter than recorded in %r (%i < %i bytes)" % (
+				self.output_path, self.path, output_size, size
+			))
+		if output_size > size:
+			os.truncate(self.output_path, size)
+		return done
+
+	def open(self):
+		self.fh = open(self.path, "ab")
+
+	def close(self):
+		if self.fh:
+			self.fh.close()
+			self.fh = None
+
+	def add(self, key, status, offset):
+		self.fh.write(("%s\t%i\t%s\n" % (status, offset, key)).encode("utf-8"))
+		self.fh.flush()
+		if self.sync:
+			os.fsync(self.fh.fileno())
+
+
+class Driver:
+	def __init__(
+		self, parse_file, output_path, checkpoint_path=None, processes=None,
+		fetch_workers=16, prefilter=None, xml=False, sync=True, log=sys.stderr,
+	):
+		self.parse_file = parse_file
+		self.output_path = output_path
+		self.checkpoint = Checkpoint(checkpoint_path or output_path + ".done", output_path, sync)
+		self.processes = processes or os.cpu_count() or 1
+		self.fetch_workers = max(fetch_workers, 1)
+		# Replays fetched or being parsed at once, which bounds memory use
+		self.max_pending = (self.processes + self.fetch_workers) * 2
+		self.xml = xml
+		self.sync = sync
+		self.log = log
+		self.protocol = BaseS3Protocol()
+		self.protocol.prefilter = prefilter
+		self.stats = {OK: 0, SKIPPED: 0, ERROR: 0, "fetch_error": 0}
+
+	def fetch(self, bucket, key):
+		"""
+		Return the decompressed replay at `key`, or None if the prefilter
+		rules it out. Runs on the fetch threads.
+		"""
+		fh = self.protocol.apply_prefilter(self.protocol.fetch(bucket, key), {}, xml=self.xml)
+		if not fh:
+			return None
+		with fh:
+			return fh.read()
+
+	def write(self, out, key, status, result):
+		if result:
+			out.write(result.encode("utf-8"))
+			if not result.endswith("\n"):
+				out.write(b"\n")
+		out.flush()
+		if self.sync:
+			os.fsync(out.fileno())
+		self.checkpoint.add(key, status, out.tell())
+		self.stats[status] += 1
+
+	def report(self, key, message):
+		done = sum(self.stats.values())
+		self.log.write("%i / %i - %s%s\n" % (done, self.total, key, message))
+
+	def run(self, bucket, keys):
+		"""
+		Parse the replays at `keys` which aren't done yet. Returns the number
+		of replays per status.
+		"""
+		done = self.checkpoint.load()
+		keys = [key for key in keys if key and key not in done]
+		self.total = len(keys)
+		if done:
+			self.log.write("Resuming: %i done, %i left\n" % (len(done), self.total))
+
+		context = multiprocessing.get_context("spawn")
+		fetcher = ThreadPoolExecutor(max_workers=self.fetch_workers)
+		parser = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+		self.checkpoint.open()
+		try:
+			with open(self.output_path, "ab") as out:
+				self.run_pipeline(fetcher, parser, out, bucket, iter(keys))
+		finally:
+			fetcher.shutdown(wait=False)
+			parser.shutdown()
+			self.checkpoint.close()
+
+		return self.stats
+
+	def run_pipeline(self, fetcher, parser, out, bucket, keys):
+		pending = {}
+
+		def fill():
+			while len(pending) < self.max_pending:
+				key = next(keys, None)
+				if key is None:
+					break
+				pending[fetcher.submit(self.fetch, bucket, key)] = (key, True)
+
+		fill()
+		while pending:
+			finished, not_done = wait(pending, return_when=FIRST_COMPLETED)
+			for future in finished:
+				key, fetching = pending.pop(future)
+				if not fetching:
+					status, result = future.result()
+					if status == ERROR:
+						self.write(out, key, status, None)
+						self.report(key, " - ERROR: %s" % (result))
+					else:
+						self.write(out, key, status, result)
+						self.report(key, "")
+					continue
+
+				try:
+					data = future.result()
+				except Exception as e:
+					# Not recorded, so that the next run retries it
+					self.stats["fetch_error"] += 1
+					self.report(key, " - ERROR: Cannot fetch: %r" % (e))
+					continue
+
+				if data is None:
+					self.write(out, key, SKIPPED, None)
+					self.report(key, " - skipped")
+				else:
+					pending[parser.submit(parse_data, self.parse_file, self.xml, data)] = (key, False)
+			fill()
+
+
+def read_keys(path):
+	with open(path, "r") as f:
+		return [line.strip() for line in f.read().split() if line.strip()]
+
+
+def main(parse_file, bucket, prefilter=None, xml=False, description=None):
+	"""
+	Command line entry point of a report script: parse the keys listed in a
+	file with `parse_file`.
+	"""
+	p = argparse.ArgumentParser(description=description)
+	p.add_argument("keys_file", help="File listing the keys of the replays, one per line")
+	p.add_argument("-o", "--output", required=True, help="File the results are appended to")
+	p.add_argument("--checkpoint", help="Checkpoint file (default: OUTPUT.done)")
+	p.add_argument("-j", "--processes", type=int, help="Parser processes (default: one per CPU)")
+	p.add_argument("--fetch-workers", type=int, default=16, help="Fetch threads (default: 16)")
+	p.add_argument("--bucket", default=bucket, help="Bucket to read from (default: %s)" % (bucket))
+	p.add_argument("--local-dir", help="Read the objects from this directory instead of the bucket")
+	p.add_argument("--no-sync", action="store_true", help="Don't fsync the output after every replay")
+	args = p.parse_args()
+
+	if args.local_dir:
+		s3.set_client(s3.LocalBucket(args.local_dir))
+
+	driver = Driver(
+		parse_file, args.output, args.checkpoint, args.processes, args.fetch_workers,
+		prefilter=prefilter, xml=xml, sync=not args.no_sync,
+	)
+	stats = driver.run(args.bucket, read_keys(args.keys_file))
+	sys.stderr.write("Done: %s\n" % (", ".join("%i %s" % (v, k) for k, v in sorted(stats.items()))))
+	if stats["fetch_error"]:
+		sys.exit(1)
@@ -0,0 +1,187 @@
+"""
+Compact capture of per-game card events (draws, plays and summons).
+
+Exporters which keep a Python list of (entity, turn) tuples per player and
+copy `dict(packet.tags)` on every ShowEntity allocate several objects per
+event, which adds up on long games. EventExporter instead records events
+into preallocated array columns which grow in place, and looks tags up
+directly in the packets' tag lists.
+
+Card IDs are resolved once the game has been exported, from the final state
+of each entity: cards are often drawn hidden and only revealed when played.
+
+	exporter = packet_tree.export(EventExporter)
+	for card_id, turn in exporter.events.cards(DRAW, player.player_id):
+		...
+"""
+
+from array import array
+
+from hearthstone.enums import BlockType, CardType, GameTag, Zone
+from hearthstone.hslog.export import EntityTreeExporter
+
+
+DRAW, PLAY, SUMMON = 0, 1, 2
+
+INITIAL_CAPACITY = 256
+
+# Enum attribute lookups are slow; these are checked for every packet
+CARDTYPE = GameTag.CARDTYPE
+CONTROLLER = GameTag.CONTROLLER
+TURN = GameTag.TURN
+ZONE = GameTag.ZONE
+BLOCK_PLAY = BlockType.PLAY
+MINION = CardType.MINION
+DECK, HAND, PLAY_ZONE = Zone.DECK, Zone.HAND, Zone.PLAY
+
+# Zones whose entering is recorded; every other zone change is passed through
+RECORDED_ZONES = frozenset((HAND, PLAY_ZONE))
+
+
+def get_tag(tags, tag, default=0):
+	"""
+	Return the value of `tag` in a packet's list of (tag, value) pairs.
+	"""
+	for key, value in tags:
+		if key == tag:
+			return value
+	return default
+
+
+class EventLog:
+	"""
+	Events stored as parallel columns of kind, entity ID, controller, turn
+	and card index. Card indexes point into `card_ids`, where 0 is an unknown
+	card; they are only filled in by resolve().
+	"""
+	__slots__ = ("size", "kinds", "entities", "controllers", "turns", "card_indexes", "card_ids")
+
+	def __init__(self, capacity=INITIAL_CAPACITY):
+		self.size = 0
+		self.kinds = array("B", bytes(capacity))
+		self.entities = array("I", bytes(capacity * 4))
+		self.controllers = array("B", bytes(capacity))
+		self.turns = array("H", bytes(capacity * 2))
+		self.card_indexes = array("H", bytes(capacity * 2))
+		self.card_ids = [""]
+
+	def __len__(self):
+		return self.size
+
+	def columns(self):
+		return (self.kinds, self.entities, self.controllers, self.turns, self.card_indexes)
+
+	def grow(self):
+		for column in self.columns():
+			column.extend(array(column.typecode, bytes(len(column) * column.itemsize)))
+
+	def add(self, kind, entity, controller, turn):
+		i = self.size
+		if i == len(self.kinds):
+			self.grow()
+		self.kinds[i] = kind
+		self.entities[i] = entity
+		self.controllers[i] = controller
+		self.turns[i] = turn
+		self.size = i + 1
+
+	def resolve(self, find_entity_by_id):
+		"""
+		Fill in the card column from the current card ID of every entity.
+		"""
+		indexes = {"": 0}
+		entity_indexes = {}
+		self.card_ids = [""]
+		for i in range(self.size):
+			entity_id = self.entities[i]
+			index = entity_indexes.get(entity_id)
+			if index is None:
+				entity = find_entity_by_id(entity_id)
+				card_id = (entity.card_id if entity else None) or ""
+				index = indexes.get(card_id)
+				if index is None:
+					index = indexes[card_id] = len(self.card_ids)
+					self.card_ids.append(card_id)
+				entity_indexes[entity_id] = index
+			self.card_indexes[i] = index
+
+	def cards(self, kind, controller):
+		"""
+		Yield the (card_id, turn) of the events of `kind` by `controller`, in
+		the order they happened.
+		"""
+		kinds, controllers, turns = self.kinds, self.controllers, self.turns
+		card_indexes, card_ids = self.card_indexes, self.card_ids
+		for i in range(self.size):
+			if kinds[i] == kind and controllers[i] == controller:
+				yield card_ids[card_indexes[i]], turns[i]
+
+
+class EventExporter(EntityTreeExporter):
+	"""
+	An EntityTreeExporter which records the cards drawn, played and summoned
+	into `self.events`. The card IDs of the events are resolved at the end of
+	the export.
+	"""
+	def __init__(self, packet_tree):
+		super().__init__(packet_tree)
+		self.events = EventLog()
+
+	def export(self):
+		super().export()
+		self.events.resolve(self.game.find_entity_by_id)
+		return self
+
+	def record(self, kind, entity):
+		controller = entity.tags.get(CONTROLLER, 0)
+		if controller:
+			turn = self.game.tags.get(TURN, 0)
+			self.events.add(kind, entity.id, controller, turn)
+
+	def handle_block(self, block):
+		if block.type == BLOCK_PLAY:
+			entity = self.game.find_entity_by_id(block.entity)
+			if entity:
+				self.record(PLAY, entity)
+		super().handle_block(block)
+
+	def handle_zone_change(self, entity, previous_zone, zone):
+		if zone == HAND and previous_zone == DECK:
+			self.record(DRAW, entity)
+		elif zone == PLAY_ZONE and previous_zone != PLAY_ZONE:
+			if entity.tags.get(CARDTYPE) == MINION:
+				self.record(SUMMON, entity)
+
+	def handle_full_entity(self, packet):
+		entity = super().handle_full_entity(packet)
+		zone = entity.tags.get(ZONE)
+		if zone in RECORDED_ZONES:
+			self.handle_zone_change(entity, None, zone)
+		return entity
+
+	def handle_show_entity(self, packet):
+		zone = get_tag(packet.tags, ZONE)
+		if zone not in RECORDED_ZONES:
+			return super().handle_show_entity(packet)
+		try:
+			entity = self.find_entity(packet.entity, "SHOW_ENTITY")
+		except self.EntityNotFound:
+			# Reported as EntityTreeExporter does
+			return super().handle_show_entity(packet)
+		previous_zone = entity.tags.get(ZONE)
+		entity = super().handle_show_entity(packet)
+		self.handle_zone_change(entity, previous_zone, zone)
+		return entity
+
+	def handle_tag_change(self, packet):
+		if packet.tag != ZONE or packet.value not in RECORDED_ZONES:
+			return super().handle_tag_change(packet)
+		# Same as EntityTreeExporter.handle_tag_change(), with a single lookup
+		try:
+			entity = self.find_entity(packet.entity, "TAG_CHANGE")
+		except self.EntityNotFound:
+			return super().handle_tag_change(packet)
+		previous_zone = entity.tags.get(ZONE)
+		entity.tag_change(packet.tag, packet.value)
+		self.handle_zone_change(entity, previous_zone, packet.value)
+		return entity
@@ -0,0 +1,177 @@
+"""
+Buffered, asynchronous publishing to Kinesis Firehose delivery streams.
+
+Records are grouped per stream into PutRecordBatch calls of up to 500 records
+or 4 MiB and sent by a background thread. Only the records that a batch
+reports as failed are retried, with exponential backoff. The queue of pending
+batches is bounded, so a mapper producing records faster than Firehose
+accepts them blocks instead of buffering without limit.
+
+Records which still fail after the last retry are counted in `failed` and
+handed to the `dead_letter` callback, if any, so that they can be kept
+somewhere and loaded later instead of being lost.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+
+
+class FirehosePublisher:
+	MAX_BATCH_RECORDS = 500
+	MAX_BATCH_BYTES = 4 * 1024 * 1024
+	MAX_RECORD_BYTES = 1000 * 1024
+
+	def __init__(self, client, max_pending=8, max_retries=5, backoff=0.1, dead_letter=None):
+		self.client = client
+		self.max_retries = max_retries
+		self.backoff = backoff
+		# Called with (stream, data) from the sending thread
+		self.dead_letter = dead_letter
+		self.failed = 0
+		self.buffers = {}
+		self.queue = Queue(maxsize=max_pending)
+		self.stats = defaultdict(lambda: defaultdict(int))
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def publish(self, stream, data):
+		if len(data) > self.MAX_RECORD_BYTES:
+			raise ValueError("Record of %i bytes is too large for Firehose" % (len(data)))
+
+		records, size = self.buffers.get(stream, ([], 0))
+		if len(records) >= self.MAX_BATCH_RECORDS or size + len(data) > self.MAX_BATCH_BYTES:
+			self.flush_stream(stream)
+			records, size = [], 0
+		records.append(data)
+		self.buffers[stream] = (records, size + len(data))
+
+	def flush_stream(self, stream):
+		records, size = self.buffers.pop(stream, ([], 0))
+		if not records:
+			return
+
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+		# Blocks while max_pending batches are already waiting
+		self.queue.put((stream, records))
+
+	def flush(self):
+		"""
+		Send all buffered records and wait until every batch is delivered.
+		"""
+		for stream in list(self.buffers):
+			self.flush_stream(stream)
+		self.queue.join()
+
+	def close(self):
+		self.flush()
+		if self.thread is not None:
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					return
+				self.send(*item)
+			finally:
+				self.queue.task_done()
+
+	def record(self, stream, name, amount=1):
+		with self.lock:
+			self.stats[stream][name] += amount
+
+	def send(self, stream, records):
+		attempt = 0
+		while records:
+			if attempt:
+				time.sleep(self.backoff * 2 ** (attempt - 1))
+
+			start = time.time()
+			sent, failed = self.put_batch(stream, records)
+			self.record(stream, "send_ms", int((time.time() - start) * 1000))
+			self.record(stream, "batches")
+			self.record(stream, "records", len(sent))
+			self.record(stream, "bytes", sum(len(data) for data in sent))
+
+			attempt += 1
+			if failed and attempt > self.max_retries:
+				self.record(stream, "failed", len(failed))
+				with self.lock:
+					self.failed += len(failed)
+				if self.dead_letter is not None:
+					for data in failed:
+						self.dead_letter(stream, data)
+				return
+			if failed:
+				self.record(stream, "retries", len(failed))
+			records = failed
+
+	def put_batch(self, stream, records):
+		"""
+		Send one batch, returning the lists of delivered and failed records.
+		"""
+		try:
+			response = self.client.put_record_batch(
+				DeliveryStreamName=stream, Records=[{"Data": data} for data in records]
+			)
+		except Exception as e:
+			# The whole call failed (eg. throttling); retry every record
+			self.record(stream, "errors_%s" % (e.__class__.__name__))
+			return [], records
+
+		if not response.get("FailedPutCount", 0):
+			return records, []
+
+		sent, failed = [], []
+		for data, result in zip(records, response["RequestResponses"]):
+			if result.get("ErrorCode"):
+				failed.append(data)
+			else:
+				sent.append(data)
+		return sent, failed
+
+	def report(self, increment_counter):
+		"""
+		Report the per-stream statistics gathered since the last call as
+		MRJob counters. Must be called from the mapper's thread.
+		"""
+		with self.lock:
+			stats, self.stats = self.stats, defaultdict(lambda: defaultdict(int))
+
+		for stream, values in stats.items():
+			for name, amount in values.items():
+				increment_counter("firehose", "%s_%s" % (stream, name), amount)
+
+
+class LocalFirehose:
+	"""
+	Stand-in for the boto3 Firehose client, which keeps records in memory.
+
+	Every `fail_every`th record of a batch is reported as failed, to exercise
+	the publisher's retries.
+	"""
+	def __init__(self, fail_every=0):
+		self.fail_every = fail_every
+		self.streams = defaultdict(list)
+		self.calls = 0
+
+	def put_record_batch(self, DeliveryStreamName, Records):
+		self.calls += 1
+		responses = []
+		for i, record in enumerate(Records):
+			if self.fail_every and (i + 1) % self.fail_every == 0:
+				responses.append({"ErrorCode": "ServiceUnavailableException"})
+			else:
+				self.streams[DeliveryStreamName].append(record["Data"])
+				responses.append({"RecordId": str(len(self.streams[DeliveryStreamName]))})
+
+		failed = sum(1 for response in responses if "ErrorCode" in response)
+		return {"FailedPutCount": failed, "RequestResponses": responses}
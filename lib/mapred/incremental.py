@@ -0,0 +1,264 @@
+"""
+Incremental runs of recurring jobs, which only process replays that are new
+since the previous run.
+
+	$ PYTHONPATH=lib python -m mapred.incremental STATE_DIR my_job.py \\
+		--list hsreplaynet-replays:uploads/2017/ [-j 32] [-- JOB OPTIONS]
+
+STATE_DIR keeps track of which input keys were processed (in a single
+append-only `processed.txt`) and, when listing a bucket, of the last key
+listed, so that the next listing only starts after it (upload keys are
+ordered by date). Each run builds an inputs file of the new keys only, runs
+the job over it (with mapred.local when -j is given, otherwise as a normal
+MRJob script, eg. with `-- -r emr`) and combines its output with that of the
+previous runs:
+
+- The partial aggregates of AggregateJob subclasses are summed with those of
+  the previous runs and formatted to `merged.csv`. Their size depends on the
+  number of keys, not on the number of runs.
+- The output of other jobs stays in the directory of each run; the output of
+  the job over all runs is the concatenation of the files in the `outputs`
+  list of `state.json`, in order.
+
+Each run has its own directory in STATE_DIR, and `state.json`, which is only
+replaced once a run succeeded, lists the outputs of the successful ones.
+
+Listed keys carry no metadata, so jobs which need metadata fields (declared
+in REQUIRED_METADATA, eg. the game_id of load_redshift.py) can only be run
+with --inputs.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from . import s3
+from .aggregate import AggregateJob, AggregateProtocol, Aggregates
+from .local import load_job_class
+
+
+STATE_FILE = "state.json"
+PROCESSED_FILE = "processed.txt"
+PARTIALS_FILE = "partials.txt"
+
+
+def input_key(line):
+	"""
+	Return the `bucket:key` part of an input line, without its metadata.
+	"""
+	return ":".join(line.split(":", 2)[:2])
+
+
+def list_keys(location, start_after=""):
+	"""
+	Yield the keys under `location` (`<bucket>:<prefix>`, or `local:<dir>`)
+	which sort after `start_after`, in order.
+	"""
+	bucket, sep, prefix = location.partition(":")
+	if bucket == "local":
+		keys = []
+		for dirpath, dirnames, filenames in os.walk(prefix or "."):
+			keys += [os.path.join(dirpath, filename) for filename in filenames]
+		for key in sorted(keys):
+			if key > start_after:
+				yield key
+		return
+
+	paginator = s3.get_client().get_paginator("list_objects_v2")
+	kwargs = {"Bucket": bucket, "Prefix": prefix}
+	if start_after:
+		kwargs["StartAfter"] = start_after
+	for page in paginator.paginate(**kwargs):
+		for obj in page.get("Contents", []):
+			yield obj["Key"]
+
+
+def replace_file(path, data, mode="w"):
+	tmp_path = path + ".tmp"
+	with open(tmp_path, mode) as f:
+		f.write(data)
+	os.replace(tmp_path, path)
+
+
+class IncrementalState:
+	"""
+	The runs committed to a state directory. Every run keeps its inputs and
+	output in its own directory, and state.json, which is replaced
+	atomically, lists the committed ones; a failed run leaves no trace.
+
+	The keys of the committed runs are appended to processed.txt, whose
+	committed size is recorded in state.json: anything past it was written
+	by a run which failed to commit, and is truncated away.
+	"""
+	def __init__(self, state_dir):
+		self.state_dir = state_dir
+		os.makedirs(state_dir, exist_ok=True)
+		self.state = {
+			"high_water_marks": {}, "runs": [], "outputs": [], "partials": None,
+			"processed_size": 0,
+		}
+		path = self.path(STATE_FILE)
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				self.state.update(json.load(f))
+
+		self.processed = set()
+		processed_path = self.path(PROCESSED_FILE)
+		if os.path.exists(processed_path):
+			os.truncate(processed_path, self.state["processed_size"])
+			with open(processed_path, "r", encoding="utf-8") as f:
+				self.processed.update(line.rstrip("\n") for line in f)
+
+	def path(self, *names):
+		return os.path.join(self.state_dir, *names)
+
+	@property
+	def partials(self):
+		if self.state["partials"]:
+			return self.path(self.state["partials"])
+
+	@property
+	def outputs(self):
+		return [self.path(output) for output in self.state["outputs"]]
+
+	def get_new_lines(self, lines):
+		return [line for line in lines if input_key(line) not in self.processed]
+
+	def list_new_lines(self, location):
+		"""
+		List the keys under `location` that were added since the last run.
+		The high water mark is only saved when the run is committed.
+		"""
+		bucket, sep, prefix = location.partition(":")
+		start_after = self.state["high_water_marks"].get(location, "")
+		lines = []
+		for key in list_keys(location, start_after):
+			lines.append("%s:%s" % (bucket, key))
+			self.state["high_water_marks"][location] = key
+		return self.get_new_lines(lines)
+
+	def commit(self, run_dir, lines, output_path, partials_path=None):
+		"""
+		Record a successful run. With `partials_path`, `output_path` replaces
+		the previous output, otherwise it is appended to the outputs.
+		"""
+		with open(self.path(PROCESSED_FILE), "ab") as f:
+			f.truncate(self.state["processed_size"])
+			f.write("".join(input_key(line) + "\n" for line in lines).encode("utf-8"))
+			f.flush()
+			os.fsync(f.fileno())
+			self.state["processed_size"] = f.tell()
+
+		self.state["runs"].append({
+			"dir": os.path.relpath(run_dir, self.state_dir),
+			"time": int(time.time()),
+			"inputs": len(lines),
+		})
+		output = os.path.relpath(output_path, self.state_dir)
+		if partials_path:
+			self.state["outputs"] = [output]
+			self.state["partials"] = os.path.relpath(partials_path, self.state_dir)
+		else:
+			self.state["outputs"].append(output)
+		replace_file(self.path(STATE_FILE), json.dumps(self.state, indent="\t"))
+
+
+def run_job(job_path, inputs_path, job_args, processes, output_path):
+	if processes:
+		command = [
+			sys.executable, "-m", "mapred.local", "-j", str(processes), "-o", output_path,
+			job_path, inputs_path,
+		] + job_args
+		subprocess.check_call(command)
+	else:
+		command = [sys.executable, job_path] + job_args + [inputs_path]
+		with open(output_path, "wb") as out:
+			subprocess.check_call(command, stdout=out)
+
+
+def merge_partials(state, job, run_dir, run_output):
+	"""
+	Sum the partial aggregates of a run with those of the previous runs,
+	and format them to the final CSV. Returns the paths of the CSV and of
+	the summed partials.
+	"""
+	protocol = AggregateProtocol()
+	aggregates = Aggregates()
+	paths = [run_output]
+	if state.partials:
+		paths.insert(0, state.partials)
+	for path in paths:
+		with open(path, "rb") as f:
+			for line in f:
+				line = line.rstrip(b"\r\n")
+				if line:
+					aggregates.merge(*protocol.read(line))
+
+	partials = b"".join(protocol.write(key, values) + b"\n" for key, values in aggregates.items())
+	partials_path = os.path.join(run_dir, PARTIALS_FILE)
+	replace_file(partials_path, partials, "wb")
+	output_path = os.path.join(run_dir, "merged.csv")
+	replace_file(output_path, "".join(line + "\n" for line in job.format_csv(aggregates.items())))
+	return output_path, partials_path
+
+
+def main():
+	p = argparse.ArgumentParser(description="Run a job over the replays added since its last run")
+	p.add_argument("state_dir", help="Directory holding the state and merged output of the runs")
+	p.add_argument("job", help="Path to the job script")
+	inputs = p.add_mutually_exclusive_group(required=True)
+	inputs.add_argument("--list", metavar="BUCKET:PREFIX", help="List new inputs from storage")
+	inputs.add_argument("--inputs", help="Inputs file; lines already processed are skipped")
+	p.add_argument("-j", "--processes", type=int, default=0, help="Run with mapred.local on N processes")
+	p.epilog = "Options after -- are passed on to the job."
+	argv, job_args = sys.argv[1:], []
+	if "--" in argv:
+		argv, job_args = argv[:argv.index("--")], argv[argv.index("--") + 1:]
+	args = p.parse_args(argv)
+
+	job_class = load_job_class(args.job)
+	required = getattr(job_class, "REQUIRED_METADATA", ())
+	if args.list and required:
+		p.error("%s needs the %s metadata of its inputs, which --list doesn't provide; use --inputs" % (
+			args.job, ", ".join(required)
+		))
+
+	state = IncrementalState(args.state_dir)
+	if args.list:
+		lines = state.list_new_lines(args.list)
+	else:
+		with open(args.inputs, "r", encoding="utf-8") as f:
+			lines = state.get_new_lines([line.strip() for line in f if line.strip()])
+
+	if not lines:
+		sys.stderr.write("No new inputs since the last run\n")
+		return
+
+	run_dir = state.path(time.strftime("run-%Y%m%d-%H%M%S"))
+	os.makedirs(run_dir, exist_ok=True)
+	inputs_path = os.path.join(run_dir, "inputs.txt")
+	output_path = os.path.join(run_dir, "output.txt")
+	replace_file(inputs_path, "".join(line + "\n" for line in lines))
+
+	is_aggregate = issubclass(job_class, AggregateJob)
+	if is_aggregate:
+		job_args.append("--emit-partials")
+	sys.stderr.write("Processing %i new inputs\n" % (len(lines)))
+	run_job(args.job, inputs_path, job_args, args.processes, output_path)
+
+	if is_aggregate:
+		merged, partials = merge_partials(state, job_class(args=[]), run_dir, output_path)
+		state.commit(run_dir, lines, merged, partials)
+		sys.stderr.write("Merged output written to %s\n" % (merged))
+	else:
+		state.commit(run_dir, lines, output_path)
+		sys.stderr.write("Output of this run written to %s; %i outputs in total, listed in %s\n" % (
+			output_path, len(state.outputs), state.path(STATE_FILE)
+		))
+
+
+if __name__ == "__main__":
+	main()
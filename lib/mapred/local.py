@@ -0,0 +1,271 @@
+"""
+Run a job on all cores of the local machine, without Hadoop.
+
+	$ PYTHONPATH=lib python -m mapred.local -j 32 my_job.py inputs.txt [JOB OPTIONS]
+
+Options after the input files are passed on to the job.
+
+The input lines are split into chunks which are processed in order by a pool
+of worker processes, each of which creates the job (and with it its S3 client
+and parser state) once and runs every chunk it is given as a map task. Map
+output is then sorted by key and reduced over `--reducers` partitions, like
+Hadoop would. Output is written in input order and counters are summed, so
+the result does not depend on how the work was scheduled.
+
+Given several input files, such as the shards of mapred.manifest, every file
+is one map task instead (unless --chunk-size is set).
+
+With `-j 1` (and a single reducer), the job runs in the current process,
+which is easier to debug and profile.
+"""
+
+import argparse
+import importlib.util
+import inspect
+import multiprocessing
+import os
+import sys
+from collections import defaultdict
+
+from mrjob.job import MRJob
+
+from .partition import stable_hash
+
+
+# The job instance of a worker process, created by init_worker()
+WORKER_JOB = None
+
+
+def load_job_class(path, name=None):
+	directory = os.path.dirname(os.path.abspath(path))
+	if directory not in sys.path:
+		sys.path.insert(0, directory)
+
+	spec = importlib.util.spec_from_file_location("_mapred_local_job", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	if name:
+		return getattr(module, name)
+	if hasattr(module, "Job"):
+		return module.Job
+
+	classes = [
+		cls for cls in vars(module).values()
+		if inspect.isclass(cls) and issubclass(cls, MRJob) and cls.__module__ == module.__name__
+	]
+	if len(classes) != 1:
+		raise ValueError("Could not find the job class in %r, use --job-class" % (path))
+	return classes[0]
+
+
+def create_job(path, class_name, job_args):
+	return load_job_class(path, class_name)(args=job_args)
+
+
+def capture_counters(job):
+	"""
+	Record the counters the job increments instead of writing them to stderr.
+	"""
+	counters = defaultdict(lambda: defaultdict(int))
+
+	def increment_counter(group, counter, amount=1):
+		counters[group][counter] += amount
+
+	job.increment_counter = increment_counter
+	return counters
+
+
+def merge_counters(total, counters):
+	for group, values in counters.items():
+		for counter, amount in values.items():
+			total[group][counter] += amount
+
+
+def init_worker(path, class_name, job_args):
+	global WORKER_JOB
+	WORKER_JOB = create_job(path, class_name, job_args)
+
+
+def run_task(job, task):
+	"""
+	Run a map or reduce task over `pairs`, returning its output pairs and the
+	counters it incremented.
+	"""
+	phase, step_num, index, pairs = task
+	os.environ["mapreduce_task_partition"] = str(index)
+	counters = capture_counters(job)
+	step = job.steps()[step_num]
+
+	if phase == "map":
+		if step_num == 0:
+			protocol = job.input_protocol()
+			pairs = (protocol.read(line) for line in pairs)
+		output = list(job.map_pairs(pairs, step_num))
+		if step.has_explicit_combiner:
+			output = list(job.combine_pairs(sort_pairs(job, output), step_num))
+	else:
+		output = list(job.reduce_pairs(pairs, step_num))
+
+	return index, output, counters
+
+
+def run_worker_task(task):
+	index, output, counters = run_task(WORKER_JOB, task)
+	# defaultdicts of lambdas can't be pickled
+	return index, output, dict((group, dict(values)) for group, values in counters.items())
+
+
+def key_encoder(job):
+	protocol = job.internal_protocol()
+	return lambda pair: protocol.write(*pair).partition(b"\t")[0]
+
+
+def sort_pairs(job, pairs):
+	"""
+	Sort pairs by their encoded key, like the Hadoop shuffle. The sort is
+	stable, so the values of each key stay in the order they were emitted,
+	unless the job sets SORT_VALUES: then whole lines are compared.
+	"""
+	if job.sort_values():
+		protocol = job.internal_protocol()
+		return sorted(pairs, key=lambda pair: protocol.write(*pair))
+	return sorted(pairs, key=key_encoder(job))
+
+
+def partition_pairs(job, pairs, count):
+	encode_key = key_encoder(job)
+	partitions = [[] for i in range(count)]
+	for pair in pairs:
+		partitions[stable_hash(encode_key(pair)) % count].append(pair)
+	return [sort_pairs(job, partition) for partition in partitions]
+
+
+def run_inline(job, lines):
+	"""
+	Run every step of `job` over `lines` in the current process, as a single
+	map and reduce task per step. Returns the output pairs of the last step
+	and the counters incremented.
+	"""
+	counters = defaultdict(lambda: defaultdict(int))
+	pairs = lines
+	for step_num, step in enumerate(job.steps()):
+		if step.has_explicit_mapper or step_num == 0:
+			index, pairs, task_counters = run_task(job, ("map", step_num, 0, pairs))
+			merge_counters(counters, task_counters)
+		if step.has_explicit_reducer:
+			partition = sort_pairs(job, pairs)
+			index, pairs, task_counters = run_task(job, ("reduce", step_num, 0, partition))
+			merge_counters(counters, task_counters)
+	return pairs, counters
+
+
+def chunk(items, size):
+	return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class LocalRunner:
+	def __init__(self, path, job_args, class_name=None, processes=None, reducers=1, chunk_size=0):
+		self.path = path
+		self.job_args = job_args
+		self.class_name = class_name
+		self.processes = processes or multiprocessing.cpu_count()
+		self.reducers = max(reducers, 1)
+		self.chunk_size = chunk_size
+		self.counters = defaultdict(lambda: defaultdict(int))
+		self.job = create_job(path, class_name, job_args)
+
+	def run_tasks(self, pool, tasks):
+		results = [None] * len(tasks)
+		for index, output, counters in pool.imap_unordered(run_worker_task, tasks):
+			results[index] = output
+			merge_counters(self.counters, counters)
+		return results
+
+	def run(self, lines, splits=None):
+		"""
+		Run every step of the job over `lines` (bytes, without line endings),
+		returning the output pairs of the last step. `splits`, if given, are
+		the lines of each map task of the first step.
+		"""
+		if splits is not None:
+			lines = [line for split in splits for line in split]
+		if self.processes == 1 and self.reducers == 1:
+			pairs, counters = run_inline(self.job, lines)
+			merge_counters(self.counters, counters)
+			return pairs
+
+		chunk_size = self.chunk_size or max(len(lines) // (self.processes * 4), 1)
+		context = multiprocessing.get_context("spawn")
+		initargs = (self.path, self.class_name, self.job_args)
+		with context.Pool(self.processes, init_worker, initargs) as pool:
+			pairs = lines
+			for step_num, step in enumerate(self.job.steps()):
+				if step.has_explicit_mapper or step_num == 0:
+					if step_num == 0 and splits is not None:
+						chunks = [split for split in splits if split]
+					else:
+						chunks = chunk(pairs, chunk_size)
+					tasks = [("map", step_num, index, items) for index, items in enumerate(chunks)]
+					pairs = [pair for output in self.run_tasks(pool, tasks) for pair in output]
+
+				if step.has_explicit_reducer:
+					partitions = partition_pairs(self.job, pairs, self.reducers)
+					tasks = [
+						("reduce", step_num, index, items) for index, items in enumerate(partitions)
+					]
+					pairs = [pair for output in self.run_tasks(pool, tasks) for pair in output]
+
+		return pairs
+
+	def write_output(self, pairs, out):
+		protocol = self.job.output_protocol()
+		for key, value in pairs:
+			out.write(protocol.write(key, value))
+			out.write(b"\n")
+
+	def write_counters(self, out):
+		out.write("Counters: %i\n" % (sum(len(values) for values in self.counters.values())))
+		for group in sorted(self.counters):
+			out.write("\t%s\n" % (group))
+			for counter, amount in sorted(self.counters[group].items()):
+				out.write("\t\t%s=%i\n" % (counter, amount))
+
+
+def main():
+	p = argparse.ArgumentParser(description="Run a job in parallel on the local machine")
+	p.add_argument("-j", "--processes", type=int, default=0, help="Number of worker processes (default: all cores)")
+	p.add_argument("--reducers", type=int, default=1, help="Number of reduce partitions")
+	p.add_argument("--chunk-size", type=int, default=0, help="Number of input lines per map task")
+	p.add_argument("--job-class", help="Name of the job class in the script (default: Job)")
+	p.add_argument("-o", "--output", help="File to write the output to (default: stdout)")
+	p.add_argument("job", help="Path to the job script")
+	p.add_argument(
+		"inputs", nargs="+",
+		help="Input files, one <STORAGE_LOCATION>:<FILE_PATH> per line (one map task each if several)"
+	)
+	p.add_argument("job_args", nargs=argparse.REMAINDER, help="Options passed on to the job")
+	args = p.parse_args()
+
+	splits = []
+	for path in args.inputs:
+		with open(path, "rb") as f:
+			splits.append([line.rstrip(b"\r\n") for line in f if line.strip()])
+
+	runner = LocalRunner(
+		args.job, args.job_args, args.job_class, args.processes, args.reducers, args.chunk_size
+	)
+	if len(splits) > 1 and not args.chunk_size:
+		pairs = runner.run(None, splits)
+	else:
+		pairs = runner.run([line for split in splits for line in split])
+
+	if args.output:
+		with open(args.output, "wb") as out:
+			runner.write_output(pairs, out)
+	else:
+		runner.write_output(pairs, sys.stdout.buffer)
+	runner.write_counters(sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
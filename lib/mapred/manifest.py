@@ -0,0 +1,194 @@
+"""
+Shards an inputs file into files of equal replay bytes, one per mapper.
+
+Hadoop splits inputs.txt by line count, but replays vary in size by more than
+10x between short arena games and long control mirrors, so some mappers get
+several times the work of others and the job waits on them. The manifest tool
+looks up the size of every object and spreads the lines over N shard files
+with about the same total size each (largest first, each to the lightest
+shard):
+
+	$ PYTHONPATH=lib python -m mapred.manifest inputs.txt shards/ -n 64 \\
+		[--list hsreplaynet-replays:uploads/2017/01/]
+	$ python my_job.py -r emr --sharded-input shards/part-*
+
+Sizes are taken, in order, from the `size` field (see --size-field) of the
+extended metadata of a line, from listing the --list locations, and from a
+HEAD request per remaining object. Listing is much cheaper than HEAD requests
+when the inputs cover most of a prefix. S3 sizes are compressed sizes, which
+are close enough to proportional to the work.
+
+--sharded-input makes BaseJob jobs keep every input file in one split, so
+that every shard is one map task; mapred.local runs one map task per input
+file when given several. Choose N as a multiple of the map slots of the
+cluster in mrjob.conf. The shard sizes are written to manifest.json.
+"""
+
+import argparse
+import glob
+import heapq
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from . import s3
+from .incremental import list_keys
+from .protocols import BaseS3Protocol
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+def read_inputs(path):
+	"""
+	Return the (line, bucket, key, metadata) of every line of `path`.
+	"""
+	protocol = BaseS3Protocol()
+	inputs = []
+	with open(path, "rb") as f:
+		for line in f:
+			line = line.rstrip(b"\r\n")
+			if not line.strip():
+				continue
+			bucket, key, metadata = protocol.read_line_protocol(line)
+			inputs.append((line, bucket, key, metadata))
+	return inputs
+
+
+def list_sizes(location):
+	"""
+	Return the size of every object under `location` (`<bucket>:<prefix>`
+	or `local:<dir>`), by (bucket, key).
+	"""
+	bucket, sep, prefix = location.partition(":")
+	if bucket == "local":
+		return dict(((bucket, key), os.path.getsize(key)) for key in list_keys(location))
+
+	sizes = {}
+	paginator = s3.get_client().get_paginator("list_objects_v2")
+	for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+		for obj in page.get("Contents", []):
+			sizes[(bucket, obj["Key"])] = obj["Size"]
+	return sizes
+
+
+def head_size(bucket, key):
+	if bucket == "local":
+		return os.path.getsize(key)
+	return s3.get_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+def get_sizes(inputs, size_field="size", locations=(), workers=32):
+	"""
+	Return the size of the object of every input (see the module docstring
+	for where sizes come from).
+	"""
+	sizes = [None] * len(inputs)
+	for i, (line, bucket, key, metadata) in enumerate(inputs):
+		if size_field in metadata:
+			sizes[i] = int(metadata[size_field])
+
+	listed = {}
+	for location in locations:
+		if None not in sizes:
+			break
+		listed.update(list_sizes(location))
+	missing = []
+	for i, (line, bucket, key, metadata) in enumerate(inputs):
+		if sizes[i] is None:
+			sizes[i] = listed.get((bucket, key))
+			if sizes[i] is None:
+				missing.append(i)
+
+	if missing:
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = executor.map(lambda i: head_size(inputs[i][1], inputs[i][2]), missing)
+			for i, size in zip(missing, results):
+				sizes[i] = size
+
+	return sizes
+
+
+def shard(sizes, count):
+	"""
+	Spread the indexes of `sizes` over `count` shards of about equal total
+	size, largest first, each to the shard with the smallest total so far.
+	Returns the indexes of every shard, in their original order.
+	"""
+	count = max(min(count, len(sizes)), 1)
+	heap = [(0, i) for i in range(count)]
+	shards = [[] for i in range(count)]
+	for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+		total, i = heapq.heappop(heap)
+		shards[i].append(index)
+		heapq.heappush(heap, (total + sizes[index], i))
+	return [sorted(indexes) for indexes in shards]
+
+
+def write_shards(inputs, sizes, shards, output_dir):
+	"""
+	Write the lines of every shard to `output_dir`/part-NNNNN, along with
+	their sizes to manifest.json. Returns the manifest.
+
+	Part files of a previous run are removed first, since `part-*` would
+	otherwise pick up the ones beyond the new number of shards.
+	"""
+	os.makedirs(output_dir, exist_ok=True)
+	for path in glob.glob(os.path.join(output_dir, "part-*")):
+		os.remove(path)
+	manifest = {"shards": []}
+	for i, indexes in enumerate(shards):
+		filename = "part-%05i" % (i)
+		with open(os.path.join(output_dir, filename), "wb") as f:
+			for index in indexes:
+				f.write(inputs[index][0] + b"\n")
+		manifest["shards"].append({
+			"path": filename,
+			"lines": len(indexes),
+			"bytes": sum(sizes[index] for index in indexes),
+		})
+
+	totals = [item["bytes"] for item in manifest["shards"]]
+	manifest["lines"] = len(inputs)
+	manifest["bytes"] = sum(totals)
+	# Largest shard over the mean: the wall time of the map phase relative to
+	# a perfect split
+	mean = manifest["bytes"] / len(totals) if totals else 0
+	manifest["imbalance"] = max(totals) / mean if mean else 1.0
+
+	tmp_path = os.path.join(output_dir, MANIFEST_FILE + ".tmp")
+	with open(tmp_path, "w") as f:
+		json.dump(manifest, f, indent="\t")
+	os.replace(tmp_path, os.path.join(output_dir, MANIFEST_FILE))
+	return manifest
+
+
+def main():
+	p = argparse.ArgumentParser(description="Shard an inputs file into files of equal replay bytes")
+	p.add_argument("inputs", help="Input file, one <STORAGE_LOCATION>:<FILE_PATH> per line")
+	p.add_argument("output_dir", help="Directory to write the shard files to")
+	p.add_argument("-n", "--shards", type=int, default=64, help="Number of shards (default: 64)")
+	p.add_argument(
+		"--size-field", default="size", help="Metadata field holding the object size (default: size)"
+	)
+	p.add_argument(
+		"--list", action="append", default=[], metavar="LOCATION",
+		help="<STORAGE_LOCATION>:<PREFIX> to list object sizes from (repeatable)"
+	)
+	p.add_argument("--workers", type=int, default=32, help="Threads for HEAD requests (default: 32)")
+	args = p.parse_args()
+
+	inputs = read_inputs(args.inputs)
+	if not inputs:
+		p.error("No inputs in %r" % (args.inputs))
+	sizes = get_sizes(inputs, args.size_field, args.list, args.workers)
+	manifest = write_shards(inputs, sizes, shard(sizes, args.shards), args.output_dir)
+	sys.stderr.write("Wrote %i lines (%i MB) to %i shards, imbalance %.3f\n" % (
+		manifest["lines"], manifest["bytes"] // (1024 * 1024), len(manifest["shards"]),
+		manifest["imbalance"],
+	))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,117 @@
+"""
+Run several analyses over a single parse of each replay.
+
+A MultiAnalysisJob lists its analyses as (name, analysis) pairs, e.g.:
+
+	class Job(MultiAnalysisJob):
+		ANALYSES = [
+			("chess", chess_brawl.handle_replay),
+			("my_analysis", my_job.handle_replay),
+			("draws", DrawExporter),
+		]
+
+An analysis is either a handler function with the same signature as
+BaseJob.handler_function, or an EntityTreeExporter subclass implementing
+`format_output(metadata)`. Each replay is parsed and its packet tree is built
+once, no matter how many analyses call `replay.to_packet_tree()`.
+
+Every output line is prefixed with the analysis name and a tab. Split the
+combined output into one file per analysis with:
+
+	$ python -m mapred.multi OUTPUT_DIR < job_output.txt
+"""
+
+import os
+import sys
+
+from hearthstone.hslog.export import EntityTreeExporter
+from mrjob.protocol import RawProtocol
+
+from .protocols import BaseJob
+from .timing import TimedReplay
+
+
+class SharedReplay:
+	"""
+	Wraps an HSReplayDocument so that its packet tree is only built once.
+	"""
+	def __init__(self, replay):
+		self.replay = replay
+		self.packet_trees = None
+
+	def __getattr__(self, name):
+		return getattr(self.replay, name)
+
+	def to_packet_tree(self):
+		if self.packet_trees is None:
+			self.packet_trees = self.replay.to_packet_tree()
+		return self.packet_trees
+
+
+class MultiAnalysisJob(BaseJob):
+	ANALYSES = ()
+	OUTPUT_PROTOCOL = RawProtocol
+
+	def run_analysis(self, analysis, replay, metadata):
+		if isinstance(analysis, type) and issubclass(analysis, EntityTreeExporter):
+			packet_tree = replay.to_packet_tree()[0]
+			exporter = packet_tree.export(analysis)
+			return exporter.format_output(metadata)
+
+		return analysis(self, replay, metadata)
+
+	def mapper(self, line, obj):
+		if not obj:
+			return
+
+		replay = obj.get("replay")
+		if not replay:
+			return
+
+		timer = self.get_stage_timer()
+		replay = SharedReplay(TimedReplay(replay, timer))
+		metadata = obj.get("metadata", {})
+		for name, analysis in self.ANALYSES:
+			try:
+				with timer.stage("handler_%s" % (name)):
+					value = self.run_analysis(analysis, replay, metadata)
+			except Exception as e:
+				self.increment_counter("exceptions", "%s_%s" % (name, e.__class__.__name__))
+				if self.INPUT_PROTOCOL.DEBUG:
+					raise
+				continue
+
+			self.increment_counter("analyses", name)
+			for row in (value or "").splitlines():
+				yield name, row
+
+		self.increment_counter("replays", "replays_processed")
+
+
+def split_output(lines, output_dir, extension=".csv"):
+	"""
+	Split the combined output of a MultiAnalysisJob into one file per analysis.
+	"""
+	os.makedirs(output_dir, exist_ok=True)
+	files = {}
+	try:
+		for line in lines:
+			name, sep, row = line.rstrip("\r\n").partition("\t")
+			if name not in files:
+				path = os.path.join(output_dir, name + extension)
+				files[name] = open(path, "w", encoding="utf-8")
+			files[name].write(row + "\n")
+	finally:
+		for f in files.values():
+			f.close()
+
+	return sorted(files)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		sys.stderr.write("Usage: %s OUTPUT_DIR < job_output.txt\n" % (sys.argv[0]))
+		sys.exit(1)
+
+	for name in split_output(sys.stdin, sys.argv[1]):
+		print(name)
@@ -0,0 +1,395 @@
+"""
+Compact binary storage for parsed packet trees.
+
+Parsing HSReplay XML and building the packet tree is the most expensive step
+of every job. This module serializes the packet trees of a replay once, so
+that later jobs can load them back without touching XML.
+
+The format is columnar: every packet (or other object of the tree) is a row
+in a node table, every attribute is a row in an attribute table, and values
+live in typed arrays. Tag lists, which make up most of a replay, get their own
+key/value arrays. Objects are restored without calling their constructors, so
+the format doesn't depend on the exact signatures of the packet classes.
+
+Only objects of the hearthstone, hslog and hsreplay packages (ALLOWED_MODULES)
+are stored and restored; files naming other classes are rejected rather than
+importing arbitrary modules. Datetimes keep their UTC offset.
+
+Layout:
+	MAGIC, version (1 byte), byte order (1 byte),
+	header length (4 bytes, little endian), JSON header,
+	the raw bytes of every section listed in the header.
+
+Files are stored uncompressed locally and gzipped on S3, like replays.
+"""
+
+import datetime
+import importlib
+import json
+import struct
+import sys
+from array import array
+from enum import Enum
+
+
+MAGIC = b"HSPT"
+VERSION = 2
+EXTENSION = ".hspt"
+
+NONE, BOOL, INT, STR, ENUM, NODE, LIST, TUPLE, TAGLIST, DATETIME, TIME = range(11)
+EPOCH = datetime.datetime(1970, 1, 1)
+UTC_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# The aux of aware datetimes and times is their UTC offset in minutes plus this; 0 is naive
+OFFSET_BIAS = 2 ** 15
+ALLOWED_MODULES = ("hearthstone", "hslog", "hsreplay")
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+UINT16_MAX = 2 ** 16 - 1
+
+SECTIONS = (
+	("node_class", "H"),
+	("attr_node", "I"),
+	("attr_name", "H"),
+	("attr_value", "I"),
+	("value_type", "B"),
+	("value_data", "q"),
+	("value_aux", "H"),
+	("items", "I"),
+	("tag_key", "q"),
+	("tag_value", "q"),
+	("tag_key_class", "H"),
+	("tag_value_class", "H"),
+	("string_data", "B"),
+	("string_offsets", "I"),
+)
+
+
+class Interner:
+	def __init__(self):
+		self.ids = {}
+		self.values = []
+
+	def __call__(self, value):
+		ret = self.ids.get(value)
+		if ret is None:
+			ret = self.ids[value] = len(self.values)
+			self.values.append(value)
+		return ret
+
+
+def class_name(cls):
+	return "%s:%s" % (cls.__module__, cls.__qualname__)
+
+
+def is_allowed(module):
+	return any(module == name or module.startswith(name + ".") for name in ALLOWED_MODULES)
+
+
+def resolve_class(name):
+	module, sep, qualname = name.partition(":")
+	if not is_allowed(module):
+		raise ValueError("Refusing to load class %r" % (name))
+	ret = importlib.import_module(module)
+	for attr in qualname.split("."):
+		ret = getattr(ret, attr)
+	return ret
+
+
+def is_int(value):
+	return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_taglist(value):
+	if not isinstance(value, list) or not value or len(value) > UINT16_MAX:
+		return False
+	for item in value:
+		if type(item) is not tuple or len(item) != 2:
+			return False
+		if not is_int(item[0]) or not is_int(item[1]):
+			return False
+	return True
+
+
+def to_microseconds(delta):
+	return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def encode_offset(value):
+	offset = value.utcoffset()
+	if offset is None:
+		return 0
+	minutes, remainder = divmod(offset.days * 86400 + offset.seconds, 60)
+	if remainder or offset.microseconds:
+		raise ValueError("Can't store the UTC offset of %r" % (value))
+	return minutes + OFFSET_BIAS
+
+
+def decode_offset(aux):
+	return datetime.timezone(datetime.timedelta(minutes=aux - OFFSET_BIAS))
+
+
+def encode_datetime(value):
+	"""
+	Return the microseconds since the epoch (UTC for aware datetimes) and
+	the aux of `value`.
+	"""
+	aux = encode_offset(value)
+	return to_microseconds(value - (UTC_EPOCH if aux else EPOCH)), aux
+
+
+def decode_datetime(data, aux):
+	if not aux:
+		return EPOCH + datetime.timedelta(microseconds=data)
+	return (UTC_EPOCH + datetime.timedelta(microseconds=data)).astimezone(decode_offset(aux))
+
+
+def encode_time(value):
+	"""
+	Return the microseconds since midnight (local to the time) and the aux
+	of `value`.
+	"""
+	seconds = (value.hour * 60 + value.minute) * 60 + value.second
+	return seconds * 10 ** 6 + value.microsecond, encode_offset(value)
+
+
+def decode_time(data, aux):
+	seconds, microsecond = divmod(data, 10 ** 6)
+	minutes, second = divmod(seconds, 60)
+	hour, minute = divmod(minutes, 60)
+	tzinfo = decode_offset(aux) if aux else None
+	return datetime.time(hour, minute, second, microsecond, tzinfo=tzinfo)
+
+
+def pack_strings(values):
+	data = array("B")
+	offsets = array("I", [0])
+	for value in values:
+		data.frombytes(value)
+		offsets.append(len(data))
+	return data, offsets
+
+
+def unpack_strings(data, offsets):
+	data = data.tobytes()
+	return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+class Writer:
+	def __init__(self):
+		self.classes = Interner()
+		self.attrs = Interner()
+		self.strings = Interner()
+		self.nodes = {}
+		self.arrays = {name: array(typecode) for name, typecode in SECTIONS}
+		self.roots = []
+
+	def add_root(self, obj):
+		self.roots.append(self.add_value(obj))
+
+	def add_value(self, value):
+		data, aux = 0, 0
+		if value is None:
+			vtype = NONE
+		elif isinstance(value, bool):
+			vtype, data = BOOL, int(value)
+		elif isinstance(value, Enum) and is_int(value):
+			vtype, data, aux = ENUM, int(value), self.add_class(value.__class__)
+		elif is_int(value) and INT64_MIN <= value <= INT64_MAX:
+			vtype, data = INT, value
+		elif isinstance(value, str):
+			vtype, data = STR, self.strings(value.encode("utf-8"))
+		elif isinstance(value, datetime.datetime):
+			vtype = DATETIME
+			data, aux = encode_datetime(value)
+		elif isinstance(value, datetime.time):
+			vtype = TIME
+			data, aux = encode_time(value)
+		elif is_taglist(value):
+			vtype, data, aux = TAGLIST, len(self.arrays["tag_key"]), len(value)
+			self.add_tags(value)
+		elif isinstance(value, (list, tuple)):
+			vtype = LIST if isinstance(value, list) else TUPLE
+			children = [self.add_value(item) for item in value]
+			items = self.arrays["items"]
+			data = len(items)
+			items.append(len(children))
+			items.extend(children)
+		elif hasattr(value, "__dict__") and not isinstance(value, (type, Enum)):
+			vtype, data = NODE, self.add_node(value)
+		else:
+			raise TypeError("Can't store %r" % (value))
+
+		ret = len(self.arrays["value_type"])
+		self.arrays["value_type"].append(vtype)
+		self.arrays["value_data"].append(data)
+		self.arrays["value_aux"].append(aux)
+		return ret
+
+	def add_class(self, cls):
+		if not is_allowed(cls.__module__):
+			raise TypeError("Can't store objects of %r" % (class_name(cls)))
+		return self.classes(class_name(cls))
+
+	def add_tags(self, tags):
+		for key, value in tags:
+			self.arrays["tag_key"].append(int(key))
+			self.arrays["tag_value"].append(int(value))
+			self.arrays["tag_key_class"].append(self.add_enum_class(key))
+			self.arrays["tag_value_class"].append(self.add_enum_class(value))
+
+	def add_enum_class(self, value):
+		# Class ids are offset by one; zero means a plain int
+		if isinstance(value, Enum):
+			return self.add_class(value.__class__) + 1
+		return 0
+
+	def add_node(self, obj):
+		key = id(obj)
+		if key in self.nodes:
+			return self.nodes[key]
+
+		ret = self.nodes[key] = len(self.arrays["node_class"])
+		self.arrays["node_class"].append(self.add_class(obj.__class__))
+		for name, value in vars(obj).items():
+			value_id = self.add_value(value)
+			self.arrays["attr_node"].append(ret)
+			self.arrays["attr_name"].append(self.attrs(name))
+			self.arrays["attr_value"].append(value_id)
+		return ret
+
+	def write(self, fh):
+		arrays = dict(self.arrays)
+		arrays["string_data"], arrays["string_offsets"] = pack_strings(self.strings.values)
+
+		header = {
+			"classes": self.classes.values,
+			"attrs": self.attrs.values,
+			"roots": self.roots,
+			"sections": [[name, len(arrays[name])] for name, typecode in SECTIONS],
+		}
+		header = json.dumps(header).encode("utf-8")
+		byteorder = b"<" if sys.byteorder == "little" else b">"
+
+		fh.write(MAGIC + struct.pack("<B", VERSION) + byteorder)
+		fh.write(struct.pack("<I", len(header)))
+		fh.write(header)
+		for name, typecode in SECTIONS:
+			fh.write(arrays[name].tobytes())
+
+
+class Reader:
+	def __init__(self, data):
+		if data[:4] != MAGIC:
+			raise ValueError("Not a packet tree file")
+		version, = struct.unpack_from("<B", data, 4)
+		if version != VERSION:
+			raise ValueError("Unsupported packet tree file version: %r" % (version))
+		swap = data[5:6] != (b"<" if sys.byteorder == "little" else b">")
+
+		header_len, = struct.unpack_from("<I", data, 6)
+		offset = 10 + header_len
+		header = json.loads(data[10:offset].decode("utf-8"))
+
+		self.arrays = {}
+		for (name, typecode), (_, count) in zip(SECTIONS, header["sections"]):
+			arr = array(typecode)
+			size = arr.itemsize * count
+			arr.frombytes(data[offset:offset + size])
+			if swap:
+				arr.byteswap()
+			self.arrays[name] = arr
+			offset += size
+
+		self.classes = [resolve_class(name) for name in header["classes"]]
+		self.attrs = header["attrs"]
+		self.roots = header["roots"]
+		self.strings = [
+			s.decode("utf-8")
+			for s in unpack_strings(self.arrays["string_data"], self.arrays["string_offsets"])
+		]
+		self.enum_members = {}
+		self.nodes = [self.classes[c].__new__(self.classes[c]) for c in self.arrays["node_class"]]
+
+	def to_enum(self, class_id, value):
+		members = self.enum_members.get(class_id)
+		if members is None:
+			members = {int(m): m for m in self.classes[class_id].__members__.values()}
+			self.enum_members[class_id] = members
+		return members.get(value, value)
+
+	def decode(self, index):
+		vtype = self.arrays["value_type"][index]
+		data = self.arrays["value_data"][index]
+		if vtype == NONE:
+			return None
+		elif vtype == BOOL:
+			return bool(data)
+		elif vtype == INT:
+			return data
+		elif vtype == STR:
+			return self.strings[data]
+		elif vtype == ENUM:
+			return self.to_enum(self.arrays["value_aux"][index], data)
+		elif vtype == NODE:
+			return self.nodes[data]
+		elif vtype == LIST or vtype == TUPLE:
+			items = self.arrays["items"]
+			ret = [self.decode(i) for i in items[data + 1:data + 1 + items[data]]]
+			return ret if vtype == LIST else tuple(ret)
+		elif vtype == TAGLIST:
+			return self.decode_tags(data, self.arrays["value_aux"][index])
+		elif vtype == DATETIME:
+			return decode_datetime(data, self.arrays["value_aux"][index])
+		elif vtype == TIME:
+			return decode_time(data, self.arrays["value_aux"][index])
+		raise ValueError("Unknown value type: %r" % (vtype))
+
+	def decode_tags(self, start, count):
+		ret = []
+		keys, values = self.arrays["tag_key"], self.arrays["tag_value"]
+		key_classes, value_classes = self.arrays["tag_key_class"], self.arrays["tag_value_class"]
+		for i in range(start, start + count):
+			key, value = keys[i], values[i]
+			if key_classes[i]:
+				key = self.to_enum(key_classes[i] - 1, key)
+			if value_classes[i]:
+				value = self.to_enum(value_classes[i] - 1, value)
+			ret.append((key, value))
+		return ret
+
+	def read(self):
+		attr_node, attr_name = self.arrays["attr_node"], self.arrays["attr_name"]
+		attr_value = self.arrays["attr_value"]
+		for i in range(len(attr_node)):
+			node = self.nodes[attr_node[i]]
+			node.__dict__[self.attrs[attr_name[i]]] = self.decode(attr_value[i])
+		return [self.decode(root) for root in self.roots]
+
+
+def dump(packet_trees, fh):
+	"""
+	Write a list of packet trees (as returned by to_packet_tree()) to the
+	binary file object `fh`.
+	"""
+	writer = Writer()
+	for packet_tree in packet_trees:
+		writer.add_root(packet_tree)
+	writer.write(fh)
+
+
+def load(fh):
+	"""
+	Read back the list of packet trees written by dump().
+	"""
+	return Reader(fh.read()).read()
+
+
+class StoredReplay:
+	"""
+	Stand-in for an HSReplayDocument whose packet trees were loaded from
+	a packet tree file.
+	"""
+	def __init__(self, packet_trees):
+		self.packet_trees = packet_trees
+
+	def to_packet_tree(self):
+		return self.packet_trees
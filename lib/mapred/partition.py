@@ -0,0 +1,76 @@
+"""
+Partitioning of job output without funnelling it through a single key.
+
+BaseJob keys the values its mapper yields with a partition key (see
+`--partition-key`), so that a reduce step spreads them across reducers. In
+map-only jobs, PartFiles lets each map task write its output straight into a
+fixed number of part files instead (`--parts-per-task`), so a job writes that
+number of files per map task.
+
+Part files are uploaded by the map task itself, outside of Hadoop's output
+committer, so every attempt of a task that completes publishes its parts.
+BaseJob turns speculative execution of map tasks off when writing them, so
+that there is only one such attempt per task.
+"""
+
+import os
+import zlib
+from uuid import uuid4
+
+from .bulkload import Storage
+
+
+def stable_hash(key):
+	"""
+	Hash of `key` which, unlike hash(), is the same in every process.
+	"""
+	return zlib.crc32(str(key).encode("utf-8"))
+
+
+class PartFiles:
+	"""
+	Writes output lines to `count` part files under a storage location.
+
+	Lines with a key always go to the same part index, so that every mapper
+	writes rows of a given key to parts with the same number. Lines without
+	a key go to whichever part is the smallest so far.
+	"""
+	def __init__(self, location, count, s3=None):
+		self.storage = Storage(location, s3)
+		self.writer_id = uuid4().hex
+		self.count = max(count, 1)
+		self.files = [None] * self.count
+		self.sizes = [0] * self.count
+		self.lines = 0
+
+	def write(self, line, key=None):
+		if key is None:
+			index = self.sizes.index(min(self.sizes))
+		else:
+			index = stable_hash(key) % self.count
+
+		if self.files[index] is None:
+			part_key = self.storage.path("part-%05i-%s" % (index, self.writer_id))
+			fd, path = self.storage.mkstemp(part_key)
+			self.files[index] = (os.fdopen(fd, "wb"), path, part_key)
+
+		f, path, part_key = self.files[index]
+		f.write(line)
+		f.write(b"\n")
+		self.sizes[index] += len(line) + 1
+		self.lines += 1
+
+	def close(self):
+		"""
+		Upload the part files, returning their keys.
+		"""
+		ret = []
+		for index, item in enumerate(self.files):
+			if item is None:
+				continue
+			f, path, key = item
+			f.close()
+			self.storage.put_file(path, key)
+			ret.append(key)
+		self.files = [None] * self.count
+		return ret
@@ -0,0 +1,53 @@
+"""
+Read-ahead of replay objects for MRJob mappers.
+
+The Prefetcher takes the (line, (bucket, key, metadata)) pairs produced by a
+deferred input protocol, fetches and decompresses the next few objects on a
+thread pool and parses them in input order on the calling thread.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+	def __init__(self, protocol, depth, workers):
+		self.protocol = protocol
+		self.depth = max(depth, 1)
+		self.workers = max(workers, 1)
+		self.wait_time = 0.0
+		self.parse_time = 0.0
+
+	def iter_pairs(self, pairs):
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			pending = deque()
+			for line, request in pairs:
+				if request is None:
+					# Skipped before fetching, eg. a duplicate upload
+					continue
+				bucket, key, metadata = request
+				future = executor.submit(self.protocol.fetch, bucket, key)
+				pending.append((line, metadata, future))
+				if len(pending) > self.depth:
+					yield self.complete(*pending.popleft())
+
+			while pending:
+				yield self.complete(*pending.popleft())
+
+		self.report()
+
+	def complete(self, line, metadata, future):
+		self.protocol.timer.begin_replay(line)
+		start = time.time()
+		fh = future.result()
+		self.wait_time += time.time() - start
+
+		start = time.time()
+		ret = self.protocol.parse(line, fh, metadata)
+		self.parse_time += time.time() - start
+		return ret
+
+	def report(self):
+		self.protocol.increment_counter("prefetch", "wait_ms", int(self.wait_time * 1000))
+		self.protocol.increment_counter("prefetch", "parse_ms", int(self.parse_time * 1000))
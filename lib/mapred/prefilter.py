@@ -0,0 +1,135 @@
+"""
+Cheap byte-level filtering of raw replays before they are parsed.
+
+A ReplayFilter drops replays which cannot be relevant to a job: those in
+which none of the job's card IDs appear, or which were played in another
+scenario. Card IDs are matched as plain substrings of the raw HSReplay XML or
+Power.log, so a match is necessary but not sufficient (for example "AT_046"
+also matches "AT_046e"); the job still does the exact check after parsing.
+"""
+
+import io
+from tempfile import SpooledTemporaryFile
+
+
+class ChainedReader(io.RawIOBase):
+	"""
+	Reads a sequence of binary streams one after the other.
+	"""
+	def __init__(self, *streams):
+		self.streams = list(streams)
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while self.streams:
+			data = self.streams[0].read(len(b))
+			if data:
+				b[:len(data)] = data
+				return len(data)
+			self.streams.pop(0)
+		return 0
+
+
+def is_rewindable(fh):
+	"""
+	Whether `fh` can be seeked back to its start cheaply. Wrappers which pass
+	seeks through (such as timing.TimedReader) expose the wrapped stream as
+	`inner`.
+	"""
+	inner = getattr(fh, "inner", None)
+	if inner is not None:
+		return is_rewindable(inner)
+	return isinstance(fh, (io.BufferedReader, io.BytesIO)) and fh.seekable()
+
+
+class ReplayFilter:
+	CHUNK_SIZE = 1024 * 1024
+	SPOOL_SIZE = 16 * 1024 * 1024
+
+	def __init__(self, card_ids=(), scenario_id=None):
+		self.card_ids = tuple(card_id.encode("utf-8") for card_id in card_ids)
+		self.scenario_id = scenario_id
+
+	def __bool__(self):
+		return bool(self.card_ids) or self.scenario_id is not None
+
+	def check_metadata(self, metadata):
+		"""
+		Return False if the upload metadata rules out the replay, otherwise
+		whether the scenario still has to be looked for in the replay itself.
+		"""
+		if self.scenario_id is None:
+			return True
+
+		scenario_id = metadata.get("scenario_id")
+		if scenario_id is None:
+			return True
+
+		return int(scenario_id) == self.scenario_id
+
+	def get_needle_groups(self, metadata, xml):
+		"""
+		Return a list of needle groups: every group must have at least one
+		of its needles appear in the replay.
+		"""
+		groups = []
+		if self.card_ids:
+			groups.append(self.card_ids)
+		if self.scenario_id is not None and xml and "scenario_id" not in metadata:
+			# Power.log doesn't record the scenario; only HSReplay XML can be checked.
+			groups.append((('scenarioID="%i"' % (self.scenario_id)).encode("utf-8"), ))
+		return groups
+
+	def filter(self, fh, metadata, xml=True):
+		"""
+		Scan the binary stream `fh` and return None if the replay can be
+		skipped, or a stream positioned at the start of the replay otherwise.
+
+		Scanning stops as soon as every needle group has matched. Streams
+		which can't be rewound cheaply are spooled to a temporary file up to
+		that point and then read through.
+		"""
+		if not self.check_metadata(metadata):
+			return None
+
+		groups = self.get_needle_groups(metadata, xml)
+		if not groups:
+			return fh
+
+		rewindable = is_rewindable(fh)
+		spool = None if rewindable else SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+		overlap = max(len(needle) for group in groups for needle in group) - 1
+		tail = b""
+
+		try:
+			while groups:
+				chunk = fh.read(self.CHUNK_SIZE)
+				if not chunk:
+					break
+				if spool is not None:
+					spool.write(chunk)
+
+				window = tail + chunk
+				groups = [
+					group for group in groups if not any(needle in window for needle in group)
+				]
+				tail = window[-overlap:] if overlap else b""
+		except Exception:
+			if spool is not None:
+				spool.close()
+			raise
+
+		if groups:
+			# Ruled out; the spool may have rolled over to a file on disk
+			if spool is not None:
+				spool.close()
+			return None
+
+		if rewindable:
+			fh.seek(0)
+			return fh
+
+		spool.seek(0)
+		return io.BufferedReader(ChainedReader(spool, fh))
@@ -2,30 +2,107 @@
 Reusable MRJob protocols to give MRJob scripts access to HSReplay.net objects.
 """
 
-import boto3
 import json
-from gzip import decompress
-from io import BytesIO
+import os
+from gzip import GzipFile, compress, decompress
+from io import BytesIO, TextIOWrapper
 from hsreplay.document import HSReplayDocument
 from mrjob.job import MRJob
 from mrjob.protocol import RawValueProtocol
+from mrjob.step import MRStep
 
+from . import cards, dedupe, packetstore, s3, summary
+from .cache import ReplayCache
+from .partition import PartFiles
+from .prefetch import Prefetcher
+from .prefilter import ReplayFilter
+from .timing import StageTimer, TimedProtocol, TimedReplay
 
-S3 = boto3.client("s3")
+
+# Minimum split size with --sharded-input, larger than any inputs file
+SHARD_SPLIT_SIZE = 1024 * 1024 * 1024 * 1024
 
 
 class BaseS3Protocol:
 	DEBUG = True
+	# Decompress S3 objects incrementally while the parser reads them, rather
+	# than holding the compressed and decompressed bodies in memory at once.
+	STREAMING = True
+
+	def __init__(self):
+		self.job = None
+		self.cache = None
+		self.prefilter = None
+		# Filter of the input lines of duplicate uploads (see mapred.dedupe)
+		self.duplicates = None
+		# When set, read() only decodes the input line and leaves fetching
+		# and parsing to a Prefetcher (see BaseJob.map_pairs).
+		self.deferred = False
+		self.timer = StageTimer()
+
+	def bind(self, job):
+		"""
+		Report the protocol's counters through the given MRJob.
+		"""
+		self.job = job
+
+	def increment_counter(self, group, counter, amount=1):
+		if self.job is not None:
+			self.job.increment_counter(group, counter, amount)
 
 	def read_s3(self, bucket, key):
-		obj = S3.get_object(Bucket=bucket, Key=key)
-		log_str = decompress(obj["Body"].read())
+		if self.cache is not None:
+			return self.read_s3_cached(bucket, key)
+
+		obj = self.get_s3_object(bucket, key)
+		if not self.STREAMING:
+			return self.read_s3_buffered(obj)
+
+		return self.timer.wrap(GzipFile(fileobj=obj["Body"], mode="rb"), "decompress")
+
+	def get_s3_object(self, bucket, key):
+		with self.timer.stage("fetch"):
+			obj = s3.get_client().get_object(Bucket=bucket, Key=key)
+		obj["Body"] = self.timer.wrap(obj["Body"], "fetch")
+		return obj
+
+	def read_s3_buffered(self, obj):
+		compressed = obj["Body"].read()
+		with self.timer.stage("decompress"):
+			log_str = decompress(compressed)
+		self.timer.add_bytes("decompress", len(log_str))
 		out = BytesIO()
 		out.write(log_str)
 		out.seek(0)
 
 		return out
 
+	def get_etag(self, bucket, key):
+		with self.timer.stage("fetch"):
+			return s3.get_client().head_object(Bucket=bucket, Key=key).get("ETag")
+
+	def read_s3_cached(self, bucket, key):
+		"""
+		Return a handle to the replay at `key` from the replay cache, caching
+		it first on a miss. The cache saves downloads and decompression, not
+		requests: every read makes a HEAD request for the current ETag, so
+		that an object which changed since it was cached isn't served stale.
+		"""
+		fh = self.cache.get(bucket, key, etag=self.get_etag(bucket, key))
+		if fh:
+			self.increment_counter("cache", "hits")
+			self.increment_counter("cache", "bytes_read", os.fstat(fh.fileno()).st_size)
+			return self.timer.wrap(fh, "fetch")
+
+		self.increment_counter("cache", "misses")
+		obj = self.get_s3_object(bucket, key)
+		with GzipFile(fileobj=obj["Body"], mode="rb") as stream:
+			stream = self.timer.wrap(stream, "decompress")
+			with self.timer.stage("cache_write"):
+				fh, size = self.cache.put(bucket, key, stream, etag=obj.get("ETag"))
+		self.increment_counter("cache", "bytes_written", size)
+		return self.timer.wrap(fh, "fetch")
+
 	def read_line_protocol(self, line):
 		bucket, sep, key = line.decode("utf-8").partition(":")
 		metadata = {}
@@ -35,32 +112,207 @@ class BaseS3Protocol:
 			metadata = json.loads(metadata)
 		return bucket, key, metadata
 
+	def format_line_protocol(self, bucket, key, metadata=None):
+		line = "%s:%s" % (bucket, key)
+		if metadata:
+			line += ":" + json.dumps(metadata)
+		return line
+
+	def is_duplicate(self, line):
+		if self.duplicates is None:
+			return False
+
+		if line in self.duplicates:
+			self.increment_counter("dedupe", "skipped")
+			return True
+		self.increment_counter("dedupe", "passed")
+		return False
+
+	def read(self, line):
+		if self.is_duplicate(line):
+			# Checked before anything is fetched
+			return line, None
+
+		bucket, key, metadata = self.read_line_protocol(line)
+		if self.deferred:
+			return line, (bucket, key, metadata)
+
+		self.timer.begin_replay(line)
+		return self.parse(line, self.get_file_handle(bucket, key), metadata)
+
+	def parse(self, line, fh, metadata):
+		raise NotImplementedError
+
 	def get_file_handle(self, bucket, key):
 		if bucket == "local":
 			# Local filesystem handle
-			return open(key, "r")
+			return self.timer.wrap(open(key, "rb"), "fetch")
 
 		try:
 			return self.read_s3(bucket, key)
-		except Exception:
+		except Exception as e:
+			self.increment_counter("errors", "fetch_%s" % (e.__class__.__name__))
 			if self.DEBUG:
 				raise
 
+	def write_object(self, bucket, key, data):
+		"""
+		Store `data` under the given location, gzipped when written to S3.
+		"""
+		if bucket == "local":
+			dirname = os.path.dirname(key)
+			if dirname:
+				os.makedirs(dirname, exist_ok=True)
+			with open(key, "wb") as f:
+				f.write(data)
+			return
 
-class HSReplayS3Protocol(BaseS3Protocol):
-	def read(self, line):
-		bucket, key, metadata = self.read_line_protocol(line)
+		s3.get_client().put_object(Bucket=bucket, Key=key, Body=compress(data))
+
+	def fetch(self, bucket, key):
+		"""
+		Download and decompress an object entirely, returning an in-memory
+		handle. Used by the Prefetcher's worker threads.
+		"""
 		fh = self.get_file_handle(bucket, key)
+		if not fh:
+			return None
+
+		with fh:
+			return BytesIO(fh.read())
+
+	def apply_prefilter(self, fh, metadata, xml):
+		"""
+		Return None if the prefilter rules out the replay in `fh`, otherwise
+		a handle to read the replay from.
+		"""
+		if not fh or not self.prefilter:
+			return fh
+
+		with self.timer.stage("prefilter"):
+			ret = self.prefilter.filter(fh, metadata, xml=xml)
+		if ret is None:
+			fh.close()
+			self.increment_counter("prefilter", "skipped")
+		else:
+			self.increment_counter("prefilter", "passed")
+		return ret
+
+
+class HSReplayS3Protocol(BaseS3Protocol):
+	def parse(self, line, fh, metadata):
+		fh = self.apply_prefilter(fh, metadata, xml=True)
+		if not fh:
+			return line, None
+
+		try:
+			with self.timer.stage("parse"):
+				replay = HSReplayDocument.from_xml_file(fh)
+		except Exception as e:
+			self.increment_counter("errors", "parse_%s" % (e.__class__.__name__))
+			if self.DEBUG:
+				raise
+			else:
+				return line, None
+
+		return line, {"replay": replay, "metadata": metadata}
+
+
+class PowerlogS3Protocol(BaseS3Protocol):
+	"""
+	Reads gzipped Power.log objects, yielding a text handle which decodes the
+	log line by line as it is read (for use with LogWatcher.read()).
+	"""
+	def parse(self, line, fh, metadata):
+		return line, self.wrap(self.apply_prefilter(fh, metadata, xml=False))
+
+	def wrap(self, fh):
+		if not fh:
+			return None
+
+		return TextIOWrapper(fh, encoding="utf-8")
+
+	def get_log_handle(self, bucket, key):
+		line, fh = self.parse(None, self.get_file_handle(bucket, key), {})
+		return fh
+
+
+class FingerprintS3Protocol(BaseS3Protocol):
+	"""
+	Reads replays through without parsing them, yielding the dedupe.Scan of
+	each (for find_duplicates.py). Set `xml` to False for Power.log objects.
+	"""
+	xml = True
+
+	def parse(self, line, fh, metadata):
+		if not fh:
+			return line, None
+
+		try:
+			with self.timer.stage("parse"), fh:
+				result = dedupe.scan(fh, metadata, xml=self.xml)
+		except Exception as e:
+			self.increment_counter("errors", "parse_%s" % (e.__class__.__name__))
+			if self.DEBUG:
+				raise
+			else:
+				return line, None
+
+		return line, {"scan": result, "metadata": metadata}
+
+
+class PacketTreeS3Protocol(BaseS3Protocol):
+	"""
+	Reads packet tree files written by export_packet_trees.py. Jobs receive a
+	StoredReplay in place of the HSReplayDocument, so handlers which only use
+	replay.to_packet_tree() work unchanged and skip XML parsing entirely.
+	"""
+	def parse(self, line, fh, metadata):
+		fh = self.apply_prefilter(fh, metadata, xml=False)
+		if not fh:
+			return line, None
+
+		try:
+			with self.timer.stage("parse"):
+				replay = packetstore.StoredReplay(packetstore.load(fh))
+		except Exception as e:
+			self.increment_counter("errors", "parse_%s" % (e.__class__.__name__))
+			if self.DEBUG:
+				raise
+			else:
+				return line, None
+
+		return line, {"replay": replay, "metadata": metadata}
+
+
+class SummaryS3Protocol(BaseS3Protocol):
+	"""
+	Reads only a summary of HSReplay XML objects (see mapred.summary). Jobs
+	receive a ReplaySummary in place of the HSReplayDocument, filled in with
+	the job's SUMMARY_FIELDS.
+	"""
+	def parse(self, line, fh, metadata):
+		fh = self.apply_prefilter(fh, metadata, xml=True)
 		if not fh:
 			return line, None
 
+		fields = getattr(self.job, "SUMMARY_FIELDS", None) or summary.FIELDS
 		try:
-			replay = HSReplayDocument.from_xml_file(fh)
-		except Exception:
+			with self.timer.stage("parse"):
+				replay = summary.summarize(fh, fields)
+			if replay.full_scan:
+				self.increment_counter("summary", "full_scans")
+			if not summary.is_complete(replay, fields):
+				self.increment_counter("summary", "incomplete")
+		except Exception as e:
+			self.increment_counter("errors", "parse_%s" % (e.__class__.__name__))
 			if self.DEBUG:
 				raise
 			else:
 				return line, None
+		finally:
+			# Stops the download when the tail isn't needed
+			fh.close()
 
 		return line, {"replay": replay, "metadata": metadata}
 
@@ -68,6 +320,224 @@ class HSReplayS3Protocol(BaseS3Protocol):
 class BaseJob(MRJob):
 	INPUT_PROTOCOL = HSReplayS3Protocol
 	OUTPUT_PROTOCOL = RawValueProtocol
+	# Replays in which none of these card IDs appear, or which were played in
+	# another scenario, are skipped before they are parsed (see ReplayFilter).
+	PREFILTER_CARD_IDS = ()
+	PREFILTER_SCENARIO_ID = None
+	# Default for --partition-key: "none", "line" or a metadata field such as "game_id"
+	PARTITION_KEY = "none"
+	# Metadata fields of the input lines the job can't run without, eg. to
+	# tell mapred.incremental that listed keys (which have none) won't do
+	REQUIRED_METADATA = ()
+	# Step methods kept when BaseJob adds its partitioning reduce step
+	MAP_STEP_METHODS = (
+		"mapper_init", "mapper", "mapper_final", "combiner_init", "combiner", "combiner_final"
+	)
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.configure_aws()
+
+	def configure_args(self):
+		super().configure_args()
+		self.add_passthru_arg(
+			"--prefetch-depth", type=int, default=0,
+			help="Number of input lines to fetch ahead of the replay being parsed (0 disables prefetching)"
+		)
+		self.add_passthru_arg(
+			"--prefetch-workers", type=int, default=4,
+			help="Number of threads fetching replays when prefetching is enabled"
+		)
+		self.add_passthru_arg(
+			"--cache-dir",
+			help="Directory in which to cache decompressed replays between local runs"
+		)
+		self.add_passthru_arg(
+			"--cache-size", type=int, default=10240,
+			help="Maximum size of the replay cache, in megabytes"
+		)
+		self.add_passthru_arg(
+			"--timing-histogram", action="store_true",
+			help="Report the distribution of per-replay times and a summary of stage times"
+		)
+		self.add_passthru_arg(
+			"--profile-slowest", type=int, default=0,
+			help="Keep cProfile stats of the N slowest replays of each mapper"
+		)
+		self.add_passthru_arg(
+			"--profile-sample", type=float, default=1.0,
+			help="Fraction of replays to profile when --profile-slowest is set"
+		)
+		self.add_passthru_arg(
+			"--profile-dir", default="profiles",
+			help="Directory to write the cProfile stats of the slowest replays to"
+		)
+		self.add_passthru_arg(
+			"--aws-region", help="Region of the AWS clients (overrides MAPRED_AWS_REGION)"
+		)
+		self.add_passthru_arg(
+			"--s3-endpoint-url",
+			help="Endpoint of an S3 compatible server to read from (overrides MAPRED_S3_ENDPOINT_URL)"
+		)
+		self.add_passthru_arg(
+			"--max-pool", type=int,
+			help="Maximum number of connections per AWS client (overrides MAPRED_MAX_POOL)"
+		)
+		self.add_passthru_arg(
+			"--partition-key", default=self.PARTITION_KEY,
+			help="Key the output by the input line (\"line\") or a metadata field (eg. \"game_id\") "
+			"and spread it across reducers, rather than emitting everything under one key"
+		)
+		self.add_passthru_arg(
+			"--partitions", type=int, default=0,
+			help="Number of reducers to spread output across when --partition-key is set"
+		)
+		self.add_passthru_arg(
+			"--parts-per-task", type=int, default=0,
+			help="Write the output of map-only jobs directly to N part files per map task, "
+			"so N times the number of map tasks in all"
+		)
+		self.add_passthru_arg(
+			"--parts-location", default="local:parts/",
+			help="<STORAGE_LOCATION>:<PREFIX> to write the part files of --parts-per-task to"
+		)
+		self.add_passthru_arg(
+			"--sharded-input", action="store_true",
+			help="Run one map task per input file, eg. the shards written by mapred.manifest"
+		)
+		self.add_file_arg(
+			"--dedupe",
+			help="Filter built with `python -m mapred.dedupe build`; skips the duplicate uploads in it"
+		)
+		self.add_file_arg(
+			"--card-table",
+			help="Card table built with `python -m mapred.cards build` (default: built on first use)"
+		)
+
+	def get_replay_cache(self):
+		if not self.options.cache_dir:
+			return None
+
+		if not hasattr(self, "_replay_cache"):
+			self._replay_cache = ReplayCache(
+				self.options.cache_dir, self.options.cache_size * 1024 * 1024
+			)
+		return self._replay_cache
+
+	def get_stage_timer(self):
+		if not hasattr(self, "_stage_timer"):
+			self._stage_timer = StageTimer(
+				self.options.profile_slowest, self.options.profile_sample
+			)
+		return self._stage_timer
+
+	def get_duplicates(self):
+		if not self.options.dedupe:
+			return None
+
+		if not hasattr(self, "_duplicates"):
+			self._duplicates = dedupe.load(self.options.dedupe)
+		return self._duplicates
+
+	def get_card_table(self):
+		return cards.get_table(self.options.card_table)
+
+	def configure_aws(self):
+		s3.configure(
+			region=self.options.aws_region,
+			endpoint_url=self.options.s3_endpoint_url,
+			max_pool=self.options.max_pool,
+		)
+
+	def jobconf(self):
+		jobconf = super().jobconf()
+		if self.options.sharded_input:
+			# Files smaller than the minimum split size are never split
+			jobconf.setdefault("mapreduce.input.fileinputformat.split.minsize", str(SHARD_SPLIT_SIZE))
+		if self.options.parts_per_task:
+			# Part files bypass the output committer: a speculative attempt
+			# would publish a second copy of its task's parts
+			jobconf["mapreduce.map.speculative"] = "false"
+		return jobconf
+
+	def input_protocol(self):
+		protocol = super().input_protocol()
+		protocol.bind(self)
+		protocol.timer = self.get_stage_timer()
+		protocol.cache = self.get_replay_cache()
+		protocol.prefilter = ReplayFilter(self.PREFILTER_CARD_IDS, self.PREFILTER_SCENARIO_ID)
+		protocol.duplicates = self.get_duplicates()
+		protocol.deferred = self.options.prefetch_depth > 0
+		return protocol
+
+	def defines_step(self, name):
+		return getattr(type(self), name) is not getattr(MRJob, name)
+
+	def steps(self):
+		if (
+			self.options.partition_key == "none" or self.options.parts_per_task or
+			self.defines_step("reducer")
+		):
+			return super().steps()
+
+		kwargs = dict(
+			(name, getattr(self, name)) for name in self.MAP_STEP_METHODS if self.defines_step(name)
+		)
+		jobconf = {}
+		if self.options.partitions:
+			jobconf["mapreduce.job.reduces"] = str(self.options.partitions)
+		return [MRStep(reducer=self.partition_reducer, jobconf=jobconf, **kwargs)]
+
+	def get_partition_key(self, line, metadata):
+		field = self.options.partition_key
+		if field == "none":
+			return None
+		if field == "line":
+			return line.decode("utf-8") if isinstance(line, bytes) else line
+		return metadata.get(field)
+
+	def partition_reducer(self, key, values):
+		for value in values:
+			yield key, value
+
+	def writes_part_files(self, step_num):
+		return bool(self.options.parts_per_task) and len(self.steps()) == step_num + 1 and (
+			not self.defines_step("reducer")
+		)
+
+	def map_pairs(self, pairs, step_num=0):
+		if step_num == 0 and self.options.prefetch_depth > 0:
+			prefetcher = Prefetcher(
+				self.input_protocol(), self.options.prefetch_depth, self.options.prefetch_workers
+			)
+			pairs = prefetcher.iter_pairs(pairs)
+
+		if not self.writes_part_files(step_num):
+			for pair in super().map_pairs(pairs, step_num):
+				yield pair
+		else:
+			parts = PartFiles(self.options.parts_location, self.options.parts_per_task)
+			protocol = self.output_protocol()
+			for key, value in super().map_pairs(pairs, step_num):
+				parts.write(protocol.write(key, value), key)
+			self.increment_counter("output", "part_lines", parts.lines)
+			self.increment_counter("output", "part_files", len(parts.close()))
+
+		if step_num == 0:
+			self.report_timing()
+
+	def output_protocol(self):
+		return TimedProtocol(super().output_protocol(), self.get_stage_timer())
+
+	def report_timing(self):
+		"""
+		Report the stage timers of this map task (see mapred.timing).
+		"""
+		timer = self.get_stage_timer()
+		timer.report(self.increment_counter, histogram=self.options.timing_histogram)
+		s3.report(self.increment_counter)
+		for path in timer.dump_profiles(self.options.profile_dir):
+			self.increment_counter("timing", "profiles_written")
 
 	def handler_function(self, replay, metadata):
 		raise NotImplementedError
@@ -80,9 +550,11 @@ class BaseJob(MRJob):
 		if not replay:
 			return
 
+		replay = TimedReplay(replay, self.get_stage_timer())
 		metadata = obj.get("metadata", {})
 		try:
-			value = self.handler_function(replay, metadata)
+			with self.get_stage_timer().stage("handler"):
+				value = self.handler_function(replay, metadata)
 		except Exception as e:
 			if self.INPUT_PROTOCOL.DEBUG:
 				raise
@@ -90,4 +562,4 @@ class BaseJob(MRJob):
 				return
 
 		self.increment_counter("replays", "replays_processed")
-		yield None, value
+		yield self.get_partition_key(line, metadata), value
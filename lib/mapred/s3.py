@@ -0,0 +1,160 @@
+"""
+Shared boto3 clients for S3 and the other AWS services used by jobs.
+
+Clients are created once per process (and again after a fork, since boto3
+clients can't be shared across processes) with a connection pool large
+enough for prefetching, adaptive retries and TCP keep-alive. Settings are
+read from the environment and can be overridden with configure():
+
+	MAPRED_AWS_REGION        Region of the clients (default: boto3's default)
+	MAPRED_S3_ENDPOINT_URL   Endpoint of an S3 compatible server (eg. a local stand-in)
+	MAPRED_MAX_POOL          Maximum number of connections per client (default: 50)
+	MAPRED_MAX_ATTEMPTS      Maximum attempts per request (default: 10)
+
+set_client() replaces a client altogether, eg. with an in-memory fake or a
+LocalBucket serving objects from a directory. Clients set that way are kept
+by configure().
+
+The latency, retries and errors of every request are recorded per operation
+and reported as MRJob counters in the "aws" group by report().
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+
+import boto3
+from botocore.config import Config
+
+
+SETTINGS = {
+	"region": os.environ.get("MAPRED_AWS_REGION") or None,
+	"endpoint_url": os.environ.get("MAPRED_S3_ENDPOINT_URL") or None,
+	"max_pool": int(os.environ.get("MAPRED_MAX_POOL", 50)),
+	"max_attempts": int(os.environ.get("MAPRED_MAX_ATTEMPTS", 10)),
+}
+
+_clients = {}
+# Keys of the clients installed with set_client()
+_set_clients = set()
+_lock = threading.Lock()
+_stats = defaultdict(lambda: defaultdict(int))
+
+
+def configure(**settings):
+	"""
+	Override SETTINGS; settings which are None are left unchanged. Clients
+	created with the previous settings are discarded, but not the ones
+	installed with set_client().
+	"""
+	with _lock:
+		SETTINGS.update((k, v) for k, v in settings.items() if v is not None)
+		for key in list(_clients):
+			if key not in _set_clients:
+				del _clients[key]
+
+
+def get_config():
+	return Config(
+		region_name=SETTINGS["region"],
+		max_pool_connections=SETTINGS["max_pool"],
+		retries={"max_attempts": SETTINGS["max_attempts"], "mode": "adaptive"},
+		tcp_keepalive=True,
+	)
+
+
+def get_client(service="s3"):
+	key = (os.getpid(), service)
+	client = _clients.get(key)
+	if client is not None:
+		return client
+
+	with _lock:
+		if key not in _clients:
+			kwargs = {"config": get_config()}
+			if service == "s3" and SETTINGS["endpoint_url"]:
+				kwargs["endpoint_url"] = SETTINGS["endpoint_url"]
+			client = boto3.client(service, **kwargs)
+			register_events(client)
+			_clients[key] = client
+		return _clients[key]
+
+
+def set_client(client, service="s3"):
+	with _lock:
+		_clients[(os.getpid(), service)] = client
+		_set_clients.add((os.getpid(), service))
+
+
+class LocalBucket:
+	"""
+	Stand-in for the S3 client which serves the objects of any bucket from a
+	local directory, stored (gzipped) under their key as in the bucket.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def get_object(self, Bucket, Key):
+		path = os.path.join(self.directory, Key)
+		ret = self.head_object(Bucket, Key)
+		ret["Body"] = open(path, "rb")
+		return ret
+
+	def head_object(self, Bucket, Key):
+		st = os.stat(os.path.join(self.directory, Key))
+		return {"ContentLength": st.st_size, "ETag": '"%x-%x"' % (st.st_mtime_ns, st.st_size)}
+
+
+def register_events(client):
+	events = client.meta.events
+	events.register("before-call", before_call)
+	events.register("after-call", after_call)
+	events.register("after-call-error", after_call_error)
+
+
+def record(operation, name, amount=1):
+	with _lock:
+		_stats[operation][name] += amount
+
+
+def get_operation(event_name):
+	# Events are named eg. "after-call.s3.GetObject"
+	return event_name.rsplit(".", 1)[-1]
+
+
+def before_call(context, **kwargs):
+	context["mapred_start"] = time.time()
+
+
+def after_call(parsed, context, event_name, **kwargs):
+	operation = get_operation(event_name)
+	start = context.get("mapred_start")
+	if start is not None:
+		record(operation, "ms", int((time.time() - start) * 1000))
+	record(operation, "requests")
+	retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+	if retries:
+		record(operation, "retries", retries)
+	if parsed.get("Error"):
+		record(operation, "errors")
+
+
+def after_call_error(exception, context, event_name, **kwargs):
+	operation = get_operation(event_name)
+	record(operation, "requests")
+	record(operation, "errors_%s" % (exception.__class__.__name__))
+
+
+def report(increment_counter):
+	"""
+	Report the request statistics gathered since the last call as MRJob
+	counters.
+	"""
+	global _stats
+	with _lock:
+		stats, _stats = _stats, defaultdict(lambda: defaultdict(int))
+
+	for operation, values in stats.items():
+		for name, amount in values.items():
+			increment_counter("aws", "%s_%s" % (operation, name), amount)
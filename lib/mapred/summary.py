@@ -0,0 +1,224 @@
+"""
+Lightweight summaries of HSReplay XML documents.
+
+Analyses which only need the players, their heroes, the first player, the
+final play states and the number of turns don't need a full HSReplayDocument.
+summarize() parses the XML only until the players and their starting heroes
+are known, which is within the first few kilobytes of a replay. The final
+PLAYSTATE and TURN tag changes are found in the last TAIL_SIZE bytes of the
+document, which are read but not parsed as XML.
+
+Replays are stored gzipped, so the tail can't be fetched with a ranged read;
+it still has to be decompressed, but that is far cheaper than parsing. When
+the tail fields aren't requested, reading stops as soon as the head is known.
+
+If the tail misses the last TURN or PLAYSTATE change of a player (a game
+followed by more than TAIL_SIZE bytes of other packets), the whole document is
+scanned again when the stream can be rewound, and `full_scan` is set. When it
+can't, the missing values are left as None; is_complete() tells them apart.
+"""
+
+import re
+from xml.etree import ElementTree
+
+from hearthstone.enums import GameTag, PlayState
+
+
+FIELDS = ("players", "heroes", "first_player", "playstates", "turns")
+TAIL_FIELDS = ("playstates", "turns")
+TAIL_SIZE = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+
+TAG_CHANGE_RE = re.compile(br"<TagChange\b([^>]*)>")
+ATTRIBUTE_RE = re.compile(br'(\w+)="([^"]*)"')
+
+
+class PlayerSummary:
+	def __init__(self, entity_id, player_id, name, account_hi, account_lo):
+		self.entity_id = entity_id
+		self.player_id = player_id
+		self.name = name
+		self.account_hi = account_hi
+		self.account_lo = account_lo
+		self.hero_entity = None
+		self.hero = None
+		self.first = False
+		self.playstate = None
+
+	def __repr__(self):
+		return "<PlayerSummary %r (%s)>" % (self.name, self.hero)
+
+
+class ReplaySummary:
+	def __init__(self):
+		self.build = None
+		self.scenario_id = None
+		self.game_type = None
+		self.format = None
+		self.game_entity_id = None
+		self.players = []
+		self.turns = None
+		# Whether the tail fields had to be read from the whole document
+		self.full_scan = False
+
+	@property
+	def first_player(self):
+		for player in self.players:
+			if player.first:
+				return player
+
+	def get_player(self, entity_id):
+		for player in self.players:
+			if player.entity_id == entity_id:
+				return player
+
+	def has_heroes(self):
+		return bool(self.players) and all(player.hero for player in self.players)
+
+
+class TailReader:
+	"""
+	Binary stream wrapper remembering the last `size` bytes read through it.
+	"""
+	def __init__(self, fh, size):
+		self.fh = fh
+		self.size = size
+		self.tail = b""
+
+	def read(self, size=-1):
+		data = self.fh.read(size)
+		self.tail = (self.tail + data)[-self.size:]
+		return data
+
+	def drain(self):
+		while self.read(CHUNK_SIZE):
+			pass
+		return self.tail
+
+
+def to_int(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+
+def parse_head(fh, summary, fields):
+	"""
+	Parse the start of the document into `summary`, stopping as soon as the
+	requested head fields are known.
+	"""
+	hero_entities = {}
+	for event, element in ElementTree.iterparse(fh, events=("start", "end")):
+		tag = element.tag
+		if event == "start":
+			if tag == "HSReplay":
+				summary.build = to_int(element.get("build"))
+			elif tag == "Game":
+				summary.scenario_id = to_int(element.get("scenarioID"))
+				summary.game_type = to_int(element.get("type"))
+				summary.format = to_int(element.get("format"))
+			continue
+
+		if tag == "GameEntity":
+			summary.game_entity_id = to_int(element.get("id"))
+		elif tag == "Player":
+			player = PlayerSummary(
+				to_int(element.get("id")), to_int(element.get("playerID")), element.get("name"),
+				to_int(element.get("accountHi")), to_int(element.get("accountLo")),
+			)
+			for child in element.iter("Tag"):
+				tag_id, value = to_int(child.get("tag")), to_int(child.get("value"))
+				if tag_id == GameTag.HERO_ENTITY:
+					player.hero_entity = value
+					hero_entities[value] = player
+				elif tag_id == GameTag.FIRST_PLAYER:
+					player.first = bool(value)
+			summary.players.append(player)
+		elif tag == "FullEntity":
+			player = hero_entities.get(to_int(element.get("id")))
+			if player is not None:
+				player.hero = element.get("cardID")
+
+		if tag in ("Tag", "Player", "GameEntity"):
+			continue
+		element.clear()
+
+		# Players are complete once another element follows them
+		if summary.players and ("heroes" not in fields or summary.has_heroes()):
+			return
+
+
+def parse_tail(tail, summary):
+	"""
+	Apply the PLAYSTATE and TURN changes in `tail` to `summary`.
+	"""
+	for match in TAG_CHANGE_RE.finditer(tail):
+		attributes = dict(ATTRIBUTE_RE.findall(match.group(1)))
+		tag_id = to_int(attributes.get(b"tag"))
+		entity_id = to_int(attributes.get(b"entity"))
+		value = to_int(attributes.get(b"value"))
+		if tag_id == GameTag.PLAYSTATE:
+			player = summary.get_player(entity_id)
+			if player is not None:
+				try:
+					player.playstate = PlayState(value)
+				except ValueError:
+					player.playstate = value
+		elif tag_id == GameTag.TURN and entity_id == summary.game_entity_id:
+			summary.turns = value
+
+
+def scan_tags(fh, summary):
+	"""
+	Apply the PLAYSTATE and TURN changes of the whole document in `fh` to
+	`summary`, a chunk at a time.
+	"""
+	rest = b""
+	while True:
+		chunk = fh.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		data = rest + chunk
+		# Keep the element which may be cut off for the next chunk
+		end = data.rfind(b"<")
+		if end < 0:
+			end = len(data)
+		parse_tail(data[:end], summary)
+		rest = data[end:]
+	parse_tail(rest, summary)
+
+
+def is_complete(summary, fields=FIELDS):
+	"""
+	Return whether the tail fields among `fields` were found.
+	"""
+	if "turns" in fields and summary.turns is None:
+		return False
+	if "playstates" in fields and any(player.playstate is None for player in summary.players):
+		return False
+	return True
+
+
+def summarize(fh, fields=FIELDS, tail_size=TAIL_SIZE):
+	"""
+	Read a ReplaySummary of the first game of the HSReplay XML in `fh`. Only
+	`fields` are guaranteed to be filled in, unless `fh` can't be rewound
+	to look for tail fields missing from the tail (see is_complete()).
+	"""
+	summary = ReplaySummary()
+	reader = TailReader(fh, tail_size)
+	parse_head(reader, summary, fields)
+
+	if any(field in fields for field in TAIL_FIELDS):
+		parse_tail(reader.drain(), summary)
+		if not is_complete(summary, fields):
+			try:
+				fh.seek(0)
+			except (AttributeError, OSError, ValueError):
+				# Not rewindable, such as a stream from S3
+				return summary
+			summary.full_scan = True
+			scan_tags(fh, summary)
+
+	return summary
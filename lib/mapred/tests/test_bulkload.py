@@ -0,0 +1,120 @@
+import gzip
+import json
+import os
+import tempfile
+from io import BytesIO
+
+from mapred.bulkload import BulkExporter, Storage, merge_manifests
+
+
+class MemoryS3:
+	"""
+	The part of the S3 client Storage uses, keeping objects in memory.
+	"""
+	def __init__(self):
+		self.objects = {}
+		self.list_calls = []
+
+	def upload_file(self, path, bucket, key):
+		with open(path, "rb") as f:
+			self.objects[(bucket, key)] = f.read()
+
+	def get_object(self, Bucket, Key):
+		return {"Body": BytesIO(self.objects[(Bucket, Key)])}
+
+	def get_paginator(self, operation):
+		return self
+
+	def paginate(self, Bucket, Prefix, Delimiter=None):
+		self.list_calls.append((Prefix, Delimiter))
+		contents, prefixes = [], set()
+		for bucket, key in sorted(self.objects):
+			if bucket != Bucket or not key.startswith(Prefix):
+				continue
+			rest = key[len(Prefix):]
+			if Delimiter and Delimiter in rest:
+				prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+			else:
+				contents.append({"Key": key})
+		yield {"Contents": contents, "CommonPrefixes": [{"Prefix": p} for p in sorted(prefixes)]}
+
+
+def export(location, records, s3=None):
+	exporter = BulkExporter(location, s3)
+	for stream, data in records:
+		exporter.publish(stream, data)
+	exporter.close()
+
+
+def read_manifest(path):
+	with open(path) as f:
+		return json.load(f)["entries"]
+
+
+def test_storage_prefix_is_a_directory():
+	assert Storage("local:exports").path("game", "part") == "exports/game/part"
+	assert Storage("local:exports/").path("game") == "exports/game"
+	assert Storage("local:").path("game") == "game"
+
+
+def test_merge_local_manifests(tmpdir):
+	location = "local:%s" % (tmpdir.join("exports"))
+	export(location, [("game", b"1|a"), ("player", b"1|x")])
+	export(location, [("game", b"2|b")])
+
+	manifests = merge_manifests(Storage(location))
+	assert sorted(manifests) == ["game", "player"]
+
+	entries = read_manifest(manifests["game"])
+	assert len(entries) == 2
+	records = []
+	for entry in entries:
+		assert entry["mandatory"]
+		assert entry["meta"]["content_length"] == os.path.getsize(entry["url"])
+		with gzip.open(entry["url"]) as f:
+			records += f.read().splitlines()
+	assert sorted(records) == [b"1|a", b"2|b"]
+	assert len(read_manifest(manifests["player"])) == 1
+
+
+def test_merge_is_repeatable(tmpdir):
+	location = "local:%s/" % (tmpdir.join("exports"))
+	export(location, [("game", b"1|a")])
+	first = merge_manifests(Storage(location))
+	# The merged manifests written next to the streams aren't streams
+	assert merge_manifests(Storage(location)) == first
+	assert len(read_manifest(first["game"])) == 1
+
+
+def test_merge_empty_location(tmpdir):
+	assert merge_manifests(Storage("local:%s" % (tmpdir.join("missing")))) == {}
+
+
+def test_merge_s3_manifests_lists_streams_only():
+	s3 = MemoryS3()
+	export("bucket:exports", [("game", b"1|a"), ("player", b"1|x")], s3)
+	export("bucket:exports", [("game", b"2|b")], s3)
+
+	manifests = merge_manifests(Storage("bucket:exports", s3))
+	assert manifests == {
+		"game": "s3://bucket/exports/game.manifest",
+		"player": "s3://bucket/exports/player.manifest",
+	}
+	# Streams come from one delimited listing instead of every key
+	assert s3.list_calls[0] == ("exports/", "/")
+	entries = json.loads(s3.objects[("bucket", "exports/game.manifest")].decode("utf-8"))["entries"]
+	assert len(entries) == 2
+	assert all(entry["url"].startswith("s3://bucket/exports/game/part-") for entry in entries)
+
+
+def test_local_temp_files_are_next_to_their_key(tmpdir, monkeypatch):
+	# A system temporary directory on another filesystem would make the
+	# final rename fail; one which doesn't exist must not be used at all
+	monkeypatch.setattr(tempfile, "tempdir", str(tmpdir.join("missing")))
+	location = "local:%s" % (tmpdir.join("exports"))
+	export(location, [("game", b"1|a")])
+
+	manifests = merge_manifests(Storage(location))
+	assert len(read_manifest(manifests["game"])) == 1
+	names = os.listdir(str(tmpdir.join("exports", "game")))
+	assert not [name for name in names if name.startswith(".tmp-")]
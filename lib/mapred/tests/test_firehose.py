@@ -0,0 +1,123 @@
+import pytest
+
+from mapred.firehose import FirehosePublisher, LocalFirehose
+
+
+def report(publisher):
+	counters = {}
+
+	def increment_counter(group, counter, amount=1):
+		counters[(group, counter)] = counters.get((group, counter), 0) + amount
+
+	publisher.report(increment_counter)
+	return counters
+
+
+def test_publish_delivers_in_order():
+	client = LocalFirehose()
+	publisher = FirehosePublisher(client, backoff=0)
+	for i in range(1200):
+		publisher.publish("game", b"%i" % (i))
+	publisher.publish("player", b"x")
+	publisher.close()
+
+	assert client.streams["game"] == [b"%i" % (i) for i in range(1200)]
+	assert client.streams["player"] == [b"x"]
+	# 500 records per batch
+	assert client.calls == 4
+
+	counters = report(publisher)
+	assert counters[("firehose", "game_records")] == 1200
+	assert counters[("firehose", "game_batches")] == 3
+	assert counters[("firehose", "player_bytes")] == 1
+
+
+def test_batches_are_bounded_in_bytes():
+	client = LocalFirehose()
+	publisher = FirehosePublisher(client, backoff=0)
+	record = b"x" * (FirehosePublisher.MAX_RECORD_BYTES)
+	for i in range(10):
+		publisher.publish("game", record)
+	publisher.close()
+
+	assert len(client.streams["game"]) == 10
+	assert client.calls == 3
+
+
+def test_failed_records_are_retried():
+	client = LocalFirehose(fail_every=3)
+	publisher = FirehosePublisher(client, backoff=0)
+	for i in range(9):
+		publisher.publish("game", b"%i" % (i))
+	publisher.close()
+
+	assert sorted(client.streams["game"]) == sorted(b"%i" % (i) for i in range(9))
+	counters = report(publisher)
+	assert counters[("firehose", "game_records")] == 9
+	assert counters[("firehose", "game_retries")] == 4
+	assert ("firehose", "game_failed") not in counters
+
+
+def test_records_fail_after_max_retries():
+	client = LocalFirehose(fail_every=1)
+	publisher = FirehosePublisher(client, max_retries=2, backoff=0)
+	publisher.publish("game", b"a")
+	publisher.publish("game", b"b")
+	publisher.close()
+
+	assert client.streams["game"] == []
+	assert client.calls == 3
+	assert publisher.failed == 2
+	counters = report(publisher)
+	assert counters[("firehose", "game_failed")] == 2
+	assert counters[("firehose", "game_retries")] == 4
+
+
+def test_failed_records_go_to_dead_letter():
+	dead_letters = []
+	client = LocalFirehose(fail_every=2)
+	publisher = FirehosePublisher(
+		client, max_retries=0, backoff=0,
+		dead_letter=lambda stream, data: dead_letters.append((stream, data))
+	)
+	for i in range(4):
+		publisher.publish("game", b"%i" % (i))
+	publisher.close()
+
+	assert client.streams["game"] == [b"0", b"2"]
+	assert dead_letters == [("game", b"1"), ("game", b"3")]
+	assert publisher.failed == 2
+
+
+def test_call_errors_retry_every_record():
+	class FlakyFirehose(LocalFirehose):
+		def put_record_batch(self, DeliveryStreamName, Records):
+			if not self.calls:
+				self.calls += 1
+				raise ConnectionError("Connection reset")
+			return super().put_record_batch(DeliveryStreamName, Records)
+
+	client = FlakyFirehose()
+	publisher = FirehosePublisher(client, backoff=0)
+	publisher.publish("game", b"a")
+	publisher.close()
+
+	assert client.streams["game"] == [b"a"]
+	counters = report(publisher)
+	assert counters[("firehose", "game_errors_ConnectionError")] == 1
+	assert counters[("firehose", "game_records")] == 1
+
+
+def test_report_resets_stats():
+	publisher = FirehosePublisher(LocalFirehose(), backoff=0)
+	publisher.publish("game", b"a")
+	publisher.flush()
+	assert report(publisher)[("firehose", "game_records")] == 1
+	assert report(publisher) == {}
+	publisher.close()
+
+
+def test_oversized_record_is_rejected():
+	publisher = FirehosePublisher(LocalFirehose())
+	with pytest.raises(ValueError):
+		publisher.publish("game", b"x" * (FirehosePublisher.MAX_RECORD_BYTES + 1))
@@ -0,0 +1,54 @@
+import json
+import os
+
+from mapred.manifest import MANIFEST_FILE, shard, write_shards
+
+
+def make_inputs(count):
+	inputs = [(("local:f%i" % (i)).encode("utf-8"), "local", "f%i" % (i), {}) for i in range(count)]
+	return inputs, [100 * (i + 1) for i in range(count)]
+
+
+def read_parts(output_dir):
+	lines = []
+	for name in sorted(os.listdir(output_dir)):
+		if name.startswith("part-"):
+			with open(os.path.join(output_dir, name), "rb") as f:
+				lines += f.read().splitlines()
+	return lines
+
+
+def test_shard_balances_sizes():
+	shards = shard([50, 40, 30, 20, 10], 2)
+	assert sorted(index for indexes in shards for index in indexes) == [0, 1, 2, 3, 4]
+	totals = sorted(sum([50, 40, 30, 20, 10][i] for i in indexes) for indexes in shards)
+	assert totals == [70, 80]
+
+
+def test_shard_count_is_bounded_by_inputs():
+	assert len(shard([1, 2], 8)) == 2
+
+
+def test_write_shards(tmpdir):
+	output_dir = str(tmpdir.join("shards"))
+	inputs, sizes = make_inputs(6)
+	manifest = write_shards(inputs, sizes, shard(sizes, 3), output_dir)
+
+	assert sorted(read_parts(output_dir)) == sorted(line for line, *rest in inputs)
+	assert manifest["lines"] == 6
+	assert manifest["bytes"] == sum(sizes)
+	with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+		assert json.load(f) == manifest
+
+
+def test_rewrite_with_fewer_shards_removes_old_parts(tmpdir):
+	output_dir = str(tmpdir.join("shards"))
+	inputs, sizes = make_inputs(4)
+	write_shards(inputs, sizes, shard(sizes, 4), output_dir)
+
+	inputs, sizes = make_inputs(2)
+	write_shards(inputs, sizes, shard(sizes, 4), output_dir)
+	assert sorted(name for name in os.listdir(output_dir) if name.startswith("part-")) == [
+		"part-00000", "part-00001"
+	]
+	assert sorted(read_parts(output_dir)) == [b"local:f0", b"local:f1"]
@@ -0,0 +1,79 @@
+import gzip
+import os
+
+import pytest
+
+from mapred import s3
+
+
+@pytest.fixture(autouse=True)
+def clients(monkeypatch):
+	monkeypatch.setattr(s3, "SETTINGS", dict(s3.SETTINGS))
+	monkeypatch.setattr(s3, "_clients", {})
+	monkeypatch.setattr(s3, "_set_clients", set())
+	# Stands in for boto3 clients, which need credentials and a region
+	monkeypatch.setattr(s3.boto3, "client", lambda service, **kwargs: object())
+	monkeypatch.setattr(s3, "register_events", lambda client: None)
+
+
+def write_object(directory, key, data):
+	path = os.path.join(str(directory), key)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with gzip.open(path, "wb") as f:
+		f.write(data)
+	return path
+
+
+def test_local_bucket_get_object(tmpdir):
+	path = write_object(tmpdir, "uploads/a.xml.gz", b"<HSReplay/>")
+	bucket = s3.LocalBucket(str(tmpdir))
+
+	obj = bucket.get_object(Bucket="any", Key="uploads/a.xml.gz")
+	with obj["Body"] as body:
+		assert gzip.decompress(body.read()) == b"<HSReplay/>"
+	assert obj["ContentLength"] == os.path.getsize(path)
+	assert obj["ETag"] == bucket.head_object(Bucket="other", Key="uploads/a.xml.gz")["ETag"]
+
+
+def test_local_bucket_etag_changes(tmpdir):
+	path = write_object(tmpdir, "a.gz", b"first")
+	bucket = s3.LocalBucket(str(tmpdir))
+	etag = bucket.head_object(Bucket="any", Key="a.gz")["ETag"]
+
+	write_object(tmpdir, "a.gz", b"second version")
+	st = os.stat(path)
+	os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+	assert bucket.head_object(Bucket="any", Key="a.gz")["ETag"] != etag
+
+
+def test_local_bucket_missing_key(tmpdir):
+	with pytest.raises(FileNotFoundError):
+		s3.LocalBucket(str(tmpdir)).get_object(Bucket="any", Key="missing.gz")
+
+
+def test_set_client():
+	bucket = s3.LocalBucket("/nonexistent")
+	s3.set_client(bucket)
+	assert s3.get_client() is bucket
+	assert s3.get_client("firehose") is not bucket
+
+
+def test_configure_keeps_set_clients():
+	bucket = s3.LocalBucket("/nonexistent")
+	s3.set_client(bucket)
+	s3.configure(max_pool=10)
+	assert s3.get_client() is bucket
+	assert s3.SETTINGS["max_pool"] == 10
+
+
+def test_configure_discards_created_clients():
+	client = s3.get_client("firehose")
+	assert s3.get_client("firehose") is client
+	s3.configure(region="eu-west-1")
+	assert s3.get_client("firehose") is not client
+
+
+def test_configure_ignores_none():
+	s3.configure(region="eu-west-1")
+	s3.configure(region=None)
+	assert s3.SETTINGS["region"] == "eu-west-1"
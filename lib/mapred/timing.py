@@ -0,0 +1,271 @@
+"""
+Per-stage timing of replay processing.
+
+A StageTimer accumulates the wall and CPU time spent in each stage of a map
+task (fetch, decompress, prefilter, parse, packet_tree, handler, output) along
+with the bytes read through the fetch and decompress stages. Stages nest, and
+time is exclusive: while the parser pulls decompressed data, the time spent
+inside GzipFile.read() is charged to "decompress" and the time spent waiting
+on the S3 body to "fetch", not to "parse".
+
+Stages are tracked per thread, so with prefetching the fetch and decompress
+times of the worker threads add up to more than the task's elapsed time.
+
+The timer also measures each replay from the moment its input line is parsed
+until the next one is, for a histogram of replay times, and can keep cProfile
+stats of the slowest replays.
+"""
+
+import cProfile
+import heapq
+import io
+import os
+import random
+import sys
+import threading
+import time
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import count
+
+
+thread_time = getattr(time, "thread_time", time.process_time)
+
+
+class StageTimer:
+	def __init__(self, profile_slowest=0, profile_sample=1.0):
+		self.profile_slowest = profile_slowest
+		self.profile_sample = profile_sample
+		self.wall = defaultdict(float)
+		self.cpu = defaultdict(float)
+		self.bytes = defaultdict(int)
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.durations = array("d")
+		self.replay = None
+		self.profiles = []
+		self.sequence = count()
+		self.dumps = count()
+
+	def now(self):
+		return time.perf_counter(), thread_time()
+
+	def charge(self, stage, now):
+		wall, cpu = self.local.mark
+		with self.lock:
+			self.wall[stage] += now[0] - wall
+			self.cpu[stage] += now[1] - cpu
+		self.local.mark = now
+
+	def enter(self, stage):
+		if not hasattr(self.local, "stack"):
+			self.local.stack = []
+		now = self.now()
+		if self.local.stack:
+			self.charge(self.local.stack[-1], now)
+		self.local.stack.append(stage)
+		self.local.mark = now
+
+	def exit(self):
+		self.charge(self.local.stack.pop(), self.now())
+
+	@contextmanager
+	def stage(self, stage):
+		self.enter(stage)
+		try:
+			yield
+		finally:
+			self.exit()
+
+	def add_bytes(self, stage, amount):
+		with self.lock:
+			self.bytes[stage] += amount
+
+	def wrap(self, fh, stage):
+		if fh is None:
+			return None
+		return TimedReader(fh, self, stage)
+
+	def begin_replay(self, line):
+		"""
+		Start timing the replay of the given input line, which ends the
+		timing of the previous one.
+		"""
+		self.end_replay()
+		profile = None
+		if self.profile_slowest and random.random() < self.profile_sample:
+			profile = cProfile.Profile()
+			profile.enable()
+		self.replay = (line, time.perf_counter(), profile)
+
+	def end_replay(self):
+		if self.replay is None:
+			return
+
+		line, start, profile = self.replay
+		self.replay = None
+		duration = time.perf_counter() - start
+		self.durations.append(duration)
+		if profile is None:
+			return
+
+		profile.disable()
+		entry = (duration, next(self.sequence), line, profile)
+		if len(self.profiles) < self.profile_slowest:
+			heapq.heappush(self.profiles, entry)
+		else:
+			heapq.heappushpop(self.profiles, entry)
+
+	def percentile(self, durations, p):
+		return durations[min(int(len(durations) * p), len(durations) - 1)]
+
+	def report(self, increment_counter, histogram=False, out=sys.stderr):
+		"""
+		Report the totals as MRJob counters in the "timing" group and, with
+		`histogram`, the distribution of replay times in the
+		"timing_histogram" group and as a summary on `out`.
+
+		The totals are reset, so that a job instance running several tasks
+		(as in mapred.local) reports each task's time once.
+		"""
+		self.end_replay()
+		with self.lock:
+			wall, cpu, nbytes = self.wall, self.cpu, self.bytes
+			self.wall, self.cpu, self.bytes = defaultdict(float), defaultdict(float), defaultdict(int)
+			durations, self.durations = self.durations, array("d")
+
+		for stage in sorted(wall):
+			increment_counter("timing", "%s_wall_ms" % (stage), int(wall[stage] * 1000))
+			increment_counter("timing", "%s_cpu_ms" % (stage), int(cpu[stage] * 1000))
+		for stage in sorted(nbytes):
+			increment_counter("timing", "%s_bytes" % (stage), nbytes[stage])
+
+		if not histogram or not durations:
+			return
+
+		buckets = defaultdict(int)
+		for duration in durations:
+			ms = int(duration * 1000)
+			low = 1 << (ms.bit_length() - 1) if ms else 0
+			buckets[low] += 1
+		for low, amount in buckets.items():
+			label = "%06i-%06ims" % (low, low * 2 if low else 1)
+			increment_counter("timing_histogram", label, amount)
+
+		durations = sorted(durations)
+		out.write("Replays: %i, p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms\n" % (
+			len(durations),
+			self.percentile(durations, 0.5) * 1000,
+			self.percentile(durations, 0.9) * 1000,
+			self.percentile(durations, 0.99) * 1000,
+			durations[-1] * 1000,
+		))
+		total = sum(wall.values()) or 1
+		out.write("%-20s %12s %12s %6s %14s\n" % ("stage", "wall (ms)", "cpu (ms)", "%", "bytes"))
+		for stage in sorted(wall, key=wall.get, reverse=True):
+			out.write("%-20s %12i %12i %5.1f%% %14i\n" % (
+				stage, wall[stage] * 1000, cpu[stage] * 1000,
+				wall[stage] * 100 / total, nbytes.get(stage, 0),
+			))
+
+	def dump_profiles(self, directory):
+		"""
+		Write the cProfile stats of the slowest replays to `directory`, along
+		with an index of their durations and input lines. Returns the paths
+		of the stats files, slowest first. The profiles are cleared.
+		"""
+		if not self.profiles:
+			return []
+
+		os.makedirs(directory, exist_ok=True)
+		prefix = os.path.join(directory, "slowest-%i-%i" % (os.getpid(), next(self.dumps)))
+		entries, self.profiles = sorted(self.profiles, reverse=True), []
+		ret = []
+		with open(prefix + ".txt", "w", encoding="utf-8") as index:
+			for rank, (duration, sequence, line, profile) in enumerate(entries):
+				path = "%s-%02i.prof" % (prefix, rank)
+				profile.dump_stats(path)
+				if isinstance(line, bytes):
+					line = line.decode("utf-8", "replace")
+				index.write("%s\t%.1f\t%s\n" % (os.path.basename(path), duration * 1000, line))
+				ret.append(path)
+		return ret
+
+
+class TimedReader(io.RawIOBase):
+	"""
+	Binary stream whose reads are timed as a stage of a StageTimer.
+	"""
+	def __init__(self, fh, timer, stage):
+		self.inner = fh
+		self.timer = timer
+		self.stage = stage
+
+	def readable(self):
+		return True
+
+	def read(self, size=-1):
+		with self.timer.stage(self.stage):
+			# botocore's StreamingBody doesn't accept -1 for "read everything"
+			data = self.inner.read(size) if size is not None and size >= 0 else self.inner.read()
+		self.timer.add_bytes(self.stage, len(data))
+		return data
+
+	def readinto(self, b):
+		data = self.read(len(b))
+		b[:len(data)] = data
+		return len(data)
+
+	def readline(self, size=-1):
+		with self.timer.stage(self.stage):
+			data = self.inner.readline(size)
+		self.timer.add_bytes(self.stage, len(data))
+		return data
+
+	def seekable(self):
+		return self.inner.seekable()
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		return self.inner.seek(offset, whence)
+
+	def tell(self):
+		return self.inner.tell()
+
+	def close(self):
+		if not self.closed:
+			self.inner.close()
+		super().close()
+
+
+class TimedReplay:
+	"""
+	Wraps a replay so that building its packet tree is timed as a stage.
+	"""
+	def __init__(self, replay, timer):
+		self.replay = replay
+		self.timer = timer
+
+	def __getattr__(self, name):
+		return getattr(self.replay, name)
+
+	def to_packet_tree(self):
+		with self.timer.stage("packet_tree"):
+			return self.replay.to_packet_tree()
+
+
+class TimedProtocol:
+	"""
+	Wraps an MRJob protocol so that formatting output is timed as a stage.
+	"""
+	def __init__(self, protocol, timer, stage="output"):
+		self.protocol = protocol
+		self.timer = timer
+		self.stage = stage
+
+	def read(self, line):
+		return self.protocol.read(line)
+
+	def write(self, key, value):
+		with self.timer.stage(self.stage):
+			return self.protocol.write(key, value)
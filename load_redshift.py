@@ -4,8 +4,28 @@ NOTE: Make sure you have packaged up the latest libraries and ./lib is on the py
 $ ./package_libraries.sh
 $ PYTHONPATH=$PYTHONPATH:lib python load_redshift.py -r emr --conf-path mrjob.conf --cluster-id <CLUSTER_ID> <INPUTS_FILE> --no-output
 
+For backfills, write the records to gzipped part files instead of Firehose and
+bulk load them with COPY afterwards:
+
+$ PYTHONPATH=$PYTHONPATH:lib python load_redshift.py ... --export-location <BUCKET>:<PREFIX>/
+$ PYTHONPATH=lib python -m mapred.bulkload <BUCKET>:<PREFIX>/ --iam-role <ROLE> --database-url <URL>
+
+Records which Firehose still rejects after the last retry fail the map task,
+unless --dead-letter-location is given: they are then written there as part
+files, to be loaded the same way once the job is done.
+
+To load every game once when both players uploaded it, skip the duplicate
+uploads by global game ID:
+
+$ PYTHONPATH=$PYTHONPATH:lib python find_duplicates.py --key game_id <INPUTS_FILE> > duplicates.txt
+$ PYTHONPATH=lib python -m mapred.dedupe build --exact duplicates.txt dedupe.bin
+$ PYTHONPATH=$PYTHONPATH:lib python load_redshift.py ... --dedupe dedupe.bin
+
 See the ./lib/redshift/tests/* for examples of the expected metadata.
 """
+from mapred import s3
+from mapred.bulkload import BulkExporter
+from mapred.firehose import FirehosePublisher
 from mapred.protocols import BaseJob
 from redshift.etl.exporters import RedshiftPublishingExporter
 from redshift.etl.records import (
@@ -14,32 +34,35 @@ from redshift.etl.records import (
 )
 
 
+# Each record type and the exporter method returning its records
+RECORD_TYPES = (
+	(GameRecord, "get_game_records"),
+	(PlayerRecord, "get_player_records"),
+	(BlockRecord, "get_block_records"),
+	(BlockInfoRecord, "get_block_info_records"),
+	(ChoicesRecord, "get_choice_records"),
+	(EntityStateRecord, "get_entity_state_records"),
+	(OptionsRecord, "get_option_records"),
+)
+
+
+def get_stream(record_class):
+	"""
+	Return the delivery stream name and record serializer of the record
+	class' Firehose output. Batching is left to the FirehosePublisher.
+	"""
+	output = record_class.get_firehose_output()
+	return output.stream_name, output.serialize
+
+
 def handle_replay(self, replay, metadata):
 	try:
 		packet_tree = replay.to_packet_tree()[0]
 		exporter = RedshiftPublishingExporter(packet_tree).export()
 		exporter.set_game_info(metadata)
 
-		game_record_output = GameRecord.get_firehose_output()
-		game_record_output.write(exporter.get_game_records())
-
-		player_record_output = PlayerRecord.get_firehose_output()
-		player_record_output.write(exporter.get_player_records())
-
-		block_record_output = BlockRecord.get_firehose_output()
-		block_record_output.write(exporter.get_block_records())
-
-		block_info_record_output = BlockInfoRecord.get_firehose_output()
-		block_info_record_output.write(exporter.get_block_info_records())
-
-		choices_record_output = ChoicesRecord.get_firehose_output()
-		choices_record_output.write(exporter.get_choice_records())
-
-		entity_state_record_output = EntityStateRecord.get_firehose_output()
-		entity_state_record_output.write(exporter.get_entity_state_records())
-
-		options_record_output = OptionsRecord.get_firehose_output()
-		options_record_output.write(exporter.get_option_records())
+		for record_class, getter in RECORD_TYPES:
+			self.publish(record_class, getattr(exporter, getter)())
 	except Exception as e:
 		self.increment_counter("exceptions", e.__class__.__name__)
 		self.increment_counter("error_global_game_ids", metadata["game_id"])
@@ -47,8 +70,53 @@ def handle_replay(self, replay, metadata):
 
 
 class Job(BaseJob):
+	REQUIRED_METADATA = ("game_id", )
 	handler_function = handle_replay
 
+	def configure_args(self):
+		super(Job, self).configure_args()
+		self.add_passthru_arg(
+			"--export-location",
+			help="Write records to gzipped part files under <STORAGE_LOCATION>:<PREFIX> "
+			"for a bulk COPY instead of publishing them to Firehose"
+		)
+		self.add_passthru_arg(
+			"--dead-letter-location",
+			help="Write the records Firehose rejects after every retry to part files under "
+			"<STORAGE_LOCATION>:<PREFIX>, instead of failing the task"
+		)
+
+	def mapper_init(self):
+		self.dead_letters = None
+		if self.options.export_location:
+			self.publisher = BulkExporter(self.options.export_location)
+		else:
+			dead_letter = None
+			if self.options.dead_letter_location:
+				self.dead_letters = BulkExporter(self.options.dead_letter_location)
+				dead_letter = self.dead_letters.publish
+			self.publisher = FirehosePublisher(s3.get_client("firehose"), dead_letter=dead_letter)
+		self.streams = {}
+
+	def publish(self, record_class, records):
+		if record_class not in self.streams:
+			self.streams[record_class] = get_stream(record_class)
+		stream, serialize = self.streams[record_class]
+		for record in records:
+			self.publisher.publish(stream, serialize(record))
+
+	def mapper_final(self):
+		self.publisher.close()
+		self.publisher.report(self.increment_counter)
+		if self.dead_letters is not None:
+			self.dead_letters.close()
+			self.dead_letters.report(
+				lambda group, counter, amount: self.increment_counter("dead_letter", counter, amount)
+			)
+		elif not self.options.export_location and self.publisher.failed:
+			# Fail the task rather than let a run which lost records look successful
+			raise RuntimeError("%i records could not be delivered to Firehose" % (self.publisher.failed))
+
 
 if __name__ == "__main__":
 	Job.run()
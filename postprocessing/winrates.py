@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""
+Win rates, deltas against a baseline and confidence intervals of grouped job
+output.
+
+The input is a CSV with a header, either one row per game (a `--won` column
+of 0/1 or WON/LOST) or pre-aggregated rows (with `--games` counting the games
+of each row and `--won` the games won). It is read in chunks, so only the
+per-group sums are kept in memory, and every statistic is computed in one
+vectorized pass over all the groups.
+
+Base win rates by class, as in data/arena-mulligan-luck/baseWinRates.csv:
+
+	$ python postprocessing/winrates.py stats.csv --by player_class \\
+		--won games_won --games games_played --sort=-win_rate \\
+		--fields player_class,win_rate:baseRate,games:n --row-names
+
+Improvement over the class' base win rate, as in improvementByClass.csv:
+
+	$ python postprocessing/winrates.py stats.csv --by player_class,Luck \\
+		--won games_won --games games_played --baseline-by player_class \\
+		--fields player_class,Luck,delta:Improvement --row-names
+
+Win rate deltas per pick against not playing Kazakus, with intervals, as in
+data/deep-dive-into-kazakus/heatmap_data.csv:
+
+	$ python postprocessing/winrates.py games.csv \\
+		--by friendly_class,opponent_class,turn,pick --won won \\
+		--baseline pick=noplay --pivot pick --percent
+
+Intervals are 95% Wilson score intervals (and Newcombe's hybrid score
+interval for deltas) by default, or percentile bootstrap intervals with
+--interval bootstrap. The `ci` fields are half the width of the interval.
+
+With --row-names, the output is written like R's write.csv(): with a row
+number column, every string quoted and missing values as NA, so that
+read.table() keeps key values with spaces or commas whole.
+"""
+
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+
+CHUNK_SIZE = 100000
+Z_95 = 1.959963984540054
+# Groups resampled at once when bootstrapping, to bound memory use
+BOOTSTRAP_SLICE = 10000
+WIN_VALUES = ("1", "1.0", "WON", "WIN", "True", "true")
+# Interval column of the baseline in the wide layout, as in heatmap_data.csv
+BASELINE_CI_NAME = "no_play_CI"
+
+LONG_FIELDS = (
+	"games", "wins", "win_rate", "ci", "ci_low", "ci_high",
+	"baseline_games", "baseline_rate", "delta", "delta_ci", "delta_ci_low", "delta_ci_high",
+)
+# Fields scaled by --percent
+RATE_FIELDS = (
+	"win_rate", "ci", "ci_low", "ci_high",
+	"baseline_rate", "delta", "delta_ci", "delta_ci_low", "delta_ci_high",
+)
+
+
+def factorize(columns):
+	"""
+	Return the group index of every row of `columns` (one array per key
+	column) and the first row of every group.
+	"""
+	codes = np.zeros(len(columns[0]), dtype=np.int64)
+	for column in columns:
+		values, inverse = np.unique(column, return_inverse=True)
+		# Renumber after every column so that codes stay below the row count
+		codes = np.unique(codes * len(values) + inverse.ravel(), return_inverse=True)[1].ravel()
+	groups, first_rows, inverse = np.unique(codes, return_index=True, return_inverse=True)
+	return inverse.ravel(), first_rows
+
+
+def parse_wins(values):
+	try:
+		return np.asarray(values, dtype=np.float64)
+	except ValueError:
+		return np.isin(np.asarray(values), WIN_VALUES).astype(np.float64)
+
+
+class GroupedCounts:
+	"""
+	Games and wins summed per group key, accumulated chunk by chunk.
+	"""
+	def __init__(self):
+		self.index = {}
+		self.keys = []
+		self.wins = np.zeros(0)
+		self.games = np.zeros(0)
+
+	def __len__(self):
+		return len(self.keys)
+
+	def add(self, key_columns, wins, games):
+		rows, first_rows = factorize(key_columns)
+		chunk_wins = np.bincount(rows, weights=wins, minlength=len(first_rows))
+		chunk_games = np.bincount(rows, weights=games, minlength=len(first_rows))
+
+		indexes = np.empty(len(first_rows), dtype=np.int64)
+		for i, row in enumerate(first_rows):
+			key = tuple(column[row] for column in key_columns)
+			index = self.index.get(key)
+			if index is None:
+				index = self.index[key] = len(self.keys)
+				self.keys.append(key)
+			indexes[i] = index
+
+		if len(self.keys) > len(self.wins):
+			grow = len(self.keys) - len(self.wins)
+			self.wins = np.concatenate((self.wins, np.zeros(grow)))
+			self.games = np.concatenate((self.games, np.zeros(grow)))
+		# Indexes are unique within a chunk
+		self.wins[indexes] += chunk_wins
+		self.games[indexes] += chunk_games
+
+	def key_column(self, i):
+		return np.array([key[i] for key in self.keys], dtype=object)
+
+
+def read_counts(f, by, won, games=None, chunk_size=CHUNK_SIZE):
+	reader = csv.reader(f)
+	header = next(reader)
+	try:
+		key_indexes = [header.index(column) for column in by]
+		won_index = header.index(won)
+		games_index = header.index(games) if games else None
+	except ValueError as e:
+		raise ValueError("Missing column: %s (columns are %s)" % (e, ", ".join(header)))
+
+	counts = GroupedCounts()
+
+	def add(rows):
+		key_columns = [np.array([row[i] for row in rows], dtype=object) for i in key_indexes]
+		wins = parse_wins([row[won_index] for row in rows])
+		if games_index is None:
+			row_games = np.ones(len(rows))
+		else:
+			row_games = np.asarray([row[games_index] for row in rows], dtype=np.float64)
+		counts.add(key_columns, wins, row_games)
+
+	rows = []
+	for row in reader:
+		if not row:
+			continue
+		rows.append(row)
+		if len(rows) >= chunk_size:
+			add(rows)
+			rows = []
+	if rows:
+		add(rows)
+	return counts
+
+
+def rates(wins, games):
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return np.where(games > 0, wins / games, np.nan)
+
+
+def wilson_interval(wins, games, z=Z_95):
+	p = rates(wins, games)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		denominator = 1 + z * z / games
+		center = (p + z * z / (2 * games)) / denominator
+		margin = z * np.sqrt(p * (1 - p) / games + z * z / (4 * games * games)) / denominator
+	return center - margin, center + margin
+
+
+def newcombe_interval(wins, games, baseline_wins, baseline_games, z=Z_95):
+	"""
+	Newcombe's hybrid score interval of the difference between two rates,
+	from their Wilson intervals.
+	"""
+	p1, p2 = rates(wins, games), rates(baseline_wins, baseline_games)
+	low1, high1 = wilson_interval(wins, games, z)
+	low2, high2 = wilson_interval(baseline_wins, baseline_games, z)
+	delta = p1 - p2
+	low = delta - np.sqrt((p1 - low1) ** 2 + (high2 - p2) ** 2)
+	high = delta + np.sqrt((high1 - p1) ** 2 + (p2 - low2) ** 2)
+	return low, high
+
+
+def bootstrap_rates(rng, wins, games, iterations):
+	# Resampling n Bernoulli outcomes of rate p draws Binomial(n, p) wins
+	n = games.astype(np.int64)
+	p = np.nan_to_num(rates(wins, games))
+	samples = rng.binomial(n, p, size=(iterations, len(n)))
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return samples / n
+
+
+def bootstrap_interval(
+	wins, games, baseline_wins=None, baseline_games=None, iterations=1000, confidence=0.95, seed=None
+):
+	"""
+	Percentile bootstrap interval of the win rates or, given a baseline, of
+	their difference with it. Returns (low, high) arrays.
+	"""
+	rng = np.random.default_rng(seed)
+	alpha = (1 - confidence) / 2 * 100
+	low, high = np.full(len(wins), np.nan), np.full(len(wins), np.nan)
+	for start in range(0, len(wins), BOOTSTRAP_SLICE):
+		part = slice(start, start + BOOTSTRAP_SLICE)
+		samples = bootstrap_rates(rng, wins[part], games[part], iterations)
+		if baseline_wins is not None:
+			samples = samples - bootstrap_rates(rng, baseline_wins[part], baseline_games[part], iterations)
+		with np.errstate(invalid="ignore"):
+			low[part], high[part] = np.nanpercentile(samples, (alpha, 100 - alpha), axis=0)
+	return low, high
+
+
+def baseline_by_columns(counts, by, baseline_by):
+	"""
+	Return the baseline (wins, games) of every group: the totals of all the
+	groups which share their `baseline_by` columns.
+	"""
+	columns = [counts.key_column(by.index(column)) for column in baseline_by]
+	groups, first_rows = factorize(columns)
+	wins = np.bincount(groups, weights=counts.wins)
+	games = np.bincount(groups, weights=counts.games)
+	return wins[groups], games[groups]
+
+
+def baseline_by_value(counts, by, column, value):
+	"""
+	Return the baseline (wins, games) of every group: those of the group with
+	the same key but `value` in `column` (NaN if there is none).
+	"""
+	i = by.index(column)
+	wins, games = np.full(len(counts), np.nan), np.full(len(counts), np.nan)
+	for index, key in enumerate(counts.keys):
+		baseline = counts.index.get(key[:i] + (value, ) + key[i + 1:])
+		if baseline is not None:
+			wins[index], games[index] = counts.wins[baseline], counts.games[baseline]
+	return wins, games
+
+
+def compute(counts, baseline=None, interval="wilson", iterations=1000, seed=None):
+	"""
+	Return a dict of the LONG_FIELDS arrays of `counts`. `baseline` is a
+	(wins, games) tuple of arrays from one of the baseline_* functions.
+	"""
+	wins, games = counts.wins, counts.games
+	ret = {"games": games, "wins": wins, "win_rate": rates(wins, games)}
+	if interval == "bootstrap":
+		ret["ci_low"], ret["ci_high"] = bootstrap_interval(wins, games, iterations=iterations, seed=seed)
+	else:
+		ret["ci_low"], ret["ci_high"] = wilson_interval(wins, games)
+	ret["ci"] = (ret["ci_high"] - ret["ci_low"]) / 2
+
+	if baseline is not None:
+		baseline_wins, baseline_games = baseline
+		ret["baseline_games"] = baseline_games
+		ret["baseline_rate"] = rates(baseline_wins, baseline_games)
+		ret["delta"] = ret["win_rate"] - ret["baseline_rate"]
+		if interval == "bootstrap":
+			low, high = bootstrap_interval(
+				wins, games, np.nan_to_num(baseline_wins), np.nan_to_num(baseline_games),
+				iterations=iterations, seed=seed,
+			)
+		else:
+			low, high = newcombe_interval(wins, games, baseline_wins, baseline_games)
+		ret["delta_ci_low"], ret["delta_ci_high"] = low, high
+		ret["delta_ci"] = (high - low) / 2
+	return ret
+
+
+def format_value(value, na=""):
+	if isinstance(value, (float, np.floating)):
+		if np.isnan(value):
+			return na
+		if value == int(value) and abs(value) < 1e15:
+			return str(int(value))
+	return str(value)
+
+
+def format_r_value(value):
+	if isinstance(value, str):
+		return '"%s"' % (value.replace('"', '""'))
+	return format_value(value, na="NA")
+
+
+def long_rows(counts, by, stats, fields):
+	"""
+	Yield the header and rows of the long layout: one row per group with the
+	`fields` of LONG_FIELDS or `by` (optionally renamed with `field:name`).
+	Keys are yielded as strings and statistics as numbers.
+	"""
+	fields = [field.partition(":") for field in fields]
+	yield [name or field for field, sep, name in fields]
+	for index, key in enumerate(counts.keys):
+		row = []
+		for field, sep, name in fields:
+			if field in by:
+				row.append(key[by.index(field)])
+			else:
+				row.append(stats[field][index])
+		yield row
+
+
+def wide_rows(counts, by, stats, pivot, baseline_value=None, baseline_ci_name=BASELINE_CI_NAME):
+	"""
+	Yield the header and rows of the wide layout: one row per key of the
+	other `by` columns, with `<value>_num`, `win_<value>` and `win_<value>_ci`
+	columns per value of `pivot` (`baseline_ci_name` for the interval of the
+	baseline value). Values other than the baseline one get the delta against
+	it, like the heatmaps of the articles.
+	"""
+	i = by.index(pivot)
+	values = []
+	rows = {}
+	for index, key in enumerate(counts.keys):
+		value = key[i]
+		if value not in values:
+			values.append(value)
+		rows.setdefault(key[:i] + key[i + 1:], {})[value] = index
+	if baseline_value in values:
+		values.remove(baseline_value)
+		values.insert(0, baseline_value)
+
+	header = [column for column in by if column != pivot]
+	for value in values:
+		ci_name = "win_%s_ci" % (value)
+		if value == baseline_value:
+			ci_name = baseline_ci_name
+		header += ["%s_num" % (value), "win_%s" % (value), ci_name]
+	yield header
+	for key, indexes in rows.items():
+		row = list(key)
+		for value in values:
+			index = indexes.get(value)
+			if index is None:
+				row += [np.nan, np.nan, np.nan]
+				continue
+			rate, ci = "win_rate", "ci"
+			if "delta" in stats and value != baseline_value:
+				rate, ci = "delta", "delta_ci"
+			row += [stats[name][index] for name in ("games", rate, ci)]
+		yield row
+
+
+def sort_groups(counts, stats, field, by):
+	descending = field.startswith("-")
+	field = field.lstrip("-")
+	if field in by:
+		order = np.argsort(counts.key_column(by.index(field)), kind="stable")
+	else:
+		order = np.argsort(stats[field], kind="stable")
+	if descending:
+		order = order[::-1]
+	counts.keys = [counts.keys[i] for i in order]
+	for name in stats:
+		stats[name] = stats[name][order]
+
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	p.add_argument("input", help="CSV output of a job, with a header ('-' for stdin)")
+	p.add_argument("--by", required=True, help="Comma-separated columns to group by")
+	p.add_argument("--won", required=True, help="Column of wins (0/1, WON/LOST) or games won")
+	p.add_argument("--games", help="Column of games played, if rows are pre-aggregated")
+	baseline = p.add_mutually_exclusive_group()
+	baseline.add_argument(
+		"--baseline-by", help="Compare each group to the totals of the groups sharing these columns"
+	)
+	baseline.add_argument(
+		"--baseline", metavar="COLUMN=VALUE",
+		help="Compare each group to the group with VALUE in COLUMN and the same other keys"
+	)
+	p.add_argument(
+		"--baseline-ci-name", default=BASELINE_CI_NAME,
+		help="Name of the interval column of the --baseline value with --pivot (default: %(default)s)"
+	)
+	p.add_argument("--interval", choices=("wilson", "bootstrap"), default="wilson")
+	p.add_argument("--bootstrap-iterations", type=int, default=1000)
+	p.add_argument("--seed", type=int, help="Random seed of the bootstrap")
+	p.add_argument("--min-games", type=float, default=0, help="Drop groups with fewer games")
+	p.add_argument("--percent", action="store_true", help="Output rates and intervals in percent")
+	p.add_argument("--sort", help="Field to sort the groups by, prefixed with '-' for descending")
+	p.add_argument("--pivot", help="Output one column set per value of this --by column")
+	p.add_argument("--fields", help="Comma-separated fields of the long layout, as FIELD[:NAME]")
+	p.add_argument("--row-names", action="store_true", help="Prepend R's row number column")
+	p.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+	p.add_argument("-o", "--output", help="File to write the CSV to (default: stdout)")
+	args = p.parse_args()
+
+	by = args.by.split(",")
+	if args.input == "-":
+		counts = read_counts(sys.stdin, by, args.won, args.games, args.chunk_size)
+	else:
+		with open(args.input, "r", newline="") as f:
+			counts = read_counts(f, by, args.won, args.games, args.chunk_size)
+
+	baseline, baseline_value = None, None
+	if args.baseline_by:
+		baseline = baseline_by_columns(counts, by, args.baseline_by.split(","))
+	elif args.baseline:
+		column, sep, baseline_value = args.baseline.partition("=")
+		baseline = baseline_by_value(counts, by, column, baseline_value)
+
+	stats = compute(counts, baseline, args.interval, args.bootstrap_iterations, args.seed)
+	if args.percent:
+		for name in RATE_FIELDS:
+			if name in stats:
+				stats[name] = stats[name] * 100
+
+	if args.min_games:
+		keep = np.flatnonzero(counts.games >= args.min_games)
+		counts.keys = [counts.keys[i] for i in keep]
+		stats = dict((name, values[keep]) for name, values in stats.items())
+	if args.sort:
+		sort_groups(counts, stats, args.sort, by)
+
+	if args.pivot:
+		rows = wide_rows(counts, by, stats, args.pivot, baseline_value, args.baseline_ci_name)
+	else:
+		fields = args.fields.split(",") if args.fields else by + [
+			field for field in LONG_FIELDS if field in stats
+		]
+		rows = long_rows(counts, by, stats, fields)
+
+	out = open(args.output, "w", newline="") if args.output else sys.stdout
+	writer = csv.writer(out, lineterminator="\n")
+	for i, row in enumerate(rows):
+		if args.row_names:
+			row = [str(i) if i else ""] + row
+			out.write(",".join(format_r_value(value) for value in row) + "\n")
+		else:
+			writer.writerow([format_value(value) for value in row])
+	if args.output:
+		out.close()
+
+
+if __name__ == "__main__":
+	main()